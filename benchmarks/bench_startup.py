@@ -0,0 +1,95 @@
+"""
+Startup benchmark for cli.py: the time to `--help` and the time from starting
+the interpreter to entering each subcommand's function (including the import
+of its module and dependencies), as seen by cron starting a container
+
+    python benchmarks/bench_startup.py                    # print the timings
+    python benchmarks/bench_startup.py --max_help 0.3     # exit with an error above 0.3 s
+
+The function itself isn't run: the child process stops as soon as it has been
+imported and is about to be called.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import os
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+# example arguments for each subcommand
+SUBCOMMANDS = {
+    'download_gfs_atm': ['--run_date', '2024-01-10 00:00:00', '--hdays', '1', '--fdays', '1', '--outputDir', '.'],
+    'download_hycom_ops': ['--run_date', '2024-01-10 00:00:00', '--outputDir', '.'],
+    'download_hycom_gofs31': ['--start_date', '2024-01-01 00:00:00', '--end_date', '2024-01-31 00:00:00',
+                              '--outputDir', '.'],
+    'download_mercator_ops': ['--usrname', 'u', '--passwd', 'p', '--run_date', '2024-01-10 00:00:00',
+                              '--hdays', '1', '--fdays', '1', '--outputDir', '.'],
+    'download_cmems_monthly': ['--usrname', 'u', '--passwd', 'p', '--dataset', 'd',
+                               '--start_date', '2024-01-01 00:00:00', '--end_date', '2024-01-31 00:00:00',
+                               '--outputDir', '.'],
+    'download_ops': ['--run_date', '2024-01-10 00:00:00', '--outputDir', '.'],
+}
+
+# run in the child: replace the cli's lazy functions so that calling one imports
+# the real function and then exits instead of running it
+CHILD = """
+import sys
+sys.path.insert(0, {repo!r})
+sys.argv = ['cli.py'] + {argv!r}
+import cli
+for name, value in list(vars(cli).items()):
+    if isinstance(value, cli.lazy):
+        setattr(cli, name, lambda *a, _f=value, **k: (_f.resolve(), sys.exit(0)))
+cli.main()
+"""
+
+def timeit(argv, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', CHILD.format(repo=REPO, argv=argv)], cwd=REPO,
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='cli.py startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement (the median is reported)')
+    parser.add_argument('--max_help', type=float, default=None, help='fail if --help takes longer (s)')
+    parser.add_argument('--max_gfs', type=float, default=None,
+                        help='fail if entering download_gfs_atm takes longer (s)')
+    args = parser.parse_args()
+
+    baseline = timeit_python(args.repeat)
+    results = {'python (baseline)': baseline, '--help': timeit(['--help'], args.repeat)}
+    for name, argv in SUBCOMMANDS.items():
+        try:
+            results[name] = timeit([name] + argv, args.repeat)
+        except subprocess.CalledProcessError:
+            # e.g. the dependencies of this subcommand aren't installed
+            results[name] = None
+
+    for name, t in results.items():
+        print(f'{name:<25} {"-" if t is None else f"{t:.3f} s"}')
+
+    failed = []
+    if args.max_help is not None and results['--help'] > args.max_help:
+        failed.append(f'--help took {results["--help"]:.3f} s > {args.max_help} s')
+    if args.max_gfs is not None and (results['download_gfs_atm'] or 0) > args.max_gfs:
+        failed.append(f'download_gfs_atm took {results["download_gfs_atm"]:.3f} s > {args.max_gfs} s')
+    if failed:
+        sys.exit('startup regression: ' + '; '.join(failed))
+
+def timeit_python(repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    main()
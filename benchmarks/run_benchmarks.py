@@ -0,0 +1,335 @@
+"""
+Offline benchmarks for the downloaders, run against the local stand-ins in standins.py
+
+    python benchmarks/run_benchmarks.py                       # run everything
+    python benchmarks/run_benchmarks.py --only gfs,hycom_ops  # run a subset
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<label>.json
+    python benchmarks/run_benchmarks.py --record cassettes    # keep the traffic of the run
+    python benchmarks/run_benchmarks.py --replay cassettes    # and replay it, without the stand-ins
+
+Each benchmark runs in its own python process (so peak memory and import costs
+are its own) with the stand-in servers running in this process. The wall time,
+bytes, throughput, per-request latency (from download_tools.metrics) and peak
+RSS are printed and stored in benchmarks/results/<label>.json, where the label
+defaults to the current git commit, so results can be compared across versions.
+
+With --record, the requests of each benchmark and their responses are recorded
+to a cassette (see download_tools/transport.py) in <dir>/<benchmark>, with the
+settings of its stand-ins, and --replay serves them from there with the emulated
+latency, bandwidth and failures of the --replay_* options instead.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+RUN_DATE = datetime(2024, 1, 10)
+MONTH = datetime(2024, 1, 1)
+
+def domain(scale):
+    # a 2x2 degree box by default, grown by scale in each direction
+    return [11., 11. + 2. * scale, -36. - 2. * scale, -36.]
+
+# ------------------------------------------------------------
+# setup of each benchmark (run in this process): returns env vars for the worker
+# ------------------------------------------------------------
+
+def _gfs_mirrors_env(workdir, mirrors):
+    path = os.path.join(workdir, 'gfs_mirrors.json')
+    with open(path, 'w') as f:
+        json.dump(mirrors, f)
+    return {'SOMISANA_GFS_MIRRORS': path, 'SOMISANA_MIRROR_HISTORY': os.path.join(workdir, 'mirror_history.json')}
+
+def setup_gfs(workdir, args, servers):
+    from standins import GfsStandin
+    gfs = GfsStandin(latency=args.latency, bandwidth=args.bandwidth)
+    servers.append(gfs)
+    url = gfs.start()
+    env = {'SOMISANA_NOMADS_URL': url}
+    env.update(_gfs_mirrors_env(workdir, [{'name': 'nomads', 'url': url, 'filter': True,
+                                           'prefix': '/pub/data/nccf/com/gfs/prod'}]))
+    return env
+
+def setup_gfs_mirrors(workdir, args, servers):
+    # a slow NOMADS (filter CGI), a fast mirror serving byte ranges only, and a mirror which is down
+    import socket
+    from standins import GfsStandin
+    slow = GfsStandin(latency=args.latency + 0.5, bandwidth=args.bandwidth)
+    fast = GfsStandin(latency=args.latency, bandwidth=args.bandwidth, filter_cgi=False)
+    servers.extend([slow, fast])
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        dead = f'http://127.0.0.1:{s.getsockname()[1]}'
+    prefix = '/pub/data/nccf/com/gfs/prod'
+    return _gfs_mirrors_env(workdir, [
+        {'name': 'nomads', 'url': slow.start(), 'filter': True, 'prefix': prefix},
+        {'name': 'down', 'url': dead, 'filter': True, 'prefix': prefix},
+        {'name': 'bucket', 'url': fast.start(), 'filter': False, 'prefix': prefix},
+    ])
+
+def setup_hycom(workdir, args, servers, gofs31=False):
+    from standins import make_hycom_tree, hycom_standin
+    root = os.path.join(workdir, 'thredds')
+    make_hycom_tree(root, RUN_DATE, domain(args.scale), gofs31_month=MONTH if gofs31 else None)
+    url, server = hycom_standin(root, latency=args.latency)
+    if server is not None:
+        servers.append(server)
+    return {'SOMISANA_HYCOM_THREDDS': url}
+
+def setup_cmems(workdir, args, servers):
+    from standins import stub_env
+    return stub_env(latency=args.latency, bandwidth=args.bandwidth)
+
+def setup_era5(workdir, args, servers):
+    from synthetic import make_era5
+    raw = os.path.join(workdir, 'raw')
+    os.makedirs(raw)
+    variables = ['sst', 't2m', 'u10', 'v10', 'msl']
+    area = [-25. + 2 * args.scale, 11., -39. - 2 * args.scale, 36.]
+    for v in variables:
+        make_era5(os.path.join(raw, f'ERA5_ecmwf_{v.upper()}_Y{MONTH.year}M{MONTH.month:02d}.nc'),
+                  v, MONTH.year, MONTH.month, area)
+    with open(os.path.join(workdir, 'era5_crocotools_param.py'), 'w') as f:
+        f.write(f"""
+era5_dir_raw = {raw!r}
+era5_dir_processed = {os.path.join(workdir, 'out')!r}
+year_start = year_end = {MONTH.year}
+month_start = month_end = {MONTH.month}
+Yorig = 1993
+nt_block = 24
+n_workers = {os.cpu_count()}
+variables = {variables!r}
+conv_cff = {[1.] * len(variables)!r}
+units = ['K', 'K', 'm s-1', 'm s-1', 'Pa']
+""")
+    shutil.copy(os.path.join(REPO, 'download_tools', 'ERA5', 'ERA5_variables.json'), workdir)
+    return {}
+
+# ------------------------------------------------------------
+# the benchmarks themselves (run in the worker process)
+# ------------------------------------------------------------
+
+def run_gfs(outdir, args):
+    from download_tools.gfs import download_gfs_atm
+    download_gfs_atm(domain(args.scale), RUN_DATE, 1, 1, outdir)
+
+def run_hycom_ops(outdir, args):
+    from download_tools.hycom import download_hycom_ops
+    download_hycom_ops(domain(args.scale), RUN_DATE, 1, 1, outdir, parallel=True)
+
+def run_hycom_gofs31(outdir, args):
+    from download_tools.hycom import download_hycom_gofs31
+    download_hycom_gofs31(domain(args.scale), MONTH, MONTH, outdir, depths=[0, 50])
+
+def run_mercator_ops(outdir, args):
+    from download_tools.cmems import download_mercator_ops
+    download_mercator_ops('user', 'pass', domain(args.scale), RUN_DATE, 1, 1, outdir)
+
+def run_cmems_monthly(outdir, args):
+    from download_tools.cmems import download_cmems_monthly
+    download_cmems_monthly('user', 'pass', 'cmems_mod_glo_phy_my_0.083deg_P1D-m', domain(args.scale),
+                           MONTH, datetime(MONTH.year, MONTH.month + 1, 1),
+                           ['so', 'thetao', 'zos', 'uo', 'vo'], [0.493, 50.], outdir)
+
+def run_era5_convert(outdir, args):
+    import runpy
+    workdir = os.path.dirname(outdir)
+    os.chdir(workdir)
+    sys.path[:0] = [workdir, os.path.join(REPO, 'download_tools', 'ERA5')]
+    # the processed files go straight into outdir (see setup_era5)
+    runpy.run_path(os.path.join(REPO, 'download_tools', 'ERA5', 'ERA5_convert.py'), run_name='__main__')
+
+BENCHMARKS = {
+    'gfs': (setup_gfs, run_gfs),
+    'gfs_mirrors': (setup_gfs_mirrors, run_gfs),
+    'hycom_ops': (setup_hycom, run_hycom_ops),
+    'hycom_gofs31': (lambda w, a, s: setup_hycom(w, a, s, gofs31=True), run_hycom_gofs31),
+    'mercator_ops': (setup_cmems, run_mercator_ops),
+    'cmems_monthly': (setup_cmems, run_cmems_monthly),
+    'era5_convert': (setup_era5, run_era5_convert),
+}
+
+# benchmarks which don't make any request, run as usual with --replay
+OFFLINE = {'era5_convert'}
+
+def _save_env(env, workdir, cassette):
+    # the files the environment points to (e.g. the mirrors config) are kept with the cassette
+    for value in env.values():
+        if value.startswith(workdir) and os.path.isfile(value):
+            dest = os.path.join(cassette, 'workdir', os.path.relpath(value, workdir))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(value, dest)
+    os.makedirs(cassette, exist_ok=True)
+    with open(os.path.join(cassette, 'env.json'), 'w') as f:
+        json.dump({k: v.replace(workdir, '{workdir}') for k, v in env.items()}, f, indent=1)
+
+def _load_env(workdir, cassette):
+    if os.path.isdir(os.path.join(cassette, 'workdir')):
+        shutil.copytree(os.path.join(cassette, 'workdir'), workdir, dirs_exist_ok=True)
+    with open(os.path.join(cassette, 'env.json')) as f:
+        return {k: v.replace('{workdir}', workdir) for k, v in json.load(f).items()}
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100. * (len(values) - 1))))]
+
+def worker(name, outdir, args):
+    sys.path.insert(0, REPO)
+    from download_tools import metrics, transport
+    if name not in OFFLINE and (args.record or args.replay):
+        transport.start('record' if args.record else 'replay', os.path.join(args.record or args.replay, name),
+                        args.replay_latency, args.replay_bandwidth, args.replay_errors, args.replay_seed)
+    t0 = time.time()
+    BENCHMARKS[name][1](outdir, args)
+    wall = time.time() - t0
+    recs = [r for r in metrics.records() if r['stage'] == 'download' and r['status'] == 'ok']
+    output_bytes = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(outdir) for f in fs
+                       if not f.startswith('.'))
+    nbytes = sum(r['bytes'] for r in recs) or output_bytes
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    result = {
+        'wall': wall,
+        'bytes': nbytes,
+        'output_bytes': output_bytes,
+        'throughput': nbytes / wall if wall > 0 else None,
+        'requests': len(recs),
+        'latency_p50': percentile([r['wall'] for r in recs], 50),
+        'latency_p95': percentile([r['wall'] for r in recs], 95),
+        'wait_p50': percentile([r['phases'].get('wait', 0.) for r in recs], 50),
+        'peak_rss_mb': peak / 1024.,
+    }
+    print('BENCHMARK_RESULT ' + json.dumps(result))
+
+def run(name, args):
+    workdir = tempfile.mkdtemp(prefix=f'somisana_bench_{name}_')
+    outdir = os.path.join(workdir, 'out')
+    os.makedirs(outdir)
+    servers = []
+    try:
+        env = dict(os.environ)
+        if args.replay and name not in OFFLINE:
+            env.update(_load_env(workdir, os.path.join(args.replay, name)))
+        else:
+            setup = BENCHMARKS[name][0](workdir, args, servers)
+            if args.record and name not in OFFLINE:
+                _save_env(setup, workdir, os.path.join(args.record, name))
+            env.update(setup)
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', name, '--outdir', outdir,
+               '--scale', str(args.scale)]
+        for option in ('record', 'replay', 'replay_latency', 'replay_bandwidth', 'replay_errors', 'replay_seed'):
+            if getattr(args, option) is not None:
+                cmd += [f'--{option}', str(getattr(args, option))]
+        proc = subprocess.run(cmd, env=env, cwd=REPO, capture_output=True, text=True)
+        if args.verbose or proc.returncode != 0:
+            print(proc.stdout)
+            print(proc.stderr, file=sys.stderr)
+        if proc.returncode != 0:
+            return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'failed'}
+        line = [l for l in proc.stdout.splitlines() if l.startswith('BENCHMARK_RESULT ')][-1]
+        return json.loads(line[len('BENCHMARK_RESULT '):])
+    finally:
+        for s in servers:
+            (s.stop if hasattr(s, 'stop') else s.shutdown)()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def git_label():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPO,
+                                       text=True).strip()
+    except Exception:
+        return datetime.now().strftime('%Y%m%d_%H%M%S')
+
+def fmt(v, scale=1., unit=''):
+    return '-' if v is None else f'{v / scale:.3g}{unit}'
+
+def print_table(results, baseline=None):
+    print(f"{'benchmark':<15}{'wall':>9}{'MB/s':>9}{'p50':>9}{'p95':>9}{'peak MB':>9}", end='')
+    print(f"{'vs base':>9}" if baseline else '')
+    for name, r in results.items():
+        if 'error' in r:
+            print(f'{name:<15} ERROR: {r["error"]}')
+            continue
+        print(f"{name:<15}{fmt(r['wall'], unit='s'):>9}{fmt(r['throughput'], 1e6):>9}"
+              f"{fmt(r['latency_p50'], unit='s'):>9}{fmt(r['latency_p95'], unit='s'):>9}"
+              f"{fmt(r['peak_rss_mb']):>9}", end='')
+        b = (baseline or {}).get(name)
+        if baseline:
+            print(f"{fmt(r['wall'] / b['wall'], unit='x'):>9}" if b and 'wall' in b else f"{'-':>9}")
+        else:
+            print()
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for somisana-download')
+    parser.add_argument('--only', default=None, help='comma separated list of benchmarks to run')
+    parser.add_argument('--scale', type=float, default=1., help='scale factor for the domain size')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to each stand-in response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='stand-in bandwidth in bytes/s')
+    parser.add_argument('--label', default=None, help='name of the results file (default: git describe)')
+    parser.add_argument('--compare', default=None, help='results json to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories')
+    parser.add_argument('--verbose', action='store_true', help='print the output of the downloaders')
+    parser.add_argument('--record', default=None, help='record the traffic of each benchmark to a cassette in this directory')
+    parser.add_argument('--replay', default=None, help='replay the cassettes of --record from this directory, without the stand-ins')
+    parser.add_argument('--replay_latency', type=float, default=None,
+                        help='with --replay, seconds before every response (default: as recorded)')
+    parser.add_argument('--replay_bandwidth', type=float, default=None,
+                        help='with --replay, bytes/s of the link shared by the transfers (default: as recorded)')
+    parser.add_argument('--replay_errors', type=float, default=None, help='with --replay, fraction of the requests which fail')
+    parser.add_argument('--replay_seed', type=int, default=None, help='with --replay, seed of the failures')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--outdir', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error('--record and --replay are exclusive')
+    for option in ('record', 'replay'):
+        if getattr(args, option):
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+
+    if args.worker:
+        return worker(args.worker, args.outdir, args)
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {}
+    for name in names:
+        print(f'running {name}...', flush=True)
+        results[name] = run(name, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+
+    label = args.label or git_label()
+    os.makedirs(os.path.join(HERE, 'results'), exist_ok=True)
+    out = os.path.join(HERE, 'results', f'{label}.json')
+    with open(out, 'w') as f:
+        json.dump({
+            'label': label,
+            'date': datetime.now().isoformat(),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'settings': {'scale': args.scale, 'latency': args.latency, 'bandwidth': args.bandwidth,
+                         'replay': args.replay, 'replay_latency': args.replay_latency,
+                         'replay_bandwidth': args.replay_bandwidth, 'replay_errors': args.replay_errors},
+            'results': results,
+        }, f, indent=1)
+    print(f'results written to {out}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""
+Local stand-ins for the remote services used by the downloaders, so they can be
+benchmarked offline:
+
+    GfsStandin     : HTTP server mimicking NOMADS (filter_gfs_0p25.pl and the
+                     pub/data/nccf/com/gfs/prod tree of .idx and grib files)
+    hycom_standin  : OPeNDAP server over synthetic HYCOM-shaped NetCDF files
+                     (needs pydap, otherwise the files are read from disk directly)
+    stub_env       : environment putting the stub `copernicusmarine` executable
+                     and `cdsapi` module in stubs/ ahead of the real ones
+
+Each stand-in can add latency and limit bandwidth so that network behaviour can be emulated
+"""
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (variable, level) records in each synthetic GFS grib file, in the order of a real .idx file
+GFS_RECORDS = [
+    ('PRMSL', 'mean sea level'),
+    ('TMP', 'surface'),
+    ('LAND', 'surface'),
+    ('TMP', '2 m above ground'),
+    ('SPFH', '2 m above ground'),
+    ('RH', '2 m above ground'),
+    ('UGRD', '10 m above ground'),
+    ('VGRD', '10 m above ground'),
+    ('PRATE', 'surface'),
+    ('UFLX', 'surface'),
+    ('VFLX', 'surface'),
+    ('DSWRF', 'surface'),
+    ('DLWRF', 'surface'),
+    ('USWRF', 'surface'),
+    ('ULWRF', 'surface'),
+]
+
+# bytes per grid point of a packed grib field, roughly
+GRIB_BYTES_PER_POINT = 2
+
+def _send_throttled(wfile, data, bandwidth):
+    if not bandwidth:
+        wfile.write(data)
+        return
+    block = max(1024, int(bandwidth / 20))
+    for i in range(0, len(data), block):
+        wfile.write(data[i:i + block])
+        time.sleep(len(data[i:i + block]) / bandwidth)
+
+class GfsStandin:
+    """
+    Stand-in for a NOMADS server
+
+    latency   : seconds added before each response
+    bandwidth : bytes per second (None for unlimited)
+    available : function (cycle datetime, forecast hour) -> bool deciding what is published
+                (default everything)
+    error_rate: fraction of requests answered with a 503
+    """
+
+    def __init__(self, latency=0., bandwidth=None, available=None, error_rate=0., filter_cgi=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.available = available or (lambda cycle, fhr: True)
+        self.error_rate = error_rate
+        self.filter_cgi = filter_cgi
+        self.requests = 0
+        self.bytes_sent = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    # full 0.25 deg grid
+    npoints_global = 1440 * 721
+
+    def _record_bytes(self, npoints):
+        return 64 + npoints * GRIB_BYTES_PER_POINT
+
+    def _grib(self, records, npoints, seed):
+        out = []
+        for i, _ in enumerate(records):
+            n = self._record_bytes(npoints)
+            body = bytes((seed + i + j) % 251 for j in range(min(n, 4096)))
+            body = (body * (n // len(body) + 1))[:n - 8]
+            out.append(b'GRIB' + n.to_bytes(4, 'big') + body)
+        return b''.join(out)
+
+    def idx(self, cycle, fhr):
+        lines, offset = [], 0
+        n = self._record_bytes(self.npoints_global)
+        for i, (var, lev) in enumerate(GFS_RECORDS):
+            fcst = 'anl' if fhr == 0 else f'{fhr} hour fcst'
+            lines.append(f"{i + 1}:{offset}:d={cycle.strftime('%Y%m%d%H')}:{var}:{lev}:{fcst}:")
+            offset += n
+        return ('\n'.join(lines) + '\n').encode()
+
+    def start(self, port=0):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, as NOMADS does
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code, data=b'', headers=None):
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                _send_throttled(self.wfile, data, standin.bandwidth)
+                with standin._lock:
+                    standin.bytes_sent += len(data)
+
+            def do_GET(self):
+                with standin._lock:
+                    standin.requests += 1
+                    standin._count += 1
+                    fail = standin.error_rate and (standin._count * standin.error_rate) % 1 < standin.error_rate
+                if standin.latency:
+                    time.sleep(standin.latency)
+                if fail:
+                    return self._reply(503, b'Service Unavailable')
+                url = urlparse(self.path)
+                if url.path == '/cgi-bin/filter_gfs_0p25.pl' and standin.filter_cgi:
+                    return self._filter(parse_qs(url.query, keep_blank_values=True))
+                m = re.match(r'/pub/data/nccf/com/gfs/prod/gfs\.(\d{8})/(\d\d)/atmos/'
+                             r'gfs\.t\d\dz\.pgrb2\.0p25\.f(\d{3})(\.idx)?$', url.path)
+                if m:
+                    cycle = datetime.strptime(m.group(1) + m.group(2), '%Y%m%d%H')
+                    fhr = int(m.group(3))
+                    if not standin.available(cycle, fhr):
+                        return self._reply(404, b'Not Found')
+                    if m.group(4):
+                        return self._reply(200, standin.idx(cycle, fhr))
+                    return self._grib_file(cycle, fhr)
+                return self._reply(404, b'Not Found')
+
+            def _filter(self, q):
+                m = re.match(r'gfs\.t(\d\d)z\.pgrb2\.0p25\.f(\d{3})', q['file'][0])
+                d = re.match(r'/gfs\.(\d{8})/(\d\d)/atmos', q['dir'][0])
+                cycle = datetime.strptime(d.group(1) + d.group(2), '%Y%m%d%H')
+                fhr = int(m.group(2))
+                if not standin.available(cycle, fhr):
+                    # NOMADS answers with a short html error page
+                    return self._reply(200, b'<html>data file is not present</html>')
+                nlon = (float(q['rightlon'][0]) - float(q['leftlon'][0])) / 0.25 + 1
+                nlat = (float(q['toplat'][0]) - float(q['bottomlat'][0])) / 0.25 + 1
+                nvars = sum(k.startswith('var_') for k in q)
+                nlevs = sum(k.startswith('lev_') for k in q)
+                nrecords = min(len(GFS_RECORDS), nvars * max(1, nlevs) // 2 + 1)
+                data = standin._grib(GFS_RECORDS[:nrecords], int(nlon * nlat), fhr)
+                self._reply(200, data)
+
+            def _grib_file(self, cycle, fhr):
+                size = len(GFS_RECORDS) * standin._record_bytes(standin.npoints_global)
+                rng = self.headers.get('Range')
+                if rng:
+                    m = re.match(r'bytes=(\d+)-(\d*)', rng)
+                    start = int(m.group(1))
+                    end = int(m.group(2)) if m.group(2) else size - 1
+                    data = standin._grib([None], (end - start + 1 - 64) // GRIB_BYTES_PER_POINT, fhr)
+                    data = data[:end - start + 1]
+                    return self._reply(206, data, {'Content-Range': f'bytes {start}-{end}/{size}'})
+                data = standin._grib(GFS_RECORDS, standin.npoints_global, fhr)
+                self._reply(200, data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+# --------------
+# HYCOM (OPeNDAP)
+# --------------
+
+# remote dataset path -> synthetic file name, for the datasets used by download_tools.hycom
+HYCOM_DATASETS = {
+    '/FMRC_ESPC-D-V02_s3z/FMRC_ESPC-D-V02_s3z_best.ncd': ('salinity', 3, True),
+    '/FMRC_ESPC-D-V02_t3z/FMRC_ESPC-D-V02_t3z_best.ncd': ('water_temp', 3, True),
+    '/FMRC_ESPC-D-V02_ssh/FMRC_ESPC-D-V02_ssh_best.ncd': ('surf_el', 1, False),
+    '/FMRC_ESPC-D-V02_u3z/FMRC_ESPC-D-V02_u3z_best.ncd': ('water_u', 3, True),
+    '/FMRC_ESPC-D-V02_v3z/FMRC_ESPC-D-V02_v3z_best.ncd': ('water_v', 3, True),
+}
+HYCOM_DEPTHS = [0., 2., 4., 6., 8., 10., 12., 15., 20., 25., 30., 35., 40., 45., 50., 60., 70., 80., 90., 100.]
+
+def make_hycom_tree(root, run_date, domain, gofs31_month=None):
+    """
+    Write synthetic HYCOM ESPC datasets covering run_date -10/+5 days
+    (enough time steps for download_hycom's completeness check) under root,
+    using the same relative paths as the THREDDS server, and optionally a
+    GOFS 3.1 3-hourly dataset covering gofs31_month
+    """
+    from synthetic import make_hycom, hycom_times
+    start, end = run_date - timedelta(days=10), run_date + timedelta(days=5)
+    for path, (var, step, has_depth) in HYCOM_DATASETS.items():
+        fpath = os.path.join(root, path.lstrip('/'))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        make_hycom(fpath, var, hycom_times(start, end, step), domain,
+                   depths=HYCOM_DEPTHS if has_depth else None)
+    if gofs31_month is not None:
+        import xarray as xr
+        m0 = datetime(gofs31_month.year, gofs31_month.month, 1)
+        m1 = datetime(m0.year + m0.month // 12, m0.month % 12 + 1, 1) - timedelta(hours=3)
+        times = hycom_times(m0, m1, 3)
+        fpath = os.path.join(root, 'GLBy0.08', 'expt_93.0')
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        dsets = []
+        for var in ['surf_el', 'water_temp', 'salinity', 'water_u', 'water_v']:
+            tmp = fpath + f'.{var}.tmp'
+            make_hycom(tmp, var, times, domain, depths=None if var == 'surf_el' else HYCOM_DEPTHS)
+            dsets.append(xr.open_dataset(tmp, decode_times=False))
+        xr.merge(dsets).to_netcdf(fpath)
+        for ds in dsets:
+            ds.close()
+        for var in ['surf_el', 'water_temp', 'salinity', 'water_u', 'water_v']:
+            os.unlink(fpath + f'.{var}.tmp')
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def hycom_standin(root, latency=0.):
+    """
+    Serve the synthetic HYCOM tree under root over OPeNDAP (using pydap) and
+    return (base url, server). Without pydap the files are read straight from
+    disk, so the benchmark then excludes the DAP protocol overhead.
+    """
+    try:
+        from pydap.wsgi.app import DapServer
+    except ImportError:
+        print('pydap not installed: HYCOM datasets will be read from local files instead of over OPeNDAP')
+        return root, None
+
+    app = DapServer(root)
+    aliases = {k: k for k in HYCOM_DATASETS}
+    aliases['/GLBy0.08/expt_93.0'] = '/GLBy0.08/expt_93.0'
+
+    def middleware(environ, start_response):
+        # pydap picks the handler from the file extension, so map the
+        # extension-less (or .ncd) THREDDS dataset paths onto .nc files
+        path = environ['PATH_INFO']
+        for alias in aliases:
+            if path == alias or path.startswith(alias + '.'):
+                environ['PATH_INFO'] = re.sub(r'\.ncd$', '', alias) + '.nc' + path[len(alias):]
+        if latency:
+            time.sleep(latency)
+        return app(environ, start_response)
+
+    # pydap needs the .nc names on disk
+    for alias in aliases:
+        src = os.path.join(root, alias.lstrip('/'))
+        dst = re.sub(r'\.ncd$', '', src) + '.nc'
+        if os.path.exists(src) and not os.path.exists(dst):
+            os.link(src, dst)
+
+    server = make_server('127.0.0.1', 0, middleware, server_class=_ThreadingWSGIServer,
+                         handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}', server
+
+# --------------
+# CMEMS and CDS
+# --------------
+
+def stub_env(latency=0., bandwidth=None):
+    """
+    Environment variables putting the stub copernicusmarine executable and the
+    stub cdsapi module first on the PATH and PYTHONPATH
+    """
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(HERE, 'stubs', 'bin') + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.join(HERE, 'stubs', 'python'), HERE] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['SOMISANA_STUB_LATENCY'] = str(latency)
+    if bandwidth:
+        env['SOMISANA_STUB_BANDWIDTH'] = str(bandwidth)
+    return env
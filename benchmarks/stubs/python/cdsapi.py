@@ -0,0 +1,35 @@
+"""
+Stub of the cdsapi client, for offline benchmarks. Client().retrieve(...).download(output)
+writes a synthetic ERA5 file for the requested variable, month and area after an
+optional delay (SOMISANA_STUB_LATENCY seconds)
+"""
+import os
+import time
+from synthetic import make_era5
+
+# CDS variable names -> the short names used in the files
+SHORT_NAMES = {
+    'land_sea_mask': 'lsm', 'sea_surface_temperature': 'sst', 'total_precipitation': 'tp',
+    'surface_thermal_radiation_downwards': 'strd', 'surface_net_solar_radiation': 'ssr',
+    '2m_temperature': 't2m', 'specific_humidity': 'q', '10m_u_component_of_wind': 'u10',
+    '10m_v_component_of_wind': 'v10', 'mean_sea_level_pressure': 'msl',
+}
+
+class Result:
+    def __init__(self, options):
+        self.options = options
+
+    def download(self, output):
+        o = self.options
+        vname = SHORT_NAMES[o['variable'][0]]
+        make_era5(output, vname, int(o['year'][0]), int(o['month'][0]), o['area'],
+                  hourly=len(o.get('time', [])) > 1)
+        return output
+
+class Client:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def retrieve(self, product, options):
+        time.sleep(float(os.environ.get('SOMISANA_STUB_LATENCY', 0)))
+        return Result(options)
@@ -0,0 +1,96 @@
+"""
+Synthetic datasets with the same shape and metadata as the real sources,
+used by the local stand-in servers and stub clients in this directory
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import xarray as xr
+
+# hours since this origin is what the HYCOM THREDDS server uses
+HYCOM_TIME_ORIGIN = datetime(2000, 1, 1)
+
+def _grid(domain, res, pad=1.):
+    lon = np.arange(domain[0] - pad, domain[1] + pad + res / 2, res)
+    lat = np.arange(domain[2] - pad, domain[3] + pad + res / 2, res)
+    return lon, lat
+
+def _field(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal(shape).astype('float32')
+
+def make_hycom(path, var, times, domain, depths=None, res=0.08):
+    """
+    A HYCOM-shaped dataset: time as float hours with units/calendar attributes
+    (the THREDDS server doesn't decode them), lat/lon and optionally depth
+    """
+    lon, lat = _grid(domain, res)
+    hours = np.array([(t - HYCOM_TIME_ORIGIN).total_seconds() / 3600. for t in times])
+    coords = {
+        'time': ('time', hours, {'units': 'hours since 2000-01-01 00:00:00', 'calendar': 'gregorian'}),
+        'lat': ('lat', lat),
+        'lon': ('lon', lon),
+    }
+    if depths is None:
+        dims = ('time', 'lat', 'lon')
+    else:
+        coords['depth'] = ('depth', np.asarray(depths, dtype='float64'))
+        dims = ('time', 'depth', 'lat', 'lon')
+    shape = tuple(len(coords[d][1]) for d in dims)
+    ds = xr.Dataset({var: (dims, _field(shape) + 15.)}, coords=coords)
+    # also include some of the auxiliary variables the downloaders drop
+    ds['tau'] = ('time', hours)
+    ds.to_netcdf(path, encoding={'time': {'dtype': 'float64'}})
+
+def hycom_times(start, end, step_hours):
+    n = int((end - start).total_seconds() // (3600 * step_hours)) + 1
+    return [start + timedelta(hours=step_hours * i) for i in range(n)]
+
+def make_cmems(path, varlist, start_date, end_date, domain, depths, res=1/12.):
+    """
+    A daily CMEMS/Mercator-shaped subset, as written by `copernicusmarine subset`
+    """
+    lon, lat = _grid(domain, res, pad=0.)
+    times = []
+    t = datetime(start_date.year, start_date.month, start_date.day, 12)
+    while t <= end_date:
+        times.append(t)
+        t += timedelta(days=1)
+    levels = np.array([0.494, 1.541, 2.646, 3.819, 5.078, 6.441, 7.930, 9.573, 11.405, 13.467,
+                       15.810, 18.496, 21.599, 25.211, 29.445, 34.434, 40.344, 47.374, 55.764, 65.807])
+    depth = levels[(levels >= depths[0]) & (levels <= depths[1])]
+    data = {}
+    for i, v in enumerate(varlist):
+        if v == 'zos':
+            data[v] = (('time', 'latitude', 'longitude'), _field((len(times), len(lat), len(lon)), i))
+        else:
+            data[v] = (('time', 'depth', 'latitude', 'longitude'),
+                       _field((len(times), len(depth), len(lat), len(lon)), i))
+    ds = xr.Dataset(data, coords={'time': times, 'depth': depth, 'latitude': lat, 'longitude': lon})
+    ds.to_netcdf(path)
+
+def make_era5(path, vname, year, month, area, hourly=True, res=0.25):
+    """
+    An ERA5 monthly file as downloaded from the CDS (latitudes decreasing,
+    valid_time in seconds since 1970)
+    """
+    north, west, south, east = [float(a) for a in area]
+    lat = np.arange(north, south - res / 2, -res)
+    lon = np.arange(west, east + res / 2, res)
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    step = timedelta(hours=1) if hourly else timedelta(days=1)
+    times = []
+    t = start
+    while t < end:
+        times.append((t - datetime(1970, 1, 1)).total_seconds())
+        t += step
+    field = _field((len(times), len(lat), len(lon)))
+    ds = xr.Dataset(
+        {vname: (('valid_time', 'latitude', 'longitude'), field)},
+        coords={
+            'valid_time': ('valid_time', np.array(times, dtype='int64'),
+                           {'units': 'seconds since 1970-01-01', 'calendar': 'proleptic_gregorian'}),
+            'latitude': lat,
+            'longitude': lon,
+        })
+    ds.to_netcdf(path, encoding={vname: {'_FillValue': -32767.}})
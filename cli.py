@@ -8,11 +8,46 @@ The only functions I'm adding here are ones which produce an output e.g. a netcd
 Feel free to add more functions from the repo as we need them in the cli
 '''
 import argparse
+import importlib
+import json
 import sys, os
 from datetime import datetime, timedelta
-from download_tools.cmems import download_cmems, download_cmems_monthly, download_mercator_ops
-from download_tools.gfs import download_gfs_atm
-from download_tools.hycom import download_hycom_ops, download_hycom_gofs31
+from download_tools import hedging, memory, metrics, profiling, transport
+
+class lazy:
+    """
+    Stand-in for a function which is only imported from its module when it is first called.
+    This keeps the heavy dependencies (xarray, pandas, dask etc.) out of the startup
+    of the cli, so each invocation only pays for the imports of the function it runs
+    """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def resolve(self):
+        return getattr(importlib.import_module(self.module), self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+# registry of the functions run by the cli
+download_cmems = lazy('download_tools.cmems', 'download_cmems')
+download_cmems_monthly = lazy('download_tools.cmems', 'download_cmems_monthly')
+download_mercator_ops = lazy('download_tools.cmems', 'download_mercator_ops')
+download_gfs_atm = lazy('download_tools.gfs', 'download_gfs_atm')
+download_hycom_ops = lazy('download_tools.hycom', 'download_hycom_ops')
+download_hycom_gofs31 = lazy('download_tools.hycom', 'download_hycom_gofs31')
+download_ops = lazy('download_tools.ops', 'download_ops')
+build_archive_index = lazy('download_tools.archive_index', 'build_archive_index')
+download_cmems_split = lazy('download_tools.cmems', 'download_cmems_split')
+planner = {name: lazy('download_tools.planner', name) for name in
+           ('plan_cmems', 'plan_cmems_monthly', 'plan_mercator_ops', 'plan_gfs_atm', 'plan_hycom_ops',
+            'plan_hycom_gofs31', 'plan_ops')}
+serve = lazy('download_tools.server', 'serve')
+server_request = lazy('download_tools.server', 'request')
+backfill = {name: lazy('download_tools.backfill', name) for name in
+            ('Queue', 'expand_cli', 'expand_era5', 'work', 'print_summary')}
+domains = {name: lazy('download_tools.domains', name) for name in ('download_domains', 'plan_domains')}
 
 # functions to help parsing string input to object types needed by python functions
 def parse_datetime(value):
@@ -44,9 +79,64 @@ def parse_bool(s: str) -> bool:
     except KeyError:
         raise argparse.ArgumentTypeError(f'expect true/false, got: {s}')
 
-def main():
+def with_domains(subparser):
+    """
+    Add --domains to a subcommand, which then downloads several named domains in
+    one pass and fans the data out to a directory per domain (see domains.py)
+    """
+    subparser.add_argument('--domains', type=parse_list_str, default=None,
+                        help='comma separated list of named domains to download in one pass instead of --domain, '
+                             'each written to its own subdirectory of outputDir')
+    subparser.add_argument('--domains_file', default=None,
+                        help='JSON file of the named domains (default SOMISANA_DOMAINS or ~/.config/somisana/domains.json)')
+    func, plan = subparser.get_default('func'), subparser.get_default('plan')
+    subparser.set_defaults(
+        func=lambda args: domains['download_domains'](func, args) if args.domains else func(args),
+        plan=lambda args: domains['plan_domains'](plan, args) if args.domains else plan(args))
+
+def warmup():
+    """
+    Import all the functions of the registry up front (for the daemon, see serve)
+    """
+    for f in [v for v in globals().values() if isinstance(v, lazy)] + list(planner.values()) + list(domains.values()):
+        try:
+            f.resolve()
+        except ImportError as e:
+            print(f'[serve] could not import {f.module}.{f.name}: {e}')
+
+def build_parser():
     
     parser = argparse.ArgumentParser(description='Command-line interface for selected functions in the somisana-download repo')
+    # global options, which go before the function name
+    parser.add_argument('--metrics_json', default=None,
+                        help='write a JSON report of the per-file download metrics to this path')
+    parser.add_argument('--metrics_prom', default=None,
+                        help='write the download metrics as a Prometheus node-exporter textfile (*.prom) to this path')
+    parser.add_argument('--profile', default=None,
+                        help='write a timeline of every phase of the run, per process and thread, as a Chrome trace '
+                             '(JSON, open it in https://ui.perfetto.dev) to this path')
+    parser.add_argument('--profile_pstats', default=None,
+                        help='with --profile, also write a cProfile of the run (pstats) to this path')
+    parser.add_argument('--memory_budget', '--memory-budget', type=memory.parse_size, default=None,
+                        help='memory the run may use e.g. 4G, which sets the chunk sizes of the downloads and merges '
+                             '(see download_tools/memory.py); the peak memory per stage goes into the metrics')
+    parser.add_argument('--hedge', action='store_true',
+                        help='send a duplicate of a request which is slower than the 95th percentile of recent '
+                             'ones, keeping whichever finishes first (at most 5%% of the requests, see hedging.py)')
+    parser.add_argument('--record', default=None, metavar='CASSETTE',
+                        help='record the requests of the run and their responses, with their timings, to this '
+                             'directory (see download_tools/transport.py)')
+    parser.add_argument('--replay', default=None, metavar='CASSETTE',
+                        help='replay the requests of the run from a directory written by --record, without the network')
+    parser.add_argument('--replay_latency', type=float, default=None,
+                        help='with --replay, seconds before every response instead of the recorded latency')
+    parser.add_argument('--replay_bandwidth', type=memory.parse_size, default=None,
+                        help='with --replay, bytes per second of the link shared by all the transfers e.g. 10M, '
+                             'instead of the recorded rates')
+    parser.add_argument('--replay_errors', type=float, default=0.,
+                        help='with --replay, fraction of the requests which fail e.g. 0.05, to exercise the retries')
+    parser.add_argument('--replay_seed', type=int, default=0,
+                        help='with --replay, seed of the failures of --replay_errors')
     subparsers = parser.add_subparsers(dest='function', help='Select the function to run')
 
     # just keep adding new subparsers for each new function as we go...
@@ -73,9 +163,16 @@ def main():
                         default=[0.493, 5727.918],
                         help='comma separated list of depth extent to download (positive down). For all depths use "0.493,5727.918"')
     parser_download_cmems_monthly.add_argument('--outputDir', required=True, help='Directory to save files')
+    parser_download_cmems_monthly.add_argument('--output_format', choices=['nc', 'zarr'], default='nc',
+                        help='nc = monthly YYYY_MM.nc files (default), zarr = append to a single zarr store')
+    parser_download_cmems_monthly.add_argument('--tile_cache', default=None,
+                        help='directory of a tile cache shared between overlapping domains (default: no cache)')
     def download_cmems_monthly_handler(args):
-        download_cmems_monthly(args.usrname, args.passwd, args.dataset, args.domain, args.start_date,args.end_date,args.varList, args.depths, args.outputDir)
-    parser_download_cmems_monthly.set_defaults(func=download_cmems_monthly_handler)
+        download_cmems_monthly(args.usrname, args.passwd, args.dataset, args.domain, args.start_date,args.end_date,args.varList, args.depths, args.outputDir, args.output_format, args.tile_cache)
+    parser_download_cmems_monthly.set_defaults(func=download_cmems_monthly_handler,
+        plan=lambda args: planner['plan_cmems_monthly'](args.dataset, args.domain, args.start_date, args.end_date,
+                                                        args.varList, args.depths))
+    with_domains(parser_download_cmems_monthly)
 
     # ----------------------
     # download_cmems_ops
@@ -103,14 +200,20 @@ def main():
                         help='forecast days i.e before run_date')
     parser_download_cmems_ops.add_argument('--outputDir', required=True, help='Directory to save file') 
     parser_download_cmems_ops.add_argument('--outputFile', required=True, help='Output file name') 
-    def download_cmems_ops_handler(args):
+    def cmems_ops_dates(args):
         # extend the download range by a day either side so we are guarenteed to cover the required model run time
         hdays = args.hdays + 1
         fdays = args.fdays + 1
         start_date = args.run_date + timedelta(days=-hdays)
         end_date = args.run_date + timedelta(days=fdays)
-        download_cmems(args.usrname, args.passwd, args.dataset, args.varList, start_date, end_date, args.domain, args.depths, args.outputDir, args.outputFile)
-    parser_download_cmems_ops.set_defaults(func=download_cmems_ops_handler)
+        return start_date, end_date
+    def download_cmems_ops_handler(args):
+        start_date, end_date = cmems_ops_dates(args)
+        download_cmems_split(args.usrname, args.passwd, args.dataset, args.varList, start_date, end_date, args.domain, args.depths, args.outputDir, args.outputFile)
+    parser_download_cmems_ops.set_defaults(func=download_cmems_ops_handler,
+        plan=lambda args: planner['plan_cmems'](args.dataset, args.varList, *cmems_ops_dates(args),
+                                                args.domain, args.depths))
+    with_domains(parser_download_cmems_ops)
 
     # ----------------------
     # download_mercator_ops
@@ -131,9 +234,15 @@ def main():
                         default=5.,
                         help='forecast days i.e before run_date')
     parser_download_mercator_ops.add_argument('--outputDir', required=True, help='Directory to save files') 
+    parser_download_mercator_ops.add_argument('--output_format', choices=['nc', 'zarr'], default='nc',
+                        help='nc = a file per run (default), zarr = add the run to a single zarr store')
+    parser_download_mercator_ops.add_argument('--tile_cache', default=None,
+                        help='directory of a tile cache shared between overlapping domains (default: no cache)')
     def download_mercator_ops_handler(args):
-        download_mercator_ops(args.usrname, args.passwd, args.domain, args.run_date,args.hdays, args.fdays,args.outputDir)
-    parser_download_mercator_ops.set_defaults(func=download_mercator_ops_handler)
+        download_mercator_ops(args.usrname, args.passwd, args.domain, args.run_date,args.hdays, args.fdays,args.outputDir, args.output_format, args.tile_cache)
+    parser_download_mercator_ops.set_defaults(func=download_mercator_ops_handler,
+        plan=lambda args: planner['plan_mercator_ops'](args.domain, args.run_date, args.hdays, args.fdays))
+    with_domains(parser_download_mercator_ops)
     
     # ------------------
     # download_gfs_atm
@@ -152,9 +261,16 @@ def main():
                         default=5.,
                         help='forecast days i.e before run_date')
     parser_download_gfs_atm.add_argument('--outputDir', required=True, help='Directory to save files')
+    parser_download_gfs_atm.add_argument('--progressive', type=parse_bool, default=False,
+                        help='use the newest cycle that has started publishing and download forecast hours as they come out')
+    parser_download_gfs_atm.add_argument('--deadline', type=float, default=120.,
+                        help='progressive mode: minutes to wait for forecast hours before taking them from the previous cycle')
     def download_gfs_atm_handler(args):
-        download_gfs_atm(args.domain, args.run_date, args.hdays, args.fdays, args.outputDir)
-    parser_download_gfs_atm.set_defaults(func=download_gfs_atm_handler) 
+        download_gfs_atm(args.domain, args.run_date, args.hdays, args.fdays, args.outputDir,
+                         args.progressive, datetime.now() + timedelta(minutes=args.deadline))
+    parser_download_gfs_atm.set_defaults(func=download_gfs_atm_handler,
+        plan=lambda args: planner['plan_gfs_atm'](args.domain, args.run_date, args.hdays, args.fdays)) 
+    with_domains(parser_download_gfs_atm)
     
     # -------------------
     # download_hycom_ops
@@ -177,9 +293,20 @@ def main():
     parser_download_hycom_ops.add_argument('--parallel',required=False, type=parse_bool,
                                        default=True,
                                        help='Download routine used: False = serial download, True = parallel download.')
+    parser_download_hycom_ops.add_argument('--output_format', choices=['nc', 'zarr'], default='nc',
+                        help='nc = a file per run (default), zarr = add the run to a single zarr store')
+    parser_download_hycom_ops.add_argument('--tile_cache', default=None,
+                        help='directory of a tile cache shared between overlapping domains (default: no cache)')
+    parser_download_hycom_ops.add_argument('--reuse', type=parse_bool, default=False,
+                        help='reuse the analysis days of the previous ops run in outputDir, only downloading the new days and the forecast')
+    parser_download_hycom_ops.add_argument('--reuse_dir', default=None,
+                        help='another directory to look for previous ops runs in')
     def download_hycom_ops_handler(args):
-        download_hycom_ops(args.domain, args.run_date, args.hdays, args.fdays, args.outputDir, args.parallel)
-    parser_download_hycom_ops.set_defaults(func=download_hycom_ops_handler)
+        download_hycom_ops(args.domain, args.run_date, args.hdays, args.fdays, args.outputDir, args.parallel, args.output_format, args.tile_cache,
+                           args.reuse, args.reuse_dir)
+    parser_download_hycom_ops.set_defaults(func=download_hycom_ops_handler,
+        plan=lambda args: planner['plan_hycom_ops'](args.domain, args.run_date, args.hdays, args.fdays))
+    with_domains(parser_download_hycom_ops)
     
     # -------------------------
     # download_hycom_gofs31
@@ -203,14 +330,213 @@ def main():
     parser_download_hycom_gofs31.add_argument('--surface', type=parse_bool,
                         default=False,
                         help='true = hourly surface data, false = 3-hourly 3D data (default)')
+    parser_download_hycom_gofs31.add_argument('--output_format', choices=['nc', 'zarr'], default='nc',
+                        help='nc = monthly YYYY_MM.nc files (default), zarr = append to a single zarr store')
     def download_hycom_gofs31_handler(args):
         download_hycom_gofs31(args.domain, args.start_date, args.end_date, args.outputDir,
-                              args.var_list, args.depths, args.surface)
-    parser_download_hycom_gofs31.set_defaults(func=download_hycom_gofs31_handler)
+                              args.var_list, args.depths, args.surface, args.output_format)
+    parser_download_hycom_gofs31.set_defaults(func=download_hycom_gofs31_handler,
+        plan=lambda args: planner['plan_hycom_gofs31'](args.domain, args.start_date, args.end_date, args.var_list,
+                                                       args.depths, args.surface))
+    with_domains(parser_download_hycom_gofs31)
+
+    # -------------------
+    # download_ops
+    # -------------------
+    parser_download_ops = subparsers.add_parser('download_ops',
+            help='Download the GFS, HYCOM and Mercator forcing for an operational run concurrently in one process')
+    parser_download_ops.add_argument('--domain', type=parse_list,
+                        default=[10, 25, -40, -25],
+                        help='comma separated list of domain extent to download i.e. "lon0,lon1,lat0,lat1"')
+    parser_download_ops.add_argument('--run_date', required=True, type=parse_datetime,
+                        help='start time in format "YYYY-MM-DD HH:MM:SS"')
+    parser_download_ops.add_argument('--hdays', type=float,
+                        default=5.,
+                        help='hindcast days i.e before run_date')
+    parser_download_ops.add_argument('--fdays', type=float,
+                        default=5.,
+                        help='forecast days i.e after run_date')
+    parser_download_ops.add_argument('--sources', type=parse_list_str,
+                        default=['gfs', 'hycom', 'mercator'],
+                        help='comma separated list of sources to download e.g. "gfs,hycom,mercator"')
+    parser_download_ops.add_argument('--usrname', type=str, default=None, help='Copernicus username (for mercator)')
+    parser_download_ops.add_argument('--passwd', default=None, help='Copernicus password (for mercator)')
+    parser_download_ops.add_argument('--outputDir', required=True,
+                        help='Directory to save files (each source goes in its own subdirectory)')
+    parser_download_ops.add_argument('--max_workers', type=parse_int, default=10,
+                        help='maximum number of concurrent download tasks across all sources')
+    parser_download_ops.add_argument('--bandwidth', type=float, default=None,
+                        help='global bandwidth budget in MB/s (default unlimited)')
+    parser_download_ops.add_argument('--output_format', choices=['nc', 'zarr'], default='nc',
+                        help='format of the merged hycom and mercator output: nc (default) or zarr')
+    parser_download_ops.add_argument('--tile_cache', default=None,
+                        help='directory of a tile cache shared between overlapping domains (default: no cache)')
+    parser_download_ops.add_argument('--gfs_progressive', type=parse_bool, default=False,
+                        help='download the GFS forecast hours of the newest cycle as they are published')
+    parser_download_ops.add_argument('--gfs_deadline', type=float, default=120.,
+                        help='progressive GFS: minutes to wait for forecast hours before using the previous cycle')
+    parser_download_ops.add_argument('--hycom_reuse', type=parse_bool, default=False,
+                        help='reuse the analysis days of the previous hycom ops run')
+    parser_download_ops.add_argument('--hycom_reuse_dir', default=None,
+                        help='directory of previous hycom ops runs (default the hycom subdirectory of outputDir)')
+    def download_ops_handler(args):
+        bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+        download_ops(args.domain, args.run_date, args.hdays, args.fdays, args.outputDir, args.sources,
+                     args.usrname, args.passwd, args.max_workers, bandwidth, args.output_format,
+                     args.tile_cache, args.gfs_progressive, datetime.now() + timedelta(minutes=args.gfs_deadline),
+                     args.hycom_reuse, args.hycom_reuse_dir)
+    parser_download_ops.set_defaults(func=download_ops_handler,
+        plan=lambda args: planner['plan_ops'](args.domain, args.run_date, args.hdays, args.fdays, args.sources))
+    with_domains(parser_download_ops)
+
+    # -------------------
+    # build_archive_index
+    # -------------------
+    parser_build_archive_index = subparsers.add_parser('build_archive_index',
+            help='Build or update the virtual index over the monthly files of an archive, so that it opens as a single dataset')
+    parser_build_archive_index.add_argument('--archiveDir', required=True,
+                        help='Directory of the monthly files (e.g. the outputDir of download_cmems_monthly)')
+    parser_build_archive_index.add_argument('--pattern', default='[0-9][0-9][0-9][0-9]_[0-9][0-9].nc',
+                        help='glob pattern of the files to index (default YYYY_MM.nc)')
+    def build_archive_index_handler(args):
+        build_archive_index(args.archiveDir, args.pattern)
+    parser_build_archive_index.set_defaults(func=build_archive_index_handler)
 
+    # every download can be planned without downloading anything (see planner.py)
+    for subparser in subparsers.choices.values():
+        if subparser.get_default('plan') is not None:
+            subparser.add_argument('--dry_run', '--dry-run', action='store_true',
+                                   help='print the planned requests, total volume and estimated time, without downloading')
+
+    # -----
+    # serve
+    # -----
+    default_socket = os.environ.get('SOMISANA_SOCKET', '/tmp/somisana-download.sock')
+    parser_serve = subparsers.add_parser('serve',
+            help='Run as a daemon accepting download jobs (the arguments of any download function of this cli) '
+                 'on a Unix socket and/or a spool directory, keeping imports, connections and sessions warm')
+    parser_serve.add_argument('--socket', default=default_socket, help='path of the Unix socket')
+    parser_serve.add_argument('--spool', default=None,
+                        help='spool directory: jobs are JSON files {"argv": [...]} dropped in <spool>/incoming')
+    parser_serve.add_argument('--workers', type=int, default=4, help='number of jobs running at once')
+    def serve_handler(args):
+        serve(build_parser(), args.socket, args.spool, args.workers, warmup)
+    parser_serve.set_defaults(func=serve_handler)
+
+    # ------
+    # submit
+    # ------
+    parser_submit = subparsers.add_parser('submit',
+            help='Submit a download job to the daemon (see serve) e.g. cli.py submit --wait download_gfs_atm --domain ...')
+    parser_submit.add_argument('--socket', default=default_socket, help='path of the Unix socket of the daemon')
+    parser_submit.add_argument('--wait', action='store_true', help='wait for the job to finish')
+    parser_submit.add_argument('job', nargs=argparse.REMAINDER, help='the function to run and its arguments')
+    def submit_handler(args):
+        job = server_request(args.socket, {'op': 'submit', 'argv': args.job, 'wait': args.wait})
+        print(json.dumps(job, indent=1))
+        if args.wait and job['status'] != 'ok':
+            sys.exit(1)
+    parser_submit.set_defaults(func=submit_handler)
+
+    # ----
+    # jobs
+    # ----
+    parser_jobs = subparsers.add_parser('jobs', help='Status of the jobs of the daemon (see serve)')
+    parser_jobs.add_argument('--socket', default=default_socket, help='path of the Unix socket of the daemon')
+    parser_jobs.add_argument('--id', default=None, help='a single job (default all of them)')
+    def jobs_handler(args):
+        print(json.dumps(server_request(args.socket, {'op': 'status', 'id': args.id}), indent=1))
+    parser_jobs.set_defaults(func=jobs_handler)
+
+    # --------
+    # backfill
+    # --------
+    default_queue = os.environ.get('SOMISANA_BACKFILL_QUEUE', 'backfill_queue.sqlite')
+    parser_backfill = subparsers.add_parser('backfill',
+            help='Queue of long backfills, run month by month by resumable workers (see download_tools/backfill.py)')
+    parser_backfill.add_argument('--queue', default=default_queue, help='path of the queue (SQLite)')
+    backfill_actions = parser_backfill.add_subparsers(dest='action', help='Select the action')
+    backfill_add = backfill_actions.add_parser('add',
+            help='Queue a download_cmems_monthly or download_hycom_gofs31 command, split into months '
+                 'e.g. cli.py backfill add --priority 10 download_hycom_gofs31 --domain ...')
+    backfill_add.add_argument('--priority', type=int, default=0, help='requests with a higher priority run first')
+    backfill_add.add_argument('job', nargs=argparse.REMAINDER, help='the function to run and its arguments')
+    backfill_era5 = backfill_actions.add_parser('era5',
+            help='Queue the ERA5 requests and conversions set up by an era5_crocotools_param.py file, split into months')
+    backfill_era5.add_argument('--params', required=True, help='the era5_crocotools_param.py file')
+    backfill_era5.add_argument('--priority', type=int, default=0, help='requests with a higher priority run first')
+    backfill_era5.add_argument('--no_request', action='store_true', help='only convert (the raw files are there already)')
+    backfill_era5.add_argument('--no_convert', action='store_true', help='only download the raw files')
+    backfill_work = backfill_actions.add_parser('work',
+            help='Run the queued tasks (on any number of nodes, with the queue and outputs on a shared filesystem)')
+    backfill_work.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    backfill_work.add_argument('--forever', action='store_true',
+                               help='keep waiting for new requests rather than stopping when the queue is done')
+    backfill_actions.add_parser('status', help='Progress of the queued requests')
+    for action in ('pause', 'resume', 'retry', 'priority'):
+        p = backfill_actions.add_parser(action, help={
+            'pause': 'Stop starting new months of a request (the running ones finish)',
+            'resume': 'Resume a paused request',
+            'retry': 'Queue the failed months of a request again',
+            'priority': 'Change the priority of a request'}[action])
+        p.add_argument('--request', type=int, required=True, help='id of the request (see status)')
+        if action == 'priority':
+            p.add_argument('--priority', type=int, required=True, help='the new priority')
+    def backfill_handler(args):
+        if args.action == 'add':
+            queue = backfill['Queue'](args.queue)
+            request_id = queue.add(' '.join(args.job), backfill['expand_cli'](build_parser(), args.job), args.priority)
+            print(f'queued request {request_id}')
+        elif args.action == 'era5':
+            tasks = backfill['expand_era5'](args.params, not args.no_request, not args.no_convert)
+            queue = backfill['Queue'](args.queue)
+            request_id = queue.add(f'era5 {os.path.abspath(args.params)}', tasks, args.priority)
+            print(f'queued request {request_id}')
+        elif args.action == 'work':
+            backfill['work'](build_parser, args.queue, args.workers, args.forever)
+        elif args.action == 'status':
+            backfill['print_summary'](args.queue)
+        elif args.action in ('pause', 'resume'):
+            backfill['Queue'](args.queue).set_request(args.request, status='paused' if args.action == 'pause' else 'active')
+        elif args.action == 'retry':
+            backfill['Queue'](args.queue).retry_failed(args.request)
+        elif args.action == 'priority':
+            backfill['Queue'](args.queue).set_request(args.request, priority=args.priority)
+        else:
+            parser_backfill.print_help()
+    parser_backfill.set_defaults(func=backfill_handler)
+
+    return parser
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
-    if hasattr(args, 'func'):
-        args.func(args)
+    if args.record and args.replay:
+        parser.error('--record and --replay are exclusive')
+    if getattr(args, 'dry_run', False):
+        args.plan(args).print()
+    elif hasattr(args, 'func'):
+        status = 'failed'
+        if args.profile:
+            profiling.start(args.profile, args.profile_pstats)
+        if args.memory_budget:
+            memory.set_budget(args.memory_budget)
+        if args.hedge:
+            hedging.ENABLED = True
+            os.environ['SOMISANA_HEDGE'] = '1'   # for worker processes
+        if args.record or args.replay:
+            transport.start('record' if args.record else 'replay', args.record or args.replay,
+                            args.replay_latency, args.replay_bandwidth, args.replay_errors, args.replay_seed)
+        try:
+            with profiling.span(args.function, 'cli'):
+                args.func(args)
+            status = 'ok'
+        finally:
+            profiling.stop()
+            if args.metrics_json:
+                metrics.write_json(args.metrics_json, command=args.function, status=status)
+            if args.metrics_prom:
+                metrics.write_prometheus(args.metrics_prom, command=args.function, status=status)
     else:
         print("Please specify a function.")
 
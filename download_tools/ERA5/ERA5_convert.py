@@ -6,176 +6,236 @@
 # Store (CDS) of Copernicus https://cds.climate.copernicus.eu into
 # a format and using units which can be used by the online interpolation of CROCO
 #
+# Each (month, variable) pair is independent, so the pairs are converted on a
+# pool of n_workers processes. A manifest of the input fingerprints is kept in
+# the processed directory so that pairs whose input hasn't changed since the
+# last run are skipped
+#
+# The data variables are written with the compression, chunking and
+# quantization of the shared output encoding policy (download_tools/encoding.py)
+#
+# With a memory budget (SOMISANA_MEMORY_BUDGET, see download_tools/memory.py)
+# the number of time records converted at a time comes from the budget, shared
+# between the workers, rather than from nt_block
+#
 #
 # -------------------------------------------------
 # Getting libraries and utilities
 # -------------------------------------------------
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import date
 import json
 from netCDF4 import Dataset as netcdf
 import numpy as np
 import os
+import sys
 from ERA5_utilities import *
 
+# the encoding policy is shared with the downloaders, at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from download_tools import memory
+from download_tools.encoding import netcdf4_options
+
 # -------------------------------------------------
 # Import my crocotools_param_python file
 from era5_crocotools_param import *
 # -------------------------------------------------
 
-# -------------------------------------------------
-# Setting processed output directory
-# -------------------------------------------------
-# Get the current directory
-os.makedirs(era5_dir_processed,exist_ok=True)
-
-# -------------------------------------------------
-# Loading ERA5 variables's information as 
-# python Dictionary from JSON file
-# -------------------------------------------------
-
-with open('ERA5_variables.json', 'r') as jf:
-    era5 = json.load(jf)
-
-#
-# -------------------------------------------------
-# Loop on Years and Months
-# -------------------------------------------------
-# 
-
-# Monthly dates limits
-monthly_date_start = datetime.datetime(year_start,month_start,1)
-monthly_date_end = datetime.datetime(year_end,month_end,1)
-
-# Length of monthly dates loop
-len_monthly_dates = (monthly_date_end.year - monthly_date_start.year) * 12 + \
-                    (monthly_date_end.month - monthly_date_start.month) + 1
-
-# Initial monthly date
-monthly_date = monthly_date_start
-
-for j in range(len_monthly_dates):
-
-    # Year and month
-    iyear = monthly_date.year;
-    imonth = monthly_date.month;      
-
-#
-# -------------------------------------------------
-# Loop on variables names
-# -------------------------------------------------
-# 
-
-    for k in range(len(variables)):
+def convert_file(fname_in, fname_out, vname, vlong, cff, unit, Yorig, nt_block):
+    '''
+    Convert a single monthly ERA5 file for one variable into the CROCO format
+    '''
 
 #
-# Variable's name, long-name and level-type
+# Read input file
 #
-        vname = variables[k]
-        vlong = era5[vname][0]
 
-        print('  Processing variable: '+vname)
+    nc = netcdf(fname_in,'r',format='NETCDF4')
+    time = nc.variables['valid_time'][:]
+    lat = nc.variables['latitude'][:]
+    lon = nc.variables['longitude'][:]
+    var_in = nc.variables[vname]
+    nt = var_in.shape[0]
 
 #
-# Read input filedate.toordinal(date(Yorig,1,1))
+# Flip latitudes (to have increasing latitudes...)
+# the data itself gets flipped block by block when it is written below
 #
 
-        fname_in = era5_dir_raw + '/ERA5_ecmwf_' + vname.upper() + '_Y' + str(iyear) + 'M' + str(imonth).zfill(2) + '.nc'
-        nc = netcdf(fname_in,'r+',format='NETCDF4')
-        time = nc.variables['valid_time'][:]
-        lat = nc.variables['latitude'][:]
-        lon = nc.variables['longitude'][:]
-        data = nc.variables[vname][:].squeeze()
-        nc.close()
+    lat = np.flip(lat, axis=0)
 
 #
-# Flip latitudes (to have increasing latitudes...)
+# Convert time from seconds since 1970-1-1 0:0:0 into days since Yorig-1-1 0:0:0
 #
 
-        lat = np.flip(lat, axis=0)
-        data = np.flip(data, axis=1)
+    time = time / 24. / 3600.
+    time = time - date.toordinal(date(Yorig,1,1)) \
+            + date.toordinal(date(1970,1,1))
 
 #
-# Missing values and multiply by cff to change unit
+# Create and write output netcdf file
 #
 
-        try:
-            mvalue=data.fill_value
-        except AttributeError:
-            print ('No fill value.. use nan')
-            mvalue=np.nan
+    vname_upper = get_vname_upper(vname)
+
+    nw = netcdf(fname_out,mode='w',format='NETCDF4')
+
+    dimlon  = nw.createDimension('lon',  len(lon))
+    dimlat  = nw.createDimension('lat',  len(lat))
+    dimtime = nw.createDimension('time', None)
+
+    varlon = nw.createVariable('lon', 'f4',('lon',))
+    varlat = nw.createVariable('lat', 'f4',('lat',))
+    vartime = nw.createVariable('time', 'f4',('time',))
+    # chunk one time record at a time, as that's how CROCO reads the forcing
+    vardata = nw.createVariable(vname_upper, 'f4',('time','lat','lon'),
+                                **netcdf4_options(vname_upper, ('time','lat','lon'),
+                                                  (nt,len(lat),len(lon)), 'f4'))
+    varlon.long_name = 'longitude of RHO-points'
+    varlat.long_name = 'latitude of RHO-points'
+    vartime.long_name = 'Time'
+    varlon.units = 'degree_east'
+    varlat.units = 'degree_north'
+    vartime.units = 'days since '+str(Yorig)+'-1-1'
+    vardata.missing_value = 9999.
+    vardata.units = unit
+    vardata.long_name = vlong
+
+    varlon[:]=lon
+    varlat[:]=lat
+    vartime[:]=time
+
+#
+# Stream the data through in blocks of nt_block time records, so memory use
+# is set by the block size and not by the length of the month.
+# A block is held about 4 times over (read, scaled, flipped and filled) in f4.
+# Each block is flipped, multiplied by cff to change unit and has its missing
+# values (the masked points from netCDF4) filled with 9999. in one go
+#
+
+    nt_block = memory.steps_per_chunk(len(lat) * len(lon) * 4, copies=4) or nt_block
+    for t0 in range(0, nt, nt_block):
+        t1 = min(t0 + nt_block, nt)
+        # drop any singleton dimensions other than time (e.g. pressure_level)
+        block = var_in[t0:t1].reshape(t1 - t0, len(lat), len(lon))
+        vardata[t0:t1] = np.ma.filled(cff * block[:, ::-1, :], 9999.)
+
+    nw.close()
+    nc.close()
+
+def convert_task(task):
+    '''
+    Process pool entry point: convert one (month, variable) pair and return
+    the fingerprint of its input so it can be stored in the manifest
+    '''
+    convert_file(task['fname_in'], task['fname_out'], task['vname'], task['vlong'],
+                 task['cff'], task['unit'], task['Yorig'], task['nt_block'])
+    return file_fingerprint(task['fname_in'])
+
+if __name__ == '__main__':
 
-        data=np.array(data)
-        data=conv_cff[k]*data
-        data[np.where(data==mvalue)]=9999.
-
-#
-# Convert time from seconds since 1970-1-1 0:0:0 into days since Yorig-1-1 0:0:0
-#
+# -------------------------------------------------
+# Setting processed output directory
+# -------------------------------------------------
+# Get the current directory
+    os.makedirs(era5_dir_processed,exist_ok=True)
 
-        time = time / 24. / 3600.
-        time = time - date.toordinal(date(Yorig,1,1)) \
-	            + date.toordinal(date(1970,1,1))
+# -------------------------------------------------
+# Loading ERA5 variables's information as
+# python Dictionary from JSON file
+# -------------------------------------------------
 
-#
-# Changes names
-#
+    with open('ERA5_variables.json', 'r') as jf:
+        era5 = json.load(jf)
 
-        if vname=='u10':
-            vname_upper='U10M'
+# -------------------------------------------------
+# Loading the manifest of previously converted files
+# -------------------------------------------------
 
-        elif vname=='v10':
-            vname_upper='V10M'
-        
-        # strangely, the CROCO source code expects variables in the file names to be upper case, except for msl!!
-        elif vname == 'msl':
-            vname_upper = 'msl'
-        else:
-            vname_upper = vname.upper()
+    manifest_file = os.path.join(era5_dir_processed, 'ERA5_convert_manifest.json')
+    manifest = load_manifest(manifest_file)
 
 #
-# Create and write output netcdf file
+# -------------------------------------------------
+# Loop on Years and Months, and on variables names,
+# to build the list of conversions which are needed
+# -------------------------------------------------
 #
 
-        fname_out = era5_dir_processed + '/' + vname_upper + '_Y' + str(iyear) + 'M' + str(imonth) + '.nc'
-
-        nw = netcdf(fname_out,mode='w',format='NETCDF4')
-
-        dimlon  = nw.createDimension('lon',  len(lon))
-        dimlat  = nw.createDimension('lat',  len(lat))
-        dimtime = nw.createDimension('time', None)
-
-        varlon = nw.createVariable('lon', 'f4',('lon',))
-        varlat = nw.createVariable('lat', 'f4',('lat',))
-        vartime = nw.createVariable('time', 'f4',('time',))
-        vardata = nw.createVariable(vname_upper, 'f4',('time','lat','lon'))
-        varlon.long_name = 'longitude of RHO-points'
-        varlat.long_name = 'latitude of RHO-points'
-        vartime.long_name = 'Time'
-        varlon.units = 'degree_east'
-        varlat.units = 'degree_north'
-        vartime.units = 'days since '+str(Yorig)+'-1-1'
-        vardata.missing_value = 9999.
-        vardata.units = units[k]
-        vardata.long_name = vlong
-	
-        varlon[:]=lon
-        varlat[:]=lat
-        vartime[:]=time
-        vardata[:]=data
-	
-        nw.close()
-
-    # ---------------------------------------------------------------------
-    # Next iteration to monthly date: add one month to current monthly date
-    # ---------------------------------------------------------------------
-    monthly_date = addmonths4date(monthly_date,1)
-    
-# Print last message on screen
-print(' ')
-print(' ERA5 files conversion done ')
-print(' ')
-
-
+    # Monthly dates limits
+    monthly_date_start = datetime.datetime(year_start,month_start,1)
+    monthly_date_end = datetime.datetime(year_end,month_end,1)
+
+    # Length of monthly dates loop
+    len_monthly_dates = (monthly_date_end.year - monthly_date_start.year) * 12 + \
+                        (monthly_date_end.month - monthly_date_start.month) + 1
+
+    # Initial monthly date
+    monthly_date = monthly_date_start
+
+    tasks = []
+    n_skipped = 0
+    for j in range(len_monthly_dates):
+
+        # Year and month
+        iyear = monthly_date.year;
+        imonth = monthly_date.month;
+
+        for k in range(len(variables)):
+
+            vname = variables[k]
+            fname_in = era5_dir_raw + '/ERA5_ecmwf_' + vname.upper() + '_Y' + str(iyear) + 'M' + str(imonth).zfill(2) + '.nc'
+            fname_out = era5_dir_processed + '/' + get_vname_upper(vname) + '_Y' + str(iyear) + 'M' + str(imonth) + '.nc'
+            task = {
+                'fname_in': fname_in,
+                'fname_out': fname_out,
+                'vname': vname,
+                'vlong': era5[vname][0],
+                'cff': conv_cff[k],
+                'unit': units[k],
+                'Yorig': Yorig,
+                'nt_block': nt_block,
+                }
+
+            # the conversion settings are part of the fingerprint, so changing
+            # e.g. Yorig or a conversion coefficient triggers a re-conversion
+            settings = {key: task[key] for key in ['vname', 'vlong', 'cff', 'unit', 'Yorig']}
+            entry = manifest.get(os.path.basename(fname_out))
+            if (os.path.isfile(fname_out) and entry is not None
+                    and entry['settings'] == settings
+                    and fingerprint_unchanged(fname_in, entry['input'])):
+                n_skipped += 1
+            else:
+                tasks.append((task, settings))
+
+        # ---------------------------------------------------------------------
+        # Next iteration to monthly date: add one month to current monthly date
+        # ---------------------------------------------------------------------
+        monthly_date = addmonths4date(monthly_date,1)
+
+    print(' '+str(n_skipped)+' file(s) unchanged since the last conversion')
+    print(' '+str(len(tasks))+' file(s) to convert using '+str(n_workers)+' worker(s)')
 
+# -------------------------------------------------
+# Convert in parallel, updating the manifest as each file completes
+# so an interrupted run still keeps what was done
+# -------------------------------------------------
 
+    memory.split(n_workers)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(convert_task, task): (task, settings) for task, settings in tasks}
+        for future in as_completed(futures):
+            task, settings = futures[future]
+            fingerprint = future.result()
+            print('  Converted: '+task['fname_out'])
+            manifest[os.path.basename(task['fname_out'])] = {
+                'input': fingerprint,
+                'settings': settings,
+                }
+            save_manifest(manifest_file, manifest)
+
+    # Print last message on screen
+    print(' ')
+    print(' ERA5 files conversion done ')
+    print(' ')
@@ -26,10 +26,14 @@
 # -------------------------------------------------
 import cdsapi
 from ERA5_utilities import *
-import calendar
 import datetime
 import json
 import os
+import sys
+
+# the requests can be recorded and replayed as those of the downloaders, at the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from download_tools import transport
 
 # -------------------------------------------------
 # Import my crocotools_param_python file
@@ -39,18 +43,13 @@ print('year_start is '+str(year_start))
 # -------------------------------------------------
 dl=2
 
-lonmin = str(float(lonmin)-dl)
-lonmax = str(float(lonmax)+dl)
-latmin = str(float(latmin)-dl)
-latmax = str(float(latmax)+dl)
-print ('lonmin-dl = ', lonmin)
-print ('lonmax+dl =', lonmax)
-print ('latmin-dl =', latmin)
-print ('latmax+dl =', latmax)
+area = era5_area(lonmin, lonmax, latmin, latmax, dl)
+print ('lonmin-dl = ', area[1])
+print ('lonmax+dl =', area[3])
+print ('latmin-dl =', area[2])
+print ('latmax+dl =', area[0])
 # -------------------------------------------------
 
-area = [latmax, lonmin, latmin, lonmax]
-
 # -------------------------------------------------
 # Setting raw output directory
 # -------------------------------------------------
@@ -85,10 +84,6 @@ for j in range(len_monthly_dates):
     year = monthly_date.year;
     month = monthly_date.month;
 
-    # Number of days in month
-    days_in_month = calendar.monthrange(year,month)[1] 
-    days = [f"{day:02}" for day in range(1, days_in_month + 1)]
-
     # Variables/Parameters loop
     for k in range(len(variables)):
 
@@ -96,40 +91,8 @@ for j in range(len_monthly_dates):
         vname = variables[k]
         vlong = era5[vname][0]
 
-        # Request options
-        options = {
-             'product_type': ['reanalysis'],
-             'variable': [vlong],
-             'year': [str(year)],
-             'month': [str(month)],
-             'day': days,
-             # 'time': times,
-             'data_format': 'netcdf',
-             'download_format': 'unarchived',
-             'area': area,
-             }
-		  
-        # # Add options to Variable without "diurnal variations"
-        if vlong == 'sea_surface_temperature':
-            options['time'] = ['00:00']
-   
-        elif vlong == 'land_sea_mask':
-            options['time'] = ['00:00']
-
-        else:
-           options['time'] = times
-
-        # Add options to Product "pressure-levels"
-        if vlong == 'specific_humidity' or vlong == 'relative_humidity':
-           options['pressure_level'] = ['1000']
-           product = 'reanalysis-era5-pressure-levels'
-
-        # Product "single-levels"
-        else:
-           product = 'reanalysis-era5-single-levels'
-
-        # Output filename
-        fname = 'ERA5_ecmwf_' + vname.upper() + '_Y' + str(year) + 'M' + str(month).zfill(2) + '.nc'
+        # Product, request options and output filename
+        product, options, fname = era5_request(vname, vlong, year, month, area, times)
         output = era5_dir_raw + '/' + fname
 
         # Information strings
@@ -151,8 +114,9 @@ for j in range(len_monthly_dates):
         # Server ECMWF-API
         c = cdsapi.Client()
 
-        # Do the request
-        c.retrieve(product, options).download(output)
+        # Do the request (through the cassette with SOMISANA_TRANSPORT, see download_tools/transport.py)
+        transport.fetch_file('cds', {'product': product, 'options': options}, output,
+                             lambda: c.retrieve(product, options).download(output))
     
     # ---------------------------------------------------------------------
     # Next iteration to monthly date: add one month to current monthly date
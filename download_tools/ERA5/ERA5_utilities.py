@@ -11,6 +11,9 @@
 # -------------------------------------------------
 import datetime
 import calendar
+import hashlib
+import json
+import os
 
 
 # -------------------------------------------------
@@ -25,3 +28,116 @@ def addmonths4date(date,addmonths):
 
 
 
+# -------------------------------------------------
+# Fingerprint of a file (size, modification time and hash)
+# -------------------------------------------------
+def file_fingerprint(fname):
+    sha = hashlib.sha256()
+    with open(fname,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha.hexdigest()}
+
+
+# -------------------------------------------------
+# Check a file against a previously stored fingerprint
+# the hash is only computed if the size matches but the time stamp doesn't
+# (e.g. the file was downloaded again with identical content)
+# -------------------------------------------------
+def fingerprint_unchanged(fname,fingerprint):
+    if not os.path.isfile(fname):
+        return False
+    stat = os.stat(fname)
+    if stat.st_size != fingerprint['size']:
+        return False
+    if stat.st_mtime == fingerprint['mtime']:
+        return True
+    return file_fingerprint(fname)['sha256'] == fingerprint['sha256']
+
+
+# -------------------------------------------------
+# Read and write the json manifest of converted files
+# -------------------------------------------------
+def load_manifest(fname):
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname,'r') as jf:
+        return json.load(jf)
+
+def save_manifest(fname,manifest):
+    # write to a temporary file first so the manifest is never left half written
+    fname_tmp = fname + '.tmp'
+    with open(fname_tmp,'w') as jf:
+        json.dump(manifest,jf,indent=1)
+    os.replace(fname_tmp,fname)
+
+
+# -------------------------------------------------
+# Changes names to the ones expected by CROCO
+# -------------------------------------------------
+def get_vname_upper(vname):
+    if vname=='u10':
+        return 'U10M'
+    elif vname=='v10':
+        return 'V10M'
+    # strangely, the CROCO source code expects variables in the file names to be upper case, except for msl!!
+    elif vname == 'msl':
+        return 'msl'
+    else:
+        return vname.upper()
+
+
+# -------------------------------------------------
+# Request area [north, west, south, east], extended by dl degrees
+# -------------------------------------------------
+def era5_area(lonmin,lonmax,latmin,latmax,dl=2):
+    return [str(float(latmax)+dl), str(float(lonmin)-dl), str(float(latmin)-dl), str(float(lonmax)+dl)]
+
+
+# -------------------------------------------------
+# CDS product, request options and output file name
+# for one variable and one month
+# -------------------------------------------------
+def era5_request(vname,vlong,year,month,area,times):
+
+    # Number of days in month
+    days_in_month = calendar.monthrange(year,month)[1]
+    days = [f"{day:02}" for day in range(1, days_in_month + 1)]
+
+    # Request options
+    options = {
+         'product_type': ['reanalysis'],
+         'variable': [vlong],
+         'year': [str(year)],
+         'month': [str(month)],
+         'day': days,
+         # 'time': times,
+         'data_format': 'netcdf',
+         'download_format': 'unarchived',
+         'area': area,
+         }
+
+    # # Add options to Variable without "diurnal variations"
+    if vlong == 'sea_surface_temperature':
+        options['time'] = ['00:00']
+
+    elif vlong == 'land_sea_mask':
+        options['time'] = ['00:00']
+
+    else:
+       options['time'] = times
+
+    # Add options to Product "pressure-levels"
+    if vlong == 'specific_humidity' or vlong == 'relative_humidity':
+       options['pressure_level'] = ['1000']
+       product = 'reanalysis-era5-pressure-levels'
+
+    # Product "single-levels"
+    else:
+       product = 'reanalysis-era5-single-levels'
+
+    # Output filename
+    fname = 'ERA5_ecmwf_' + vname.upper() + '_Y' + str(year) + 'M' + str(month).zfill(2) + '.nc'
+
+    return product, options, fname
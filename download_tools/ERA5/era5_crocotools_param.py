@@ -29,6 +29,15 @@ month_start = 12
 year_end = 2014
 month_end = 1
 #
+# Number of time records converted at a time by ERA5_convert.py
+# (this sets the peak memory use of the conversion)
+#
+nt_block = 24
+#
+# Number of processes used by ERA5_convert.py to convert files in parallel
+#
+n_workers = 4
+#
 # Year origin of time
 #
 Yorig=1993
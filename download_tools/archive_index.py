@@ -0,0 +1,128 @@
+"""
+Virtual index over an archive of monthly YYYY_MM.nc files (as written by
+download_cmems_monthly and download_hycom_gofs31)
+
+Opening a multi-decade archive with open_mfdataset reads the metadata of every
+file, every time. Instead, build_archive_index scans each file once with
+kerchunk, recording where each chunk of each variable lives (file, offset,
+length), and combines these into a single reference index along time. The
+whole archive then opens as one lazy dataset through open_archive, reading only
+the index, while the data stays where it is in the monthly files.
+
+The references of each file are kept in <archiveDir>/.archive_index/ next to the
+size and modification time of the file, so rebuilding the index only scans the
+new or changed months.
+
+kerchunk (and fsspec) are only needed for this module:
+    conda install -c conda-forge kerchunk
+"""
+import json
+import os
+from glob import glob
+
+INDEX_DIR = '.archive_index'
+INDEX_NAME = 'index.json'
+MONTHLY_PATTERN = '[0-9][0-9][0-9][0-9]_[0-9][0-9].nc'
+
+def _kerchunk():
+    try:
+        from kerchunk.hdf import SingleHdf5ToZarr
+        from kerchunk.combine import MultiZarrToZarr
+    except ImportError:
+        raise ImportError("kerchunk is needed for the archive index: conda install -c conda-forge kerchunk")
+    return SingleHdf5ToZarr, MultiZarrToZarr
+
+def index_path(archiveDir):
+    return os.path.join(archiveDir, INDEX_DIR, INDEX_NAME)
+
+def _write_json(path, obj):
+    # write to a temporary file first so a reader never sees half an index
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def file_references(fpath, part_dir):
+    """
+    The kerchunk references of a single file, from the cache in part_dir if the
+    file hasn't changed since it was scanned
+    """
+    SingleHdf5ToZarr, _ = _kerchunk()
+    stat = os.stat(fpath)
+    part = os.path.join(part_dir, os.path.basename(fpath) + '.json')
+    if os.path.exists(part):
+        with open(part) as f:
+            cached = json.load(f)
+        if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['refs'], False
+    with open(fpath, 'rb') as f:
+        refs = SingleHdf5ToZarr(f, 'file://' + os.path.abspath(fpath), inline_threshold=300).translate()
+    _write_json(part, {'size': stat.st_size, 'mtime': stat.st_mtime, 'refs': refs})
+    return refs, True
+
+def build_archive_index(archiveDir, pattern=MONTHLY_PATTERN, concat_dim='time'):
+    """
+    Build (or update) the reference index of the monthly files in archiveDir
+
+    INPUTS:
+    archiveDir : directory containing the monthly files
+    pattern    : glob pattern of the files to index (default YYYY_MM.nc)
+    concat_dim : dimension along which the files are combined
+
+    OUTPUT:
+    path to the index, <archiveDir>/.archive_index/index.json
+    """
+    _, MultiZarrToZarr = _kerchunk()
+    import xarray as xr
+
+    files = sorted(glob(os.path.join(archiveDir, pattern)))
+    if len(files) == 0:
+        raise FileNotFoundError(f"No files matching {pattern} in {archiveDir}")
+
+    part_dir = os.path.join(archiveDir, INDEX_DIR)
+    os.makedirs(part_dir, exist_ok=True)
+
+    parts = []
+    scanned = 0
+    for fpath in files:
+        refs, new = file_references(fpath, part_dir)
+        parts.append(refs)
+        scanned += new
+    print(f'{len(files)} files in {archiveDir}, {scanned} (re)scanned')
+
+    # drop the references of files which are no longer in the archive
+    names = {os.path.basename(f) + '.json' for f in files}
+    for part in glob(os.path.join(part_dir, '*.nc.json')):
+        if os.path.basename(part) not in names:
+            os.remove(part)
+
+    # the variables without the concat dimension (the grid) are taken from the first file
+    with xr.open_dataset(files[0], decode_times=False) as ds:
+        identical_dims = [v for v in ds.variables if concat_dim not in ds[v].dims]
+
+    # cf:time decodes each file's times with its own units, in case they differ between files
+    combined = MultiZarrToZarr(parts, concat_dims=[concat_dim], identical_dims=identical_dims,
+                               coo_map={concat_dim: f'cf:{concat_dim}'}).translate()
+    path = index_path(archiveDir)
+    _write_json(path, combined)
+    print(f'Written {path}')
+    return path
+
+def open_archive(archiveDir, chunks={}):
+    """
+    Open the whole archive as a single lazy dataset through its index
+    (see build_archive_index)
+    """
+    import xarray as xr
+    path = index_path(archiveDir)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No index in {archiveDir}, run build_archive_index first")
+    return xr.open_dataset('reference://', engine='zarr', chunks=chunks,
+                           backend_kwargs={'consolidated': False,
+                                           'storage_options': {'fo': path, 'remote_protocol': 'file'}})
+
+if __name__ == '__main__':
+    archiveDir = '/path/to/archive/'
+    build_archive_index(archiveDir)
+    ds = open_archive(archiveDir)
+    print(ds)
@@ -0,0 +1,486 @@
+"""
+Persistent queue for long backfills (multi-year hindcast and archive downloads)
+
+A backfill request is expanded into one task per month, kept in a SQLite queue
+(by default backfill_queue.sqlite, or SOMISANA_BACKFILL_QUEUE), and run by
+worker processes which take the tasks one at a time:
+    - cli tasks: a download_cmems_monthly or download_hycom_gofs31 command of
+      cli.py, restricted to one month
+    - era5_request / era5_convert tasks: the CDS requests of ERA5_request.py and
+      the conversions of ERA5_convert.py for one month, as set up by an
+      era5_crocotools_param.py file (a month is converted once it's downloaded)
+
+The state of every task is in the queue, so a backfill which is stopped or
+dies carries on with the months which aren't done when workers are started
+again, and within a month the downloaders pick up from what they already have
+(the manifest, the parts of a split CMEMS request, the day files of a GOFS 3.1
+month). A task being run is leased by its worker, which renews the lease while
+it works: the task goes back to the queue if the worker dies and its lease
+expires (after LEASE_TTL seconds).
+
+Requests have a priority: workers always take the next month of the highest
+priority request, so a short urgent hindcast added with a higher priority
+runs ahead of a long reanalysis pull. Requests can also be paused and resumed.
+
+Several nodes can work on the same backfill: put the queue and the output
+directories on the filesystem they share, and run `cli.py backfill --queue
+<shared queue> work` on each node. The workers of all the nodes claim months
+from the same queue, and since each month is downloaded, merged or converted
+by its own worker, the throughput grows with the number of nodes (until the
+data servers become the limit). The months of a download into a Zarr store
+are the exception: they're appended to the store in time order, so they run
+one after the other. SQLite's own locks aren't reliable on network
+filesystems, so every change to the queue is also made under the lease of the
+queue file (see locking.py, its lock files work across hosts), and the queue
+keeps the default rollback journal (WAL can't be shared between hosts). The
+manifests of the output directories switch to the same journal there (see
+manifest.py), and the artifacts a month shares with its neighbours are
+protected by their own leases. A node which dies hands its months back when
+their leases expire; the clocks of the nodes must be synchronised (NTP), and
+LEASE_TTL much longer than any difference between them. Months left by a
+worker which died on the same host (and in the same pid namespace) are taken
+back straight away.
+"""
+import json
+import os
+import runpy
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from download_tools import locking, memory, transport
+
+DEFAULT_QUEUE = os.environ.get('SOMISANA_BACKFILL_QUEUE', 'backfill_queue.sqlite')
+LEASE_TTL = float(os.environ.get('SOMISANA_BACKFILL_LEASE', 300))
+MAX_ATTEMPTS = 3
+POLL = 5.
+QUEUE_POLL = 0.02   # first interval between attempts at the lease of the queue, held for a moment at a time
+
+# cli functions which can be split into months, with the names of their date arguments
+MONTHLY_FUNCTIONS = {
+    'download_cmems_monthly': ('--start_date', '--end_date'),
+    'download_hycom_gofs31': ('--start_date', '--end_date'),
+}
+
+ERA5_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ERA5')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    description TEXT NOT NULL,
+    priority    INTEGER NOT NULL DEFAULT 0,
+    status      TEXT NOT NULL,
+    created     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id    INTEGER NOT NULL REFERENCES requests (id),
+    label         TEXT NOT NULL,
+    kind          TEXT NOT NULL,
+    payload       TEXT NOT NULL,
+    after         INTEGER REFERENCES tasks (id),
+    status        TEXT NOT NULL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    worker        TEXT,
+    pidns         TEXT,
+    lease_expires REAL,
+    started       TEXT,
+    finished      TEXT,
+    error         TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, request_id);
+"""
+
+# request status values
+ACTIVE = 'active'
+PAUSED = 'paused'
+
+# task status values
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _worker_alive(worker, pidns):
+    """
+    False if worker ran on this host, in this pid namespace, and is no longer running
+    """
+    host, _, pid = worker.rpartition(':')
+    if host != socket.gethostname() or pidns is None or pidns != locking._pid_namespace():
+        return True
+    return locking._pid_alive(int(pid))
+
+class Queue:
+    """
+    The backfill queue. Like the manifest, connections are kept per thread.
+    The journal is left in its default (rollback) mode rather than WAL, and
+    changes are made under the lease of the queue file, so the queue can be
+    shared by the nodes mounting a network filesystem
+    """
+
+    def __init__(self, db):
+        self.db = os.path.abspath(db)
+        self._local = threading.local()
+        # leases are held per process, this serialises the threads of the process
+        self._write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.db), exist_ok=True)
+        with self._write_lock, locking.lease(self.db, poll=QUEUE_POLL, quiet=True):
+            conn = self._connect()
+            conn.executescript(SCHEMA)
+            # queues created before tasks had a pidns
+            if 'pidns' not in [row['name'] for row in conn.execute('PRAGMA table_info(tasks)')]:
+                conn.execute('ALTER TABLE tasks ADD COLUMN pidns TEXT')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db, timeout=120, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """
+        A write transaction, under the lease of the queue file
+        """
+        with self._write_lock, locking.lease(self.db, poll=QUEUE_POLL, quiet=True):
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def add(self, description, tasks, priority=0):
+        """
+        Add a request made of tasks [(label, kind, payload, index of the task it comes after or None)]
+        """
+        with self._write() as conn:
+            request_id = conn.execute('INSERT INTO requests (description, priority, status, created) '
+                                      'VALUES (?,?,?,?)', (description, priority, ACTIVE, _now())).lastrowid
+            ids = []
+            for label, kind, payload, after in tasks:
+                ids.append(conn.execute(
+                    'INSERT INTO tasks (request_id, label, kind, payload, after, status) VALUES (?,?,?,?,?,?)',
+                    (request_id, label, kind, json.dumps(payload), None if after is None else ids[after],
+                     PENDING)).lastrowid)
+        return request_id
+
+    def claim(self, worker):
+        """
+        Lease the next task to run (the first month of the highest priority active
+        request, including tasks whose worker's lease has expired or whose worker
+        died on this host), or None
+        """
+        now = time.time()
+        with self._write() as conn:
+            for row in conn.execute('SELECT id, label, worker, pidns FROM tasks WHERE status = ? AND lease_expires >= ?',
+                                    (RUNNING, now)).fetchall():
+                if not _worker_alive(row['worker'], row['pidns']):
+                    conn.execute('UPDATE tasks SET lease_expires = 0 WHERE id = ?', (row['id'],))
+            row = conn.execute(
+                """SELECT t.* FROM tasks t JOIN requests r ON t.request_id = r.id
+                   WHERE r.status = ?
+                     AND (t.status = ? OR (t.status = ? AND t.lease_expires < ?))
+                     AND (t.after IS NULL OR (SELECT status FROM tasks WHERE id = t.after) = ?)
+                   ORDER BY r.priority DESC, t.request_id, t.id LIMIT 1""",
+                (ACTIVE, PENDING, RUNNING, now, DONE)).fetchone()
+            if row is not None:
+                if row['status'] == RUNNING:
+                    print(f"[backfill] {row['label']}: {row['worker']} is gone or its lease expired, taking it over")
+                conn.execute('UPDATE tasks SET status = ?, worker = ?, pidns = ?, lease_expires = ?, started = ?, '
+                             'attempts = attempts + 1, error = NULL WHERE id = ?',
+                             (RUNNING, worker, locking._pid_namespace(), now + LEASE_TTL, _now(), row['id']))
+        return dict(row) if row is not None else None
+
+    def renew(self, task_id, worker):
+        """
+        Extend the lease of a task, False if it's no longer ours
+        """
+        with self._write() as conn:
+            cur = conn.execute('UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ?',
+                               (time.time() + LEASE_TTL, task_id, worker, RUNNING))
+        return cur.rowcount == 1
+
+    def finish(self, task, worker, error=None):
+        """
+        Record the outcome of a task: done, back to pending for another attempt, or failed
+        """
+        if error is None:
+            status = DONE
+        else:
+            status = FAILED if task['attempts'] >= MAX_ATTEMPTS else PENDING
+        with self._write() as conn:
+            conn.execute('UPDATE tasks SET status = ?, finished = ?, error = ?, lease_expires = NULL '
+                         'WHERE id = ? AND worker = ?', (status, _now(), error, task['id'], worker))
+        return status
+
+    def release(self, task, worker):
+        """
+        Give a task back without counting the attempt (e.g. the worker was interrupted)
+        """
+        with self._write() as conn:
+            conn.execute('UPDATE tasks SET status = ?, attempts = attempts - 1, lease_expires = NULL '
+                         'WHERE id = ? AND worker = ?', (PENDING, task['id'], worker))
+
+    def set_request(self, request_id, status=None, priority=None):
+        with self._write() as conn:
+            if status is not None:
+                conn.execute('UPDATE requests SET status = ? WHERE id = ?', (status, request_id))
+            if priority is not None:
+                conn.execute('UPDATE requests SET priority = ? WHERE id = ?', (priority, request_id))
+
+    def retry_failed(self, request_id):
+        with self._write() as conn:
+            conn.execute('UPDATE tasks SET status = ?, attempts = 0 WHERE request_id = ? AND status = ?',
+                         (PENDING, request_id, FAILED))
+
+    def outstanding(self):
+        """
+        Number of tasks of active requests which aren't done or failed, nor waiting
+        on a task which failed (until it's retried, see retry_failed)
+        """
+        return self._connect().execute(
+            'WITH RECURSIVE blocked (id) AS ('
+            '  SELECT id FROM tasks WHERE status = ?'
+            '  UNION SELECT t.id FROM tasks t JOIN blocked b ON t.after = b.id WHERE t.status = ?) '
+            'SELECT COUNT(*) FROM tasks t JOIN requests r ON t.request_id = r.id '
+            'WHERE r.status = ? AND t.status IN (?, ?) AND t.id NOT IN (SELECT id FROM blocked)',
+            (FAILED, PENDING, ACTIVE, PENDING, RUNNING)).fetchone()[0]
+
+    def summary(self):
+        conn = self._connect()
+        out = []
+        for r in conn.execute('SELECT * FROM requests ORDER BY priority DESC, id'):
+            r = dict(r)
+            r['tasks'] = {row['status']: row['n'] for row in conn.execute(
+                'SELECT status, COUNT(*) AS n FROM tasks WHERE request_id = ? GROUP BY status', (r['id'],))}
+            r['running'] = [dict(row) for row in conn.execute(
+                'SELECT label, worker, started, attempts FROM tasks WHERE request_id = ? AND status = ?',
+                (r['id'], RUNNING))]
+            r['failed'] = [dict(row) for row in conn.execute(
+                'SELECT label, error FROM tasks WHERE request_id = ? AND status = ?', (r['id'], FAILED))]
+            out.append(r)
+        return out
+
+    def nodes(self):
+        """
+        Months done per node (host), with their mean duration and the rate of the
+        node since its first month started
+        """
+        return [dict(row) for row in self._connect().execute(
+            """SELECT substr(worker, 1, instr(worker, ':') - 1) AS node, COUNT(*) AS done,
+                      COUNT(DISTINCT worker) AS workers,
+                      AVG(julianday(finished) - julianday(started)) * 1440 AS minutes,
+                      COUNT(*) / ((julianday(MAX(finished)) - julianday(MIN(started))) * 24) AS per_hour
+               FROM tasks WHERE status = ? GROUP BY node ORDER BY node""", (DONE,))]
+
+# ------------------------------------------------------------
+# expanding requests into monthly tasks
+# ------------------------------------------------------------
+
+def month_starts(start_date, end_date):
+    d = datetime(start_date.year, start_date.month, 1)
+    while d <= end_date:
+        yield d
+        d = datetime((d + timedelta(days=32)).year, (d + timedelta(days=32)).month, 1)
+
+def expand_cli(parser, argv):
+    """
+    The monthly tasks of a cli.py command (one of MONTHLY_FUNCTIONS): the same
+    command, with its dates narrowed to each month in turn. With --output_format
+    zarr each month comes after the one before it, since a Zarr store can only
+    be appended to in time order (see zarr_store.py)
+    """
+    args = parser.parse_args(argv)
+    if args.function not in MONTHLY_FUNCTIONS:
+        raise ValueError(f"{args.function} can't be split into months, only {', '.join(MONTHLY_FUNCTIONS)}")
+    start_arg, end_arg = MONTHLY_FUNCTIONS[args.function]
+    in_order = getattr(args, 'output_format', None) == 'zarr'
+    tasks = []
+    for m0 in month_starts(args.start_date, args.end_date):
+        m1 = (m0 + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        month_argv = list(argv) + [start_arg, m0.strftime('%Y-%m-%d %H:%M:%S'),
+                                   end_arg, m1.strftime('%Y-%m-%d %H:%M:%S')]
+        after = len(tasks) - 1 if in_order and tasks else None
+        tasks.append((f"{args.function} {m0:%Y_%m}", 'cli', {'argv': month_argv}, after))
+    return tasks
+
+def _era5_modules():
+    if ERA5_DIR not in sys.path:
+        sys.path.insert(0, ERA5_DIR)
+    import ERA5_utilities
+    return ERA5_utilities
+
+def expand_era5(param_file, request=True, convert=True):
+    """
+    The monthly tasks of the ERA5 scripts, as set up by param_file (an
+    era5_crocotools_param.py): downloading the variables of each month, and/or
+    converting them for CROCO once they're downloaded
+    """
+    util = _era5_modules()
+    p = runpy.run_path(param_file)
+    # the directories in the param file are relative to where the scripts are run from
+    here = os.path.dirname(os.path.abspath(param_file))
+    raw = os.path.normpath(os.path.join(here, p['era5_dir_raw']))
+    processed = os.path.normpath(os.path.join(here, p['era5_dir_processed']))
+    with open(os.path.join(ERA5_DIR, 'ERA5_variables.json')) as f:
+        era5 = json.load(f)
+    area = util.era5_area(p['lonmin'], p['lonmax'], p['latmin'], p['latmax'])
+
+    tasks = []
+    for m0 in month_starts(datetime(p['year_start'], p['month_start'], 1), datetime(p['year_end'], p['month_end'], 1)):
+        requests, conversions = [], []
+        for k, vname in enumerate(p['variables']):
+            product, options, fname = util.era5_request(vname, era5[vname][0], m0.year, m0.month, area, p['times'])
+            requests.append({'product': product, 'options': options, 'output': os.path.join(raw, fname)})
+            conversions.append({
+                'fname_in': os.path.join(raw, fname),
+                'fname_out': os.path.join(processed, f'{util.get_vname_upper(vname)}_Y{m0.year}M{m0.month}.nc'),
+                'vname': vname, 'vlong': era5[vname][0], 'cff': p['conv_cff'][k], 'unit': p['units'][k],
+                'Yorig': p['Yorig'], 'nt_block': p.get('nt_block', 24)})
+        after = None
+        if request:
+            tasks.append((f'era5_request {m0:%Y_%m}', 'era5_request', {'requests': requests}, None))
+            after = len(tasks) - 1
+        if convert:
+            tasks.append((f'era5_convert {m0:%Y_%m}', 'era5_convert', {'conversions': conversions}, after))
+    return tasks
+
+# ------------------------------------------------------------
+# running the tasks
+# ------------------------------------------------------------
+
+def _run_era5_request(payload):
+    import cdsapi
+    from download_tools.locking import atomic_write
+    client = cdsapi.Client()
+    for r in payload['requests']:
+        # variables already downloaded (e.g. before the worker was interrupted) are kept
+        if os.path.isfile(r['output']):
+            continue
+        os.makedirs(os.path.dirname(r['output']), exist_ok=True)
+        with atomic_write(r['output']) as tmp:
+            transport.fetch_file('cds', {'product': r['product'], 'options': r['options']}, tmp,
+                                 lambda: client.retrieve(r['product'], r['options']).download(tmp))
+
+def _run_era5_convert(payload):
+    _era5_modules()
+    import ERA5_convert
+    from download_tools.locking import atomic_write, lease
+    for c in payload['conversions']:
+        os.makedirs(os.path.dirname(c['fname_out']), exist_ok=True)
+        # the manifest of ERA5_convert.py is shared with the script, and with the other workers
+        manifest_file = os.path.join(os.path.dirname(c['fname_out']), 'ERA5_convert_manifest.json')
+        settings = {key: c[key] for key in ['vname', 'vlong', 'cff', 'unit', 'Yorig']}
+        entry = ERA5_convert.load_manifest(manifest_file).get(os.path.basename(c['fname_out']))
+        if (os.path.isfile(c['fname_out']) and entry is not None and entry['settings'] == settings
+                and ERA5_convert.fingerprint_unchanged(c['fname_in'], entry['input'])):
+            continue
+        with atomic_write(c['fname_out']) as tmp:
+            fingerprint = ERA5_convert.convert_task(dict(c, fname_out=tmp))
+        with lease(manifest_file):
+            manifest = ERA5_convert.load_manifest(manifest_file)
+            manifest[os.path.basename(c['fname_out'])] = {'input': fingerprint, 'settings': settings}
+            ERA5_convert.save_manifest(manifest_file, manifest)
+
+def run_task(parser, task):
+    payload = json.loads(task['payload'])
+    if task['kind'] == 'cli':
+        args = parser.parse_args(payload['argv'])
+        args.func(args)
+    elif task['kind'] == 'era5_request':
+        _run_era5_request(payload)
+    elif task['kind'] == 'era5_convert':
+        _run_era5_convert(payload)
+    else:
+        raise ValueError(f"unknown task kind {task['kind']}")
+
+def _heartbeat(queue, task, worker, done):
+    while not done.wait(LEASE_TTL / 3):
+        if not queue.renew(task['id'], worker):
+            print(f"[backfill] {task['label']}: lost the lease, another worker has taken it over")
+            return
+
+def worker_loop(build_parser, queue_path, forever=False):
+    """
+    Run tasks from the queue until there are none left (or forever)
+    """
+    parser = build_parser()
+    queue = Queue(queue_path)
+    worker = worker_name()
+    while True:
+        task = queue.claim(worker)
+        if task is None:
+            if not forever and queue.outstanding() == 0:
+                return
+            # tasks may be waiting on others which are running, or on new requests
+            time.sleep(POLL)
+            continue
+        print(f"[backfill] {worker} running {task['label']} (attempt {task['attempts'] + 1})")
+        task['attempts'] += 1
+        done = threading.Event()
+        threading.Thread(target=_heartbeat, args=(queue, task, worker, done), daemon=True).start()
+        error = None
+        try:
+            run_task(parser, task)
+        except KeyboardInterrupt:
+            queue.release(task, worker)
+            raise
+        except BaseException as e:
+            # including SystemExit, from the functions which exit when there's no data
+            traceback.print_exc()
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            done.set()
+        status = queue.finish(task, worker, error)
+        print(f"[backfill] {task['label']}: {status}")
+
+def work(build_parser, queue_path=DEFAULT_QUEUE, workers=1, forever=False):
+    """
+    Run workers processes on the queue (processes rather than threads, since the
+    netCDF4 library isn't thread-safe with OPeNDAP and the conversions are CPU bound)
+    """
+    import multiprocessing
+    memory.split(workers)   # each worker gets its share of the memory budget
+    procs = [multiprocessing.Process(target=worker_loop, args=(build_parser, queue_path, forever))
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        print('[backfill] interrupted, the running tasks go back to the queue')
+        for p in procs:
+            p.join()
+
+def print_summary(queue_path=DEFAULT_QUEUE):
+    queue = Queue(queue_path)
+    for r in queue.summary():
+        counts = ', '.join(f'{n} {status}' for status, n in sorted(r['tasks'].items()))
+        print(f"[{r['id']}] priority {r['priority']} {r['status']}: {r['description']}\n    {counts}")
+        for t in r['running']:
+            print(f"    running {t['label']} on {t['worker']} since {t['started']} (attempt {t['attempts']})")
+        for t in r['failed']:
+            print(f"    failed {t['label']}: {t['error']}")
+    nodes = queue.nodes()
+    if nodes:
+        print('months done per node:')
+        for n in nodes:
+            print(f"    {n['node']}: {n['done']} by {n['workers']} workers, {n['minutes']:.1f} min each, "
+                  f"{n['per_hour'] or 0:.1f} per hour")
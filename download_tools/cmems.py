@@ -12,6 +12,24 @@ import xarray as xr
 import subprocess
 import time
 import threading
+from download_tools.manifest import get_manifest
+from download_tools import metrics
+from download_tools.metrics import track
+from download_tools import memory, throttle, transport
+from download_tools.concurrency import controller
+from download_tools.encoding import write_netcdf
+from download_tools.locking import atomic_write, lease
+from download_tools.planner import cmems_periods
+from download_tools.profiling import traced
+from download_tools.tiles import download_tiled
+from download_tools.zarr_store import append_to_zarr, store_covers, store_name
+
+# the metadata scan of the files being merged shows up in the profile (see profiling.py)
+open_mfdataset = traced('open_mfdataset', 'merge')(xr.open_mfdataset)
+
+# 'cli' runs the copernicusmarine command for each request, 'python' calls its python
+# client in this process instead (as the download daemon does, see server.py)
+CMEMS_CLIENT = os.environ.get('SOMISANA_CMEMS_CLIENT', 'cli')
 
 def is_valid_netcdf_file(file_path):
     try:
@@ -20,21 +38,43 @@ def is_valid_netcdf_file(file_path):
     except:
         return False
 
-def download_cmems(usrname, passwd, dataset, varlist, start_date, end_date, domain, depths, outputDir, fname, ver=''):
+def download_cmems(usrname, passwd, dataset, varlist, start_date, end_date, domain, depths, outputDir, fname, ver='',
+                   tile_cache=None):
     """
     Generic function to download a subset of a CMEMS dataset
     This is called by other functions in this file
     Input variables should be self-explanatory from the runcommand
+    If tile_cache is given, the domain is downloaded as tiles shared with other domains (see tiles.py)
     """
+    if tile_cache is not None:
+        key = f"{'_'.join(varlist)}_{start_date:%Y%m%d}_{end_date:%Y%m%d}_{depths[0]:g}_{depths[1]:g}{ver}"
+        record = dict(dataset=dataset,
+                      params={'vars': varlist, 'domain': domain, 'depths': depths, 'version': ver, 'tiled': True},
+                      time_start=start_date, time_end=end_date)
+        download_tiled('cmems', dataset, key, domain, outputDir, fname,
+                       lambda tile, tile_dir, tile_fname: download_cmems(usrname, passwd, dataset, varlist, start_date,
+                                                                         end_date, tile, depths, tile_dir, tile_fname, ver),
+                       tile_cache, record)
+        return
     
     # skip this file if it already exists
     f = os.path.normpath(os.path.join(outputDir, fname))
-    if is_valid_netcdf_file(f):
+    manifest = get_manifest(outputDir)
+    record = dict(dataset=dataset,
+                  params={'vars': varlist, 'domain': domain, 'depths': depths, 'version': ver},
+                  time_start=start_date, time_end=end_date)
+    if manifest.already_downloaded(f, 'cmems', legacy_check=is_valid_netcdf_file, **record):
         print("file already exists - "+ fname)
+        with track('cmems', fname) as m:
+            m.set_status('skipped')
         return  
     
     variables = f"-v {' -v '.join(varlist)} "
 
+    # the client writes to a temporary file, moved into place once it's valid, so
+    # other processes never see a partial file (see locking.py)
+    tmp = os.path.join(os.path.normpath(outputDir), f".{os.path.splitext(fname)[0]}.{os.getpid()}.nc")
+
     if ver: # only use if it's a defined input
         version = f"--dataset-version {ver}"
     else:
@@ -55,43 +95,124 @@ def download_cmems(usrname, passwd, dataset, varlist, start_date, end_date, doma
             -Z {depths[1]} \
             {variables} \
             -o {os.path.normpath(outputDir)} \
-            -f {fname}"""
+            -f {os.path.basename(tmp)}"""
 
     # allow for a few retries if there was a temporary download error
     MAX_RETRIES = 3
     RETRY_WAIT = 10      
     
-    i = 0
-    while i < MAX_RETRIES:
-        print(
-            f"Attempt {i+1} of {MAX_RETRIES}"
-        )
-        try: 
-            os.system(runcommand)
-            if is_valid_netcdf_file(f):
-                print("Completed "+fname)
-                break
-            else:
-                os.unlink(f)
-                raise Exception(f"Mercator download failed (bad NetCDF output): {fname}")
-        except Exception as e:  # Catch all potential exceptions here
-            print(f"Error: {e}, retrying in {RETRY_WAIT} seconds...")
-            time.sleep(RETRY_WAIT)
-            raise  # Re-raise the exception for potential retries
-        i+=1
+    with manifest.downloading(f, 'cmems', **record):
+        _start = time.time()
+        i = 0
+        with track('cmems', fname) as m:
+            while i < MAX_RETRIES:
+                print(
+                    f"Attempt {i+1} of {MAX_RETRIES}"
+                )
+                try: 
+                    # the copernicusmarine client does the request and the transfer in one go
+                    with controller('copernicusmarine').slot() as s:
+                        with m.phase('transfer'):
+                            if CMEMS_CLIENT == 'python':
+                                fetch = lambda: _subset_in_process(usrname, passwd, dataset, ver, varlist, start_date,
+                                                                   end_date, domain, depths, tmp)
+                            else:
+                                fetch = lambda: os.system(runcommand)
+                            # the request, without the credentials, identifies it when it's recorded (see transport.py)
+                            transport.fetch_file('cmems', dict(dataset=dataset, ver=ver, vars=varlist,
+                                                               start=start_date, end=end_date,
+                                                               domain=domain, depths=depths), tmp, fetch)
+                        if is_valid_netcdf_file(tmp):
+                            s.add_bytes(os.path.getsize(tmp))
+                            os.replace(tmp, f)
+                        else:
+                            s.fail('bad NetCDF output')
+                    if is_valid_netcdf_file(f):
+                        print("Completed "+fname)
+                        m.add_bytes(os.path.getsize(f))
+                        with m.phase('transfer'):
+                            throttle.consume(os.path.getsize(f))
+                        manifest.record(f, 'cmems', duration=time.time() - _start, **record)
+                        break
+                    else:
+                        if os.path.exists(tmp):
+                            os.unlink(tmp)
+                        raise Exception(f"Mercator download failed (bad NetCDF output): {fname}")
+                except Exception as e:  # Catch all potential exceptions here
+                    print(f"Error: {e}, retrying in {RETRY_WAIT} seconds...")
+                    manifest.fail(f, 'cmems', duration=time.time() - _start, **record)
+                    with m.phase('backoff'):
+                        time.sleep(RETRY_WAIT)
+                    raise  # Re-raise the exception for potential retries
+                i+=1
 
-def download_mercator_ops(usrname, passwd, domain, run_date, hdays, fdays, outputDir):
+def _subset_in_process(usrname, passwd, dataset, ver, varlist, start_date, end_date, domain, depths, out_path):
     """
-    Download the operational Mercator ocean output
+    The same subset as the copernicusmarine command in download_cmems, through the python client
     """
-    # extend the download range by a day either side so we are guarenteed to cover the required model run time
-    hdays = hdays + 1
-    fdays = fdays + 1
-    start_date = run_date + timedelta(days=-hdays)
-    end_date = run_date + timedelta(days=fdays)
-    
-    # hard coding the variable info to extract (variables are in separate files)
-    VARIABLES = [
+    import copernicusmarine
+    copernicusmarine.subset(
+        dataset_id=dataset,
+        dataset_version=ver or None,
+        username=usrname,
+        password=passwd,
+        variables=varlist,
+        minimum_longitude=domain[0],
+        maximum_longitude=domain[1],
+        minimum_latitude=domain[2],
+        maximum_latitude=domain[3],
+        start_datetime=start_date.strftime("%Y-%m-%d 00:00:00"),
+        end_datetime=end_date.strftime("%Y-%m-%d 23:59:59"),
+        minimum_depth=depths[0],
+        maximum_depth=depths[1],
+        output_directory=os.path.dirname(out_path),
+        output_filename=os.path.basename(out_path),
+    )
+
+def download_cmems_split(usrname, passwd, dataset, varlist, start_date, end_date, domain, depths, outputDir, fname,
+                         ver='', tile_cache=None):
+    """
+    download_cmems, split into several requests over time if the request would be
+    too big for one (see planner.cmems_periods), the parts being concatenated into fname
+    """
+    periods = cmems_periods(dataset, varlist, start_date, end_date, domain, depths)
+    if len(periods) == 1:
+        download_cmems(usrname, passwd, dataset, varlist, start_date, end_date, domain, depths, outputDir, fname,
+                       ver, tile_cache)
+        return
+
+    f = os.path.normpath(os.path.join(outputDir, fname))
+    manifest = get_manifest(outputDir)
+    record = dict(dataset=dataset,
+                  params={'vars': varlist, 'domain': domain, 'depths': depths, 'version': ver},
+                  time_start=start_date, time_end=end_date)
+    if manifest.already_downloaded(f, 'cmems', legacy_check=is_valid_netcdf_file, **record):
+        print("file already exists - "+ fname)
+        return
+
+    with manifest.downloading(f, 'cmems', **record):
+        print(f"{fname}: downloading in {len(periods)} parts")
+        parts = []
+        for k, (p0, p1) in enumerate(periods):
+            part = fname.replace('.nc', f'_part{k}.nc')
+            download_cmems(usrname, passwd, dataset, varlist, p0, p1, domain, depths, outputDir, part, ver, tile_cache)
+            parts.append(os.path.join(outputDir, part))
+        with track('cmems', fname, stage='merge') as m, open_mfdataset(parts, combine='by_coords', chunks=memory.file_chunks(parts)) as ds:
+            with m.phase('write'), atomic_write(f) as tmp:
+                write_netcdf(ds, tmp, m)
+            m.add_bytes(os.path.getsize(f))
+        manifest.record(f, 'cmems', **record)
+    for part in parts:
+        os.remove(part)
+
+# all depths
+MERCATOR_DEPTHS = [0.493, 5727.918]
+
+def mercator_variables(run_date):
+    """
+    Variable info to extract for the operational Mercator download (variables are in separate files)
+    """
+    return [
         {
             "name": "so",
             "#": "Salinity in psu",
@@ -121,34 +242,86 @@ def download_mercator_ops(usrname, passwd, domain, run_date, hdays, fdays, outpu
             "fname": f"mercator_uo_vo_{run_date.strftime('%Y%m%d_%H')}.nc"
         },
     ]
+
+def mercator_ops_dates(run_date, hdays, fdays):
+    """
+    Start and end dates of the download for an operational run
+    """
+    # extend the download range by a day either side so we are guarenteed to cover the required model run time
+    hdays = hdays + 1
+    fdays = fdays + 1
+    start_date = run_date + timedelta(days=-hdays)
+    end_date = run_date + timedelta(days=fdays)
+    return start_date, end_date
+
+def download_mercator_ops(usrname, passwd, domain, run_date, hdays, fdays, outputDir, output_format='nc',
+                          tile_cache=None):
+    """
+    Download the operational Mercator ocean output
+
+    output_format : 'nc' for MERCATOR_<run_date>.nc (default), or 'zarr' to add
+                    the run to a MERCATOR_ops_<domain>.zarr store (see merge_mercator_ops)
+    tile_cache    : directory of the tile cache shared between domains (see tiles.py)
+    """
+    start_date, end_date = mercator_ops_dates(run_date, hdays, fdays)
     
-    # all depths
-    depths = [0.493, 5727.918]
+    VARIABLES = mercator_variables(run_date)
     
     # you can loop on the variables to download them in series
     # for var in VARIABLES:
-    #     download_cmems(usrname, passwd,var["id"], var["vars"], start_date, end_date, domain, depths, outputDir, var["fname"])
+    #     download_cmems(usrname, passwd,var["id"], var["vars"], start_date, end_date, domain, MERCATOR_DEPTHS, outputDir, var["fname"])
     
     # but I'm rather doing them in parallel to save time (thanks Gemini)
     def download_worker(var):
-        download_cmems(usrname, passwd, var["id"], var["vars"], start_date, end_date, domain, depths, outputDir, var["fname"])
+        download_cmems_split(usrname, passwd, var["id"], var["vars"], start_date, end_date, domain, MERCATOR_DEPTHS, outputDir, var["fname"],
+                             tile_cache=tile_cache)
     threads = []
     for var in VARIABLES:
-        t = threading.Thread(target=download_worker, args=(var,))
+        t = threading.Thread(target=metrics.in_scope(download_worker), args=(var,))
         threads.append(t)
         t.start()
     # Wait for all threads to finish
     for t in threads:
         t.join()
     
-    # Concatenate the separate NetCDF files
+    merge_mercator_ops(domain, run_date, start_date, end_date, outputDir, output_format)
+
+def _open_chunked(path):
+    # in time chunks which fit the memory budget (if any, see memory.py), so the merge is streamed
+    return xr.open_dataset(path, chunks=memory.file_chunks(path))
+
+def merge_mercator_ops(domain, run_date, start_date, end_date, outputDir, output_format='nc'):
+    """
+    Concatenate the separate NetCDF files of an operational run into MERCATOR_<run_date>.nc
+
+    With output_format='zarr' the run is written to MERCATOR_ops_<domain>.zarr
+    instead: the days we already have from previous runs are overwritten with
+    this run's (more recent) data and the new days are appended
+    """
+    VARIABLES = mercator_variables(run_date)
     print("merge NetCDF files")
+    if output_format == 'zarr':
+        store = store_name(outputDir, 'MERCATOR_ops', domain)
+        with track('cmems', os.path.basename(store), stage='merge') as m:
+            datasets = [_open_chunked(os.path.join(outputDir, var["fname"])) for var in VARIABLES]
+            with m.phase('write'):
+                append_to_zarr(xr.merge(datasets), store)
+            for ds in datasets:
+                ds.close()
+        return
     output_path = os.path.abspath(os.path.join(outputDir, f"MERCATOR_{run_date.strftime('%Y%m%d_%H')}.nc"))
-    datasets = [xr.open_dataset(os.path.join(outputDir, var["fname"])) for var in VARIABLES]
-    merged = xr.merge(datasets)
-    merged.to_netcdf(output_path, mode="w")
-    for ds in datasets:
-        ds.close()
+    # another run merging the same files waits for us, and readers only ever see a complete file
+    with lease(output_path), track('cmems', os.path.basename(output_path), stage='merge') as m:
+        datasets = [_open_chunked(os.path.join(outputDir, var["fname"])) for var in VARIABLES]
+        merged = xr.merge(datasets)
+        with m.phase('write'), atomic_write(output_path) as tmp:
+            write_netcdf(merged, tmp, m, mode="w")
+        for ds in datasets:
+            ds.close()
+        m.add_bytes(os.path.getsize(output_path))
+        get_manifest(outputDir).record(output_path, 'cmems', dataset='MERCATOR',
+                                       params={'merged': [var["fname"] for var in VARIABLES], 'domain': domain},
+                                       time_start=start_date, time_end=end_date)
 
     subprocess.call(["chmod", "-R", "775", output_path])
     
@@ -160,15 +333,30 @@ def download_cmems_monthly(usrname,
                             end_date,
                             varlist, 
                             depths, 
-                            outputDir):
+                            outputDir,
+                            output_format='nc',
+                            tile_cache=None):
  
     """
     Download month by month for any dataset on CMEMS
-    
+
+    output_format : 'nc' for monthly YYYY_MM.nc files (default), or 'zarr' to
+                    append each month to a single <dataset>_<domain>.zarr store
+    tile_cache    : directory of the tile cache shared between domains (see tiles.py)
     """
    
     os.makedirs(outputDir,exist_ok=True)
 
+    # report what is still missing from the archive for this period in one lookup
+    months = []
+    d = datetime(start_date.year, start_date.month, 1)
+    while d <= end_date:
+        months.append(os.path.join(outputDir, d.strftime('%Y_%m') + '.nc'))
+        d = datetime((d + timedelta(days=32)).year, (d + timedelta(days=32)).month, 1)
+    if output_format != 'zarr':
+        missing = get_manifest(outputDir).missing(months)
+        print(f"{len(months) - len(missing)} of {len(months)} monthly files already in the manifest")
+
     downloadDate=start_date
     
     while downloadDate <= end_date:
@@ -183,7 +371,21 @@ def download_cmems_monthly(usrname,
         # output filename
         fname = str(downloadDate.strftime('%Y_%m'))+'.nc'
         
-        download_cmems(usrname, passwd, dataset, varlist, start_date_download, end_date_download, domain, depths, outputDir, fname)
+        if output_format == 'zarr':
+            store = store_name(outputDir, dataset, domain)
+            if store_covers(store, start_date_download, end_date_download):
+                print(f'{downloadDate.strftime("%Y-%m")} already in {store}. Skipping.')
+            else:
+                # the month is downloaded as usual, then moved into the store
+                download_cmems_split(usrname, passwd, dataset, varlist, start_date_download, end_date_download, domain, depths, outputDir, fname,
+                                     tile_cache=tile_cache)
+                fpath = os.path.join(outputDir, fname)
+                with track('cmems', fname, stage='merge'), xr.open_dataset(fpath) as ds:
+                    append_to_zarr(ds, store)
+                os.remove(fpath)
+        else:
+            download_cmems_split(usrname, passwd, dataset, varlist, start_date_download, end_date_download, domain, depths, outputDir, fname,
+                                     tile_cache=tile_cache)
             
         downloadDate=downloadDate+timedelta(days=32) # 32 days ensures we get to the next month
         downloadDate=datetime(downloadDate.year, downloadDate.month, 1) # set the first day of the month
@@ -0,0 +1,197 @@
+"""
+Adaptive (AIMD) concurrency limits per remote endpoint, shared by all the downloaders
+
+Rather than a fixed number of threads per source, every request to a remote
+endpoint (NOMADS, the HYCOM THREDDS server, Copernicus Marine) runs in a slot
+of that endpoint's controller:
+
+    with controller('https://nomads.ncep.noaa.gov/...').slot() as s:
+        data = urlopen(url).read()
+        s.add_bytes(len(data))
+
+The number of slots starts low and is adjusted as requests complete:
+    - additive increase: after a window of successful requests (as many as the
+      current limit), the limit goes up by one if the throughput of the window
+      improved on that before the last increase
+    - multiplicative decrease: an error, a throttling response (429/503) or a
+      latency spike (smoothed latency above LATENCY_FACTOR x the best seen) cuts
+      the limit by DECREASE, at most once per window so that a burst of failures
+      from the same overload only counts once
+Every change is printed and kept for the metrics report (see metrics.write_json)
+so the defaults in ENDPOINT_LIMITS can be tuned.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+# (initial, maximum) number of concurrent requests for the endpoints we know
+ENDPOINT_LIMITS = {
+    'nomads.ncep.noaa.gov': (1, 4),
+    # the 5 variables of download_hycom_ops share this one, and ran all at once before the controller
+    'tds.hycom.org': (5, 6),
+    'copernicusmarine': (2, 8),
+}
+DEFAULT_LIMITS = (2, 8)
+
+DECREASE = 0.5
+LATENCY_FACTOR = 3.
+MIN_SPIKE = 1.   # seconds above the best latency before a spike counts (small requests are noisy)
+THROTTLE_CODES = (429, 503)
+
+class Slot:
+    """
+    A request running in a slot of a controller
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.t0 = time.time()
+        self.nbytes = 0
+        self.released = False
+
+    def add_bytes(self, n):
+        self.nbytes += int(n)
+
+    def fail(self, reason='error', throttled=False):
+        """
+        Report a failed request (e.g. incomplete data, which doesn't raise) and give
+        the slot back straight away, so it isn't held while we back off
+        """
+        if not self.released:
+            self.released = True
+            self.controller._release(self, ok=False, reason=reason, throttled=throttled)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.released:
+            return False
+        self.released = True
+        if exc_type is None:
+            self.controller._release(self, ok=True)
+        else:
+            throttled = getattr(exc, 'code', None) in THROTTLE_CODES
+            self.controller._release(self, ok=False, reason=exc_type.__name__, throttled=throttled)
+        return False
+
+class AIMDController:
+    """
+    Concurrency limit for one endpoint, adjusted by additive increase / multiplicative decrease
+    """
+
+    def __init__(self, endpoint, initial=2, maximum=8, minimum=1):
+        self.endpoint = endpoint
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.in_flight = 0
+        self.decisions = []
+        self._cond = threading.Condition()
+        self._latency = None        # smoothed latency of successful requests
+        self._best_latency = None
+        self._window = []           # (start, end, bytes) of the successes since the last change
+        self._last_throughput = None
+        self._last_cut = 0.
+
+    def slot(self):
+        """
+        Wait for a free slot and return it (as a context manager)
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return Slot(self)
+
+    def _set_limit(self, limit, reason):
+        # called with the lock held
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit != self.limit:
+            self.decisions.append({'time': time.time(), 'endpoint': self.endpoint,
+                                   'from': self.limit, 'to': limit, 'reason': reason})
+            print(f'[concurrency] {self.endpoint}: {self.limit} -> {limit} ({reason})')
+            self.limit = limit
+            self._cond.notify_all()
+        self._window = []
+
+    def _release(self, slot, ok, reason=None, throttled=False):
+        end = time.time()
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+            if not ok:
+                self._decrease('throttled' if throttled else reason, end)
+                return
+
+            latency = end - slot.t0
+            self._latency = latency if self._latency is None else 0.7 * self._latency + 0.3 * latency
+            self._best_latency = min(self._best_latency or self._latency, self._latency)
+            if (self._latency > LATENCY_FACTOR * self._best_latency and
+                    self._latency - self._best_latency > MIN_SPIKE):
+                self._decrease(f'latency {self._latency:.1f} s vs {self._best_latency:.1f} s', end)
+                return
+
+            self._window.append((slot.t0, end, slot.nbytes))
+            if len(self._window) >= self.limit:
+                self._increase()
+
+    def _decrease(self, reason, now):
+        # one cut per window: requests which were already in flight when we cut
+        # shouldn't cut again
+        if now - self._last_cut < (self._latency or 0.):
+            return
+        self._last_cut = now
+        self._last_throughput = None
+        self._set_limit(int(self.limit * DECREASE), reason)
+
+    def _increase(self):
+        t0 = min(w[0] for w in self._window)
+        t1 = max(w[1] for w in self._window)
+        nbytes = sum(w[2] for w in self._window)
+        # bytes per second, or requests per second when the bytes aren't known
+        throughput = (nbytes or len(self._window)) / max(t1 - t0, 1e-6)
+        # compared with the throughput before the last increase, so noise doesn't ratchet the limit up
+        improved = self._last_throughput is None or throughput > 1.05 * self._last_throughput
+        if improved:
+            self._last_throughput = throughput
+        if improved and self.limit < self.maximum:
+            self._set_limit(self.limit + 1, f'throughput {throughput / (1e6 if nbytes else 1):.3g}'
+                                            f'{" MB/s" if nbytes else " req/s"}')
+        else:
+            self._window = []
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def endpoint_name(url):
+    """
+    The endpoint of a url (its host), or the name itself if it isn't a url e.g. 'copernicusmarine'
+    """
+    netloc = urlparse(url).netloc
+    if netloc:
+        return netloc
+    return 'local' if os.path.exists(url) else url
+
+def controller(url):
+    """
+    The (shared) controller of the endpoint serving url
+    """
+    endpoint = endpoint_name(url)
+    with _controllers_lock:
+        if endpoint not in _controllers:
+            initial, maximum = ENDPOINT_LIMITS.get(endpoint, DEFAULT_LIMITS)
+            # e.g. to stay below an agreed limit on a server
+            if os.environ.get('SOMISANA_MAX_CONCURRENCY'):
+                maximum = min(maximum, int(os.environ['SOMISANA_MAX_CONCURRENCY']))
+            _controllers[endpoint] = AIMDController(endpoint, initial, maximum)
+        return _controllers[endpoint]
+
+def decisions():
+    """
+    All the changes made to the limits so far
+    """
+    with _controllers_lock:
+        controllers = list(_controllers.values())
+    return sorted((d for c in controllers for d in c.decisions), key=lambda d: d['time'])
@@ -0,0 +1,281 @@
+"""
+Downloads for several named domains in one pass
+
+We need the same forcing for several nested or overlapping domains. Rather than
+running a subcommand once per domain (each sending its own requests for largely
+the same data), a subcommand given --domains downloads a small set of covering
+boxes once and then fans the data out locally into a directory per domain:
+    <outputDir>/<name>/...           the outputs, as a run with --domain would write them
+    <outputDir>/.domains/<box>/...   the downloads of the covering boxes
+The requests and bytes then scale with the area of the covering boxes rather
+than the sum of the domains.
+
+The covering boxes start as the domains themselves and two boxes are merged
+into their bounding box as long as it isn't more than MERGE_SLACK (25% by
+default, SOMISANA_DOMAIN_MERGE_SLACK) larger than the area they cover, so nested
+domains collapse into their parent while distant ones keep their own box.
+
+The domains are defined in a JSON file, {"name": [lon_min, lon_max, lat_min,
+lat_max], ...}, given by --domains_file or SOMISANA_DOMAINS (default
+~/.config/somisana/domains.json).
+
+Each output of a box is fanned out in a single pass over it:
+    - NetCDF files: the subsets of all the domains are written together through
+      one dask graph, so each chunk of the box file is read once
+    - grib files (GFS): a single wgrib2 call with a -small_grib per domain. Without
+      wgrib2 the box file is linked as is (a superset of the domain)
+    - Zarr stores: the time steps from the start of the run are appended to (or
+      overwritten in) the store of each domain
+    - any other file (e.g. the gfs.env of a GFS run): copied as is, since it
+      doesn't depend on the domain
+A file which was fanned out already (same size and modification time of the
+box file) is skipped, through the manifest of the domain directory.
+"""
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+from copy import copy
+from datetime import timedelta
+
+from download_tools.locking import atomic_write
+from download_tools.manifest import get_manifest
+from download_tools.metrics import track
+
+MERGE_SLACK = float(os.environ.get('SOMISANA_DOMAIN_MERGE_SLACK', 0.25))
+STAGING = '.domains'
+GRIB_EXTENSIONS = ('.grb', '.grb2', '.grib', '.grib2')
+
+def domains_path():
+    return os.environ.get('SOMISANA_DOMAINS',
+                          os.path.join(os.path.expanduser('~'), '.config', 'somisana', 'domains.json'))
+
+def load_domains(names, path=None):
+    """
+    The extents {name: [lon_min, lon_max, lat_min, lat_max]} of the named domains
+    """
+    path = path or domains_path()
+    with open(path) as f:
+        defined = json.load(f)
+    unknown = [n for n in names if n not in defined]
+    if unknown:
+        raise ValueError(f"Unknown domain(s) {', '.join(unknown)} (not in {path}, which has {', '.join(defined)})")
+    return {n: [float(x) for x in defined[n]] for n in names}
+
+def extent_key(domain):
+    # as in the names of the zarr stores (see zarr_store.store_name)
+    return '_'.join(f'{d:g}' for d in domain)
+
+def area(box):
+    return max(box[1] - box[0], 0.) * max(box[3] - box[2], 0.)
+
+def _intersection(a, b):
+    return [max(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3])]
+
+def _bounds(a, b):
+    return [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+
+def covering_boxes(domains):
+    """
+    Group the domains {name: extent} into covering boxes, returned as a list of
+    (box, [names]) where box is the bounding box of the named domains
+    """
+    groups = [(list(extent), [name], area(extent)) for name, extent in domains.items()]
+    while True:
+        best = None
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                (a, _, cover_a), (b, _, cover_b) = groups[i], groups[j]
+                box = _bounds(a, b)
+                # area covered by the two, counting their overlap once
+                cover = cover_a + cover_b - area(_intersection(a, b))
+                waste = area(box) - cover
+                if area(box) <= (1 + MERGE_SLACK) * cover and (best is None or waste < best[0]):
+                    best = (waste, i, j, box, cover)
+        if best is None:
+            return [(box, names) for box, names, _ in groups]
+        _, i, j, box, cover = best
+        merged = (box, groups[i][1] + groups[j][1], cover)
+        groups = [g for k, g in enumerate(groups) if k not in (i, j)] + [merged]
+
+def _since(args):
+    # start of the data of the run, for the zarr outputs
+    if getattr(args, 'start_date', None) is not None:
+        return args.start_date
+    if getattr(args, 'run_date', None) is not None:
+        # the ops downloads pad the hindcast with a day (see e.g. hycom_ops_dates)
+        return args.run_date - timedelta(days=(args.hdays or 0) + 1)
+    return None
+
+def _args_for(args, box, outputDir):
+    box_args = copy(args)
+    box_args.domain = box
+    box_args.outputDir = outputDir
+    box_args.domains = None
+    return box_args
+
+def _subset(ds, domain):
+    lon = 'lon' if 'lon' in ds.dims else 'longitude'
+    lat = 'lat' if 'lat' in ds.dims else 'latitude'
+    # either orientation of the coordinates
+    lons = slice(domain[0], domain[1]) if ds[lon][0] <= ds[lon][-1] else slice(domain[1], domain[0])
+    lats = slice(domain[2], domain[3]) if ds[lat][0] <= ds[lat][-1] else slice(domain[3], domain[2])
+    return ds.sel({lon: lons, lat: lats})
+
+def _fan_out_netcdf(src, targets):
+    import dask
+    import xarray as xr
+    from download_tools.encoding import get_policy, netcdf_encoding
+    from download_tools.profiling import span
+    policy = get_policy()
+    with xr.open_dataset(src) as ds:
+        # a time step at a time, shared by all the domains
+        ds = ds.chunk({'time': 1}) if 'time' in ds.dims else ds.chunk()
+        with contextlib.ExitStack() as stack:
+            writes = []
+            for path, domain in targets:
+                sub = _subset(ds, domain)
+                tmp = stack.enter_context(atomic_write(path))
+                writes.append(sub.to_netcdf(tmp, encoding=netcdf_encoding(sub, policy), compute=False))
+            with span('fan_out', 'write', file=os.path.basename(src), domains=len(targets)):
+                dask.compute(*writes)
+
+_warned = False
+
+def _fan_out_grib(src, targets):
+    global _warned
+    wgrib2 = shutil.which('wgrib2')
+    if wgrib2 is None:
+        if not _warned:
+            print('[domains] wgrib2 not found: the grib files of the box are kept whole for every domain')
+            _warned = True
+        for path, _ in targets:
+            with atomic_write(path) as tmp:
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copyfile(src, tmp)
+        return
+    with contextlib.ExitStack() as stack:
+        cmd = [wgrib2, src]
+        for path, domain in targets:
+            tmp = stack.enter_context(atomic_write(path))
+            cmd += ['-small_grib', f'{domain[0]}:{domain[1]}', f'{domain[2]}:{domain[3]}', tmp]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+def _fan_out_zarr(src, targets, since):
+    import xarray as xr
+    from download_tools.zarr_store import append_to_zarr
+    with xr.open_zarr(src) as ds:
+        if since is not None:
+            ds = ds.sel(time=slice(since, None))
+        for path, domain in targets:
+            append_to_zarr(_subset(ds, domain), path)
+
+def _outputs(staging):
+    """
+    The outputs under a box directory, as paths relative to it (hidden files and directories excluded)
+    """
+    for root, dirs, files in os.walk(staging):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for d in [d for d in dirs if d.endswith('.zarr')]:
+            dirs.remove(d)
+            yield os.path.relpath(os.path.join(root, d), staging)
+        for f in files:
+            if not f.startswith('.'):
+                yield os.path.relpath(os.path.join(root, f), staging)
+
+def _copy_auxiliary(src, targets):
+    """
+    Copy an output which doesn't depend on the domain (e.g. gfs.env) to each target,
+    unless it's there already (same size and modification time)
+    """
+    stat = os.stat(src)
+    for path in targets:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            dst = os.stat(path)
+            if dst.st_size == stat.st_size and dst.st_mtime == stat.st_mtime:
+                continue
+        except FileNotFoundError:
+            pass
+        with atomic_write(path) as tmp:
+            shutil.copy2(src, tmp)
+
+def fan_out(staging, box, domains, outputDir, since=None):
+    """
+    Write the outputs of the box downloaded to staging out to the directory of
+    each of the domains {name: extent} in outputDir
+    """
+    for rel in sorted(_outputs(staging)):
+        src = os.path.join(staging, rel)
+        if rel.endswith('.zarr'):
+            # the domain is part of the name of a store
+            targets = [(os.path.join(outputDir, name, rel.replace(extent_key(box), extent_key(extent))), extent)
+                       for name, extent in domains.items()]
+            with track('domains', rel, stage='fanout'):
+                _fan_out_zarr(src, targets, since)
+            continue
+        if not rel.endswith(('.nc',) + GRIB_EXTENSIONS):
+            _copy_auxiliary(src, [os.path.join(outputDir, name, rel) for name in domains])
+            continue
+
+        stat = os.stat(src)
+        params = {'from': os.path.abspath(src), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        targets = []
+        for name, extent in domains.items():
+            path = os.path.join(outputDir, name, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            manifest = get_manifest(os.path.dirname(path))
+            entry = manifest.get(path)
+            if entry is not None and manifest.is_complete(path) and \
+                    json.loads(entry['params'] or '{}') == dict(params, domain=extent):
+                continue
+            targets.append((path, extent))
+        if not targets:
+            continue
+        with track('domains', rel, stage='fanout') as m, contextlib.ExitStack() as downloads:
+            for path, extent in targets:
+                downloads.enter_context(get_manifest(os.path.dirname(path)).downloading(
+                    path, 'domains', params=dict(params, domain=extent)))
+            if rel.endswith(GRIB_EXTENSIONS):
+                _fan_out_grib(src, targets)
+            else:
+                _fan_out_netcdf(src, targets)
+            for path, extent in targets:
+                get_manifest(os.path.dirname(path)).record(path, 'domains', params=dict(params, domain=extent))
+                m.add_bytes(os.path.getsize(path))
+
+def download_domains(func, args):
+    """
+    Run the cli function func (a subcommand handler) for the named domains of
+    args.domains: once per covering box, then fanned out to a directory per domain
+    """
+    domains = load_domains(args.domains, args.domains_file)
+    boxes = covering_boxes(domains)
+    total = sum(area(d) for d in domains.values())
+    print(f"[domains] {len(domains)} domains in {len(boxes)} box(es), "
+          f"{sum(area(b) for b, _ in boxes) / total:.0%} of the area of separate downloads")
+    for box, names in boxes:
+        print(f"[domains] box {extent_key(box)} for {', '.join(names)}")
+        staging = os.path.join(args.outputDir, STAGING, extent_key(box))
+        os.makedirs(staging, exist_ok=True)
+        func(_args_for(args, box, staging))
+        fan_out(staging, box, {n: domains[n] for n in names}, args.outputDir, _since(args))
+
+def plan_domains(plan, args):
+    """
+    The plan (see planner.py) of a run for the named domains of args.domains: that of its covering boxes
+    """
+    domains = load_domains(args.domains, args.domains_file)
+    boxes = covering_boxes(domains)
+    total = None
+    for box, names in boxes:
+        p = plan(_args_for(args, box, args.outputDir))
+        if total is None:
+            total = p
+            total.title += f" ({len(domains)} domains in {len(boxes)} box(es))"
+        else:
+            total.extend(p)
+    return total
@@ -0,0 +1,225 @@
+"""
+Output encoding policy shared by all the writers: compression, chunking, float32
+downcasting and per-variable quantization
+
+Without an explicit encoding the merged outputs were written as uncompressed
+float32/float64. Every final write now goes through the same policy:
+    - compression : 'zlib' (default), 'zstd' (needs netCDF-C built with the zstd
+                    plugin) or 'none', at level complevel with the shuffle filter
+    - chunks      : chunk length per dimension, the whole dimension if it isn't
+                    listed (one time step and level at a time by default, which is
+                    how the model pre-processing reads the files)
+    - float32     : float64 data variables are written as float32
+    - variables   : quantization per variable, either least_significant_digit
+                    (a precision of 10**-digits in the units of the variable,
+                    e.g. 3 for 0.001 degC) or significant_digits with a
+                    quantize_mode (e.g. 'BitRound', for fields spanning orders
+                    of magnitude)
+Quantization zeros the bits below the requested precision, which is what lets
+the compression do its job on noisy float data. Variables which are already
+packed as integers (scale_factor/add_offset, e.g. the HYCOM THREDDS data) keep
+their packing, which is a quantization in itself, and are only compressed.
+Bit rounding applies to the whole field except _FillValue, so it
+shouldn't be used where missing values are flagged otherwise (as in
+ERA5_convert, with missing_value = 9999.).
+
+The policy can be changed without touching the code with a JSON file given by
+the SOMISANA_ENCODING environment variable, with any of the keys of POLICY, e.g.
+    {"compression": "zstd", "variables": {"thetao": {"least_significant_digit": 2}}}
+or only the compression with SOMISANA_COMPRESSION (e.g. 'none', to compare sizes
+and write times against uncompressed output).
+
+Each write reports the size the output would have had uncompressed, the size on
+disk and the write time, which also go into the metrics of the write (see
+metrics.track.set_encoding).
+"""
+import json
+import os
+import time
+
+from download_tools.profiling import span
+
+POLICY = {
+    'compression': 'zlib',
+    'complevel': 4,
+    'shuffle': True,
+    'float32': True,
+    'chunks': {'time': 1, 'depth': 1},
+    'variables': {
+        # ocean, as named by HYCOM and CMEMS
+        'water_temp': {'least_significant_digit': 3},   # 0.001 degC
+        'thetao': {'least_significant_digit': 3},
+        'bottomT': {'least_significant_digit': 3},
+        'salinity': {'least_significant_digit': 3},     # 0.001 psu
+        'so': {'least_significant_digit': 3},
+        'water_u': {'least_significant_digit': 3},      # 1 mm/s
+        'water_v': {'least_significant_digit': 3},
+        'uo': {'least_significant_digit': 3},
+        'vo': {'least_significant_digit': 3},
+        'surf_el': {'least_significant_digit': 4},      # 0.1 mm
+        'zos': {'least_significant_digit': 4},
+        # atmosphere, as named by ERA5_convert
+        'SST': {'least_significant_digit': 3},          # 0.001 K
+        'T2M': {'least_significant_digit': 3},
+        'U10M': {'least_significant_digit': 3},         # 1 mm/s
+        'V10M': {'least_significant_digit': 3},
+        'msl': {'least_significant_digit': 0},          # 1 Pa
+        'STRD': {'least_significant_digit': 2},         # 0.01 W m-2
+        'SSR': {'least_significant_digit': 2},
+        'TP': {'least_significant_digit': 8},           # 1e-8 kg m-2 s-1, i.e. 0.036 mm/h
+        'Q': {'least_significant_digit': 6},            # 1e-6 kg kg-1
+    },
+}
+
+# encoding keys of the source which are kept when the data is packed as integers
+PACKING_KEYS = ('dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value')
+
+def get_policy():
+    """
+    POLICY, with the overrides of SOMISANA_ENCODING and SOMISANA_COMPRESSION
+    """
+    policy = dict(POLICY, variables=dict(POLICY['variables']))
+    if os.environ.get('SOMISANA_ENCODING'):
+        with open(os.environ['SOMISANA_ENCODING']) as f:
+            override = json.load(f)
+        policy['variables'].update(override.pop('variables', {}))
+        policy.update(override)
+    if os.environ.get('SOMISANA_COMPRESSION'):
+        policy['compression'] = os.environ['SOMISANA_COMPRESSION']
+    return policy
+
+def _is_packed(encoding):
+    return 'scale_factor' in encoding or 'add_offset' in encoding
+
+def _chunksizes(dims, shape, policy):
+    return tuple(max(1, min(policy['chunks'].get(d, n), n)) for d, n in zip(dims, shape))
+
+def netcdf4_options(name, dims, shape, dtype, policy=None):
+    """
+    Keyword arguments of netCDF4's createVariable for a (float) variable written
+    directly with netCDF4 (e.g. in ERA5_convert)
+    """
+    policy = policy or get_policy()
+    opts = {}
+    if policy['compression'] == 'zlib':
+        opts.update(zlib=True, complevel=policy['complevel'], shuffle=policy['shuffle'])
+    elif policy['compression'] != 'none':
+        opts.update(compression=policy['compression'], complevel=policy['complevel'], shuffle=policy['shuffle'])
+    if len(dims):
+        opts['chunksizes'] = _chunksizes(dims, shape, policy)
+    if str(dtype).startswith('f'):
+        opts.update(policy['variables'].get(name, {}))
+    return opts
+
+def variable_encoding(name, da, policy=None):
+    """
+    The xarray (netCDF4 engine) encoding of a data variable
+    """
+    policy = policy or get_policy()
+    src = da.encoding
+    if _is_packed(src):
+        enc = {key: src[key] for key in PACKING_KEYS if key in src}
+    else:
+        enc = {key: src[key] for key in ('_FillValue', 'missing_value') if key in src}
+        if da.dtype.kind == 'f' and policy['float32']:
+            enc['dtype'] = 'float32'
+    shape = [da.sizes[d] for d in da.dims]
+    dtype = 'f' if da.dtype.kind == 'f' and not _is_packed(src) else 'i'
+    enc.update(netcdf4_options(name, da.dims, shape, dtype, policy))
+    return enc
+
+def netcdf_encoding(ds, policy=None):
+    """
+    The encoding of all the data variables of ds (the coordinates keep their own)
+    """
+    policy = policy or get_policy()
+    return {v: variable_encoding(v, ds[v], policy) for v in ds.data_vars}
+
+def _zarr_major():
+    import zarr
+    return int(zarr.__version__.split('.')[0])
+
+def zarr_encoding(name, da, policy=None):
+    """
+    The equivalent encoding for a new Zarr store (compressor and quantize filter):
+    the numcodecs codecs of the v2 format with zarr 2, the codecs of the v3
+    format (compressors and array-to-array filters) with zarr 3, where the
+    compressor key is refused
+    """
+    if _zarr_major() >= 3:
+        return _zarr3_encoding(name, da, policy)
+    import numcodecs
+    policy = policy or get_policy()
+    src = da.encoding
+    enc = {}
+    if _is_packed(src):
+        enc.update({key: src[key] for key in PACKING_KEYS if key in src})
+    elif da.dtype.kind == 'f':
+        dtype = 'float32' if policy['float32'] else str(da.dtype)
+        enc['dtype'] = dtype
+        quantize = policy['variables'].get(name, {})
+        if 'least_significant_digit' in quantize:
+            enc['filters'] = [numcodecs.Quantize(quantize['least_significant_digit'], dtype=dtype)]
+        elif quantize.get('quantize_mode') == 'BitRound':
+            enc['filters'] = [numcodecs.BitRound(quantize['significant_digits'])]
+    if policy['compression'] == 'zlib':
+        enc['compressor'] = numcodecs.Zlib(level=policy['complevel'])
+    elif policy['compression'] == 'zstd':
+        enc['compressor'] = numcodecs.Blosc(cname='zstd', clevel=policy['complevel'],
+                                            shuffle=numcodecs.Blosc.SHUFFLE if policy['shuffle']
+                                            else numcodecs.Blosc.NOSHUFFLE)
+    else:
+        enc['compressor'] = None
+    return enc
+
+def _zarr3_encoding(name, da, policy=None):
+    import numcodecs.zarr3
+    import zarr.codecs
+    policy = policy or get_policy()
+    src = da.encoding
+    enc = {}
+    if _is_packed(src):
+        enc.update({key: src[key] for key in PACKING_KEYS if key in src})
+    elif da.dtype.kind == 'f':
+        dtype = 'float32' if policy['float32'] else str(da.dtype)
+        enc['dtype'] = dtype
+        quantize = policy['variables'].get(name, {})
+        if 'least_significant_digit' in quantize:
+            enc['filters'] = [numcodecs.zarr3.Quantize(digits=quantize['least_significant_digit'], dtype=dtype)]
+        elif quantize.get('quantize_mode') == 'BitRound':
+            enc['filters'] = [numcodecs.zarr3.BitRound(keepbits=quantize['significant_digits'])]
+    if policy['compression'] == 'zlib':
+        enc['compressors'] = [zarr.codecs.GzipCodec(level=policy['complevel'])]
+    elif policy['compression'] == 'zstd':
+        enc['compressors'] = [zarr.codecs.BloscCodec(cname='zstd', clevel=policy['complevel'],
+                                                     shuffle='shuffle' if policy['shuffle'] else 'noshuffle')]
+    else:
+        enc['compressors'] = None
+    return enc
+
+def raw_size(ds):
+    """
+    Size of ds written without compression, at the dtype it would have had
+    without the policy (its source encoding, or its dtype in memory)
+    """
+    import numpy as np
+    return int(sum(ds[v].size * np.dtype(ds[v].encoding.get('dtype', ds[v].dtype)).itemsize
+                   for v in ds.variables))
+
+def write_netcdf(ds, path, m=None, **kwargs):
+    """
+    Write ds to path with the encoding policy, reporting the size reduction and
+    the write time (to the metrics of m, the track of the write, if given)
+    """
+    policy = get_policy()
+    t0 = time.time()
+    with span('to_netcdf', 'write', file=os.path.basename(str(path))):
+        ds.to_netcdf(path, encoding=netcdf_encoding(ds, policy), **kwargs)
+    report = {'compression': policy['compression'], 'raw_bytes': raw_size(ds),
+              'bytes': os.path.getsize(path), 'write': time.time() - t0}
+    report['ratio'] = report['raw_bytes'] / report['bytes'] if report['bytes'] else None
+    print(f"{os.path.basename(str(path))}: {report['raw_bytes'] / 1e6:.1f} MB -> {report['bytes'] / 1e6:.1f} MB "
+          f"({report['compression']}, {report['ratio'] or 0:.1f}x) written in {report['write']:.1f} s")
+    if m is not None:
+        m.set_encoding(report)
+    return report
@@ -5,9 +5,21 @@ import time
 import urllib
 import urllib.request
 from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
+from download_tools.manifest import get_manifest
+from download_tools import metrics
+from download_tools.metrics import track
+from download_tools import throttle
+from download_tools.concurrency import controller
+from download_tools.http_pool import urlopen
+from download_tools.locking import atomic_write
+from download_tools.profiling import traced
+from download_tools import gfs_mirrors, hedging
 
 """
 Download GFS forecast data
+Each file is fetched from the fastest of the mirrors of the GFS files (NOMADS and the cloud
+open-data buckets), failing over to the next mirror if it doesn't get through (see gfs_mirrors.py)
 The GFS model is initialised every 6 hours, and provides hourly forecasts
 For the historical data we download the forecast for hours 1 through 6 from each initialisation 
 The forecast data gets downloaded from the latest available initialisation
@@ -16,12 +28,17 @@ The latest initialisation is used at the time this is run, so that if there is a
 side then a slightly older initialization will be found
 """
 
+# base url of the NOMADS server (can be pointed at a local stand-in e.g. for benchmarking),
+# the first of the default mirrors
+NOMADS_URL = gfs_mirrors.MIRRORS[0]["url"]
+
 def time_param(dt):
     return dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "/atmos"
 
 def create_fname(dt, i):
     return dt.strftime("%Y%m%d") + dt.strftime("%H") + "_f" + str(i).zfill(3) + ".grb"
 
+@traced('validate', 'gfs')
 def validate_download_or_remove(fileout):
     if Path(fileout).stat().st_size < 1000:
         print(
@@ -41,62 +58,113 @@ def set_params(_params, dt, i):
     # return params
     return urllib.parse.urlencode(params)  # Encode the parameters
 
+def fetch_from(mirror, encoded_params, request, m, token=None):
+    """
+    Fetch a file from a mirror: through the filter CGI, or the byte ranges of its records
+    (aborted if token, see hedging.py, is cancelled)
+    """
+    url = mirror.filter_url(encoded_params) if mirror.filter else mirror.file_url(request["dir"], request["file"])
+    with controller(url).slot() as s:
+        if mirror.filter:
+            t0 = time.time()
+            with m.phase("wait"):
+                response = urlopen(url)  # Fetch data (on a warm connection, see http_pool.py)
+            if token is not None:
+                token.on_cancel(response.abort)
+            latency = time.time() - t0
+            t1 = time.time()
+            with m.phase("transfer"):
+                data = throttle.read(response)
+            seconds = time.time() - t1
+        else:
+            data, latency, seconds = gfs_mirrors.fetch_ranges(mirror, request, m, token)
+        s.add_bytes(len(data))
+    if token is not None:
+        token.check()   # aborted: data is truncated
+    mirror.success(latency, len(data), seconds)
+    return data
+
 def download_file(fname, outputDir, encoded_params):
-    url = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl?" + encoded_params  # Construct URL
     fileout = os.path.join(outputDir, fname)
-    if not os.path.isfile(fileout):
+    manifest = get_manifest(outputDir)
+    request = dict(urllib.parse.parse_qsl(encoded_params, keep_blank_values=True))
+    with track("gfs", fname) as m:
+        if manifest.already_downloaded(fileout, "gfs", legacy_check=os.path.isfile,
+                                      dataset="gfs_0p25", params=request):
+            print("File already exists", fileout)
+            m.set_status("skipped")
+            return
         max_retries = 3
         delay = 60
         download_success = False
-        for attempt in range(1,max_retries+1):
-            try:
-                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                print(f"[{now}] Downloading {fileout}")
-                response = urllib.request.urlopen(url)  # Fetch data
-                with open(fileout, 'wb') as f:
-                    f.write(response.read())
-                download_success = validate_download_or_remove(fileout)
-
-            except urllib.error.URLError as e:
-                print(f"Download of {fileout} failed: {e}")
-
-            if download_success:
-                return
-            elif attempt < max_retries:
-                print(f"Retrying {fileout} download in {delay} seconds...")
-                time.sleep(delay)
+        with manifest.downloading(fileout, "gfs", dataset="gfs_0p25", params=request):
+            _start = time.time()
+            for attempt in range(1,max_retries+1):
+                # the fastest mirror first, then the next one straight away if it doesn't get through
+                mirrors = gfs_mirrors.ranked(request)
+                for k, mirror in enumerate(mirrors):
+                    # a slow request is hedged on the next mirror, if it's up (see hedging.py)
+                    backup = mirrors[k + 1] if k + 1 < len(mirrors) and not mirrors[k + 1].is_down() else mirror
+                    try:
+                        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                        print(f"[{now}] Downloading {fileout} from {mirror.name}")
+                        data = hedging.run(mirror.url,
+                                           lambda token: fetch_from(mirror, encoded_params, request, m, token),
+                                           lambda token: fetch_from(backup, encoded_params, request, m, token))
+                        m.add_bytes(len(data))
+                        with m.phase("write"), atomic_write(fileout) as tmp:
+                            with open(tmp, 'wb') as f:
+                                f.write(data)
+                        download_success = validate_download_or_remove(fileout)
+                        if download_success:
+                            break
+                        mirror.failure("invalid file")
+                    except (urllib.error.URLError, OSError) as e:
+                        print(f"Download of {fileout} from {mirror.name} failed: {e}")
+                        mirror.failure(e)
+
+                if download_success:
+                    manifest.record(fileout, "gfs", dataset="gfs_0p25", params=request,
+                                    duration=time.time() - _start)
+                    return
+                elif attempt < max_retries:
+                    print(f"Retrying {fileout} download in {delay} seconds...")
+                    m.retry()
+                    with m.phase("backoff"):
+                        time.sleep(delay)
+            manifest.fail(fileout, "gfs", dataset="gfs_0p25", params=request,
+                          duration=time.time() - _start)
         raise RuntimeError(f"Failed to download {fname} after {max_retries} attempts")
-    else:
-        print("File already exists", fileout)
 
 def check_gfs_availability(dt, fhr=0):
     """
     Check if a GFS .idx file exists for a given datetime and forecast hour
     """
     fhr_str = str(fhr).zfill(3)
-    idx_url = (
-        "https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/gfs."
-        + dt.strftime("%Y%m%d")
-        + "/"
-        + dt.strftime("%H")
-        + "/atmos/gfs.t"
-        + dt.strftime("%H")
-        + "z.pgrb2.0p25.f"
-        + fhr_str
-        + ".idx"
-    )
+    directory = "/gfs." + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "/atmos"
+    fname = "gfs.t" + dt.strftime("%H") + "z.pgrb2.0p25.f" + fhr_str + ".idx"
 
-    try:
-        req = urllib.request.Request(idx_url, headers={"User-Agent": "Mozilla/5.0"})
-        with urllib.request.urlopen(req) as resp:
-            content = resp.read().decode("utf-8")
-            if len(content.strip()) > 0:
-                return True
-            else:
-                #print(f".idx file empty at {idx_url}")
-                return False
-    except (HTTPError, URLError) as e:
-        #print(f"Failed to access .idx file at {idx_url}: {e}")
+    with track("gfs", fname, stage="probe") as m:
+        # available if any mirror has it (the cloud buckets can lag behind NOMADS)
+        for mirror in gfs_mirrors.ranked():
+            idx_url = mirror.file_url(directory, fname)
+            try:
+                t0 = time.time()
+                with m.phase("wait"):
+                    resp = urlopen(idx_url, headers={"User-Agent": "Mozilla/5.0"})
+                mirror.success(time.time() - t0)
+                with resp:
+                    content = resp.read().decode("utf-8")
+                    m.add_bytes(len(content))
+                    if len(content.strip()) > 0:
+                        return True
+                    #print(f".idx file empty at {idx_url}")
+            except HTTPError as e:
+                #print(f"Failed to access .idx file at {idx_url}: {e}")
+                pass
+            except URLError as e:
+                mirror.failure(e)
+        m.set_status("unavailable")
         return False
 
 def get_latest_available_dt(dt, last_fhr=6):
@@ -124,26 +192,130 @@ def get_latest_available_dt(dt, last_fhr=6):
 
     return latest_available_date
 
+def max_workers():
+    # enough threads for the mirror allowing the most concurrent requests
+    return max(controller(m.url).maximum for m in gfs_mirrors.get_mirrors())
+
+def download_files(files, outputDir):
+    """
+    Download a list of (fname, encoded_params). The files are submitted to a pool
+    of threads, but the number actually downloading at once is set by the
+    concurrency controller for NOMADS (see concurrency.py), which backs off if
+    we get throttled
+    """
+    with ThreadPoolExecutor(max_workers=max_workers()) as pool:
+        futures = [pool.submit(metrics.in_scope(download_file), fname, outputDir, encoded_params) for fname, encoded_params in files]
+        for future in futures:
+            future.result()
+    gfs_mirrors.save_history()
+
 def download_hindcast(start, end, outputDir, params):
+    files = []
     while start < end:
         for i in range(1, 7):  # hours 1 to 6
-            download_file(create_fname(start, i), outputDir, set_params(params, start, i))
+            files.append((create_fname(start, i), set_params(params, start, i)))
         start = start + timedelta(hours=6)
+    download_files(files, outputDir)
 
 def download_forecast(total_forecast_hours, latest_available_date, outputDir, params):
+    files = []
     for i in range(1, total_forecast_hours + 1):
         if i > 120 and i % 3 != 0:
             continue  # GFS switches to 3-hourly output after f120
-        download_file(create_fname(latest_available_date, i), outputDir, set_params(params, latest_available_date, i))
+        files.append((create_fname(latest_available_date, i), set_params(params, latest_available_date, i)))
+    download_files(files, outputDir)
 
-def download_gfs_atm(domain, run_date, hdays, fdays, outputDir):
+def get_latest_started_dt(dt):
+    """
+    The newest cycle which has started publishing (i.e. its first forecast hour is out)
+    """
+    latest_started_date = datetime(dt.year, dt.month, dt.day, 18, 0, 0)
+    for _ in range(5):
+        print("Testing GFS publication: ", latest_started_date.strftime("%Y%m%d_%H"))
+        if check_gfs_availability(latest_started_date, fhr=1):
+            print("GFS data being published for: ", latest_started_date.strftime("%Y%m%d_%H"), "\n")
+            return latest_started_date
+        latest_started_date = latest_started_date + timedelta(hours=-6)
+    print("GFS data is not presently available")
+    exit(1)
+
+def wait_for_hour(cycle, fhr, deadline, poll=10., max_poll=120.):
+    """
+    Poll for the .idx of a forecast hour until it's published (True) or the deadline passes (False),
+    backing off from poll to max_poll seconds between checks
+    """
+    while not check_gfs_availability(cycle, fhr=fhr):
+        remaining = (deadline - datetime.now()).total_seconds()
+        if remaining <= 0:
+            return False
+        time.sleep(min(poll, remaining))
+        poll = min(poll * 1.5, max_poll)
+    return True
+
+def fallback_hour(fhr):
+    """
+    The forecast hour of the previous cycle standing in for forecast hour fhr: the
+    same valid time (6 hours further ahead), or the nearest published hour to it
+    past f120, where GFS output is only 3-hourly
+    """
+    fhr = fhr + 6
+    if fhr > 120:
+        fhr = 3 * round(fhr / 3)
+    return fhr
+
+def download_forecast_progressive(total_forecast_hours, cycle, outputDir, params, deadline):
+    """
+    Download the forecast hours of a cycle as they get published: each hour is
+    downloaded as soon as its .idx appears, while we poll for the next one. Hours
+    which still aren't out by the deadline are taken from the previous cycle
+    (the same valid time, at a 6 hour longer lead time, or the nearest hour it
+    has, see fallback_hour), saved under this cycle's file name so that the set
+    of files is complete.
+
+    Returns the list of hours which fell back to the previous cycle
+    """
+    previous = cycle - timedelta(hours=6)
+    fallbacks = []
+    with ThreadPoolExecutor(max_workers=max_workers()) as pool:
+        futures = []
+        for i in range(1, total_forecast_hours + 1):
+            if i > 120 and i % 3 != 0:
+                continue  # GFS switches to 3-hourly output after f120
+            if wait_for_hour(cycle, i, deadline):
+                futures.append(pool.submit(metrics.in_scope(download_file), create_fname(cycle, i), outputDir,
+                                           set_params(params, cycle, i)))
+            else:
+                fhr = fallback_hour(i)
+                print(f"f{str(i).zfill(3)} of {cycle.strftime('%Y%m%d_%H')} not published by the deadline, "
+                      f"using f{str(fhr).zfill(3)} of {previous.strftime('%Y%m%d_%H')}")
+                fallbacks.append(i)
+                futures.append(pool.submit(metrics.in_scope(download_file), create_fname(cycle, i), outputDir,
+                                           set_params(params, previous, fhr)))
+        for future in futures:
+            future.result()
+    gfs_mirrors.save_history()
+    return fallbacks
+
+def download_gfs_atm(domain, run_date, hdays, fdays, outputDir, progressive=False, deadline=None):
+    """
+    Download the GFS forcing for a run
+
+    By default we use the newest cycle which has finished publishing the forecast
+    hours we need. With progressive=True we use the newest cycle which has started
+    publishing instead, and download its forecast hours as they come out (see
+    download_forecast_progressive), until deadline (a datetime, default 2 hours
+    from now) after which any missing hours come from the previous cycle.
+    """
     _now = datetime.now()
     hdays = hdays + 0.25
     fdays = fdays + 0.25
     start_date = run_date + timedelta(days=-hdays)
 
     last_fhr = int(fdays * 24)
-    latest_available_date = get_latest_available_dt(run_date, last_fhr=last_fhr)
+    if progressive:
+        latest_available_date = get_latest_started_dt(run_date)
+    else:
+        latest_available_date = get_latest_available_dt(run_date, last_fhr=last_fhr)
     #latest_available_date = run_date ## FOR DEBUGGING - DELETE
     delta_days = (latest_available_date - run_date).total_seconds() / 86400
 
@@ -180,7 +352,13 @@ def download_gfs_atm(domain, run_date, hdays, fdays, outputDir):
     # Download forecast forcing files
     print("\nDOWNLOADING FORECAST files")
     total_forecast_hours = int((fdays - delta_days) * 24)
-    download_forecast(total_forecast_hours, latest_available_date, outputDir, params)    
+    fallbacks = []
+    if progressive:
+        deadline = deadline or _now + timedelta(hours=2)
+        fallbacks = download_forecast_progressive(total_forecast_hours, latest_available_date, outputDir,
+                                                  params, deadline)
+    else:
+        download_forecast(total_forecast_hours, latest_available_date, outputDir, params)    
 
     print("GFS download completed (in " + str(datetime.now() - _now) + " h:m:s)")
     
@@ -196,6 +374,9 @@ def download_gfs_atm(domain, run_date, hdays, fdays, outputDir):
                 "FDAYS=" + str(fdays) + "\n",
             ]
         )
+        if fallbacks:
+            # forecast hours of this cycle which were taken from the previous cycle
+            env.write("GFS_FALLBACK_HOURS=" + ",".join(str(i) for i in fallbacks) + "\n")
     try:
         os.chmod(gfs_env, 0o777)
     except:
@@ -0,0 +1,303 @@
+"""
+Mirrors of the GFS 0.25 deg grib files, ranked by how fast they serve us
+
+The same files are published on NOMADS and on the open-data buckets of the
+public clouds. Each mirror is either
+    - a filter mirror (NOMADS): the filter_gfs_0p25.pl CGI cuts the variables,
+      levels and subregion we ask for out of the file on the server
+    - a range mirror (e.g. AWS): only the files are served, so the records we
+      need are located in the .idx of the file and fetched with byte-range
+      requests. The records are global; they're cut to the domain with wgrib2
+      (-small_grib), so without wgrib2 the range mirrors are only used for
+      global files (a run mixing subsets and global files would have files on
+      different grids)
+
+The mirrors are configured with a JSON file given by SOMISANA_GFS_MIRRORS, a
+list of {"name", "url", "filter", "prefix"} where prefix is the path of the
+gfs.YYYYMMDD tree on the server (default MIRRORS below).
+
+Every file is fetched from the mirror expected to serve it the fastest: its
+latency plus the bytes it would send (a subset for a filter mirror, the global
+records for a range mirror) over its throughput. Both come from a quick probe of
+each mirror at the start of a run (an .idx, then a small byte range of a grib
+file), from every download since, and from the history of recent runs (kept in
+SOMISANA_MIRROR_HISTORY, default ~/.cache/somisana/gfs_mirrors.json). A mirror
+which fails is put aside for a cool-down (doubling with repeated failures) and
+the file is fetched from the next mirror straight away, so a slow or throttling
+NOMADS doesn't stall the run.
+"""
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from urllib.error import HTTPError, URLError
+
+from download_tools import throttle, transport
+from download_tools.http_pool import urlopen
+
+MIRRORS = [
+    {'name': 'nomads', 'url': os.environ.get('SOMISANA_NOMADS_URL', 'https://nomads.ncep.noaa.gov'),
+     'filter': True, 'prefix': '/pub/data/nccf/com/gfs/prod'},
+    {'name': 'aws', 'url': 'https://noaa-gfs-bdp-pds.s3.amazonaws.com', 'filter': False, 'prefix': ''},
+]
+
+PROBE_BYTES = 1 << 18
+PROBE_TIMEOUT = 10
+DEFAULT_THROUGHPUT = 2e6     # bytes per second, until a mirror has been measured
+ALPHA = 0.3                  # weight of a new measurement in the smoothed latency and throughput
+COOLDOWN = 60.               # seconds a mirror is put aside after a failure, doubled for each further failure
+MAX_COOLDOWN = 900.
+HISTORY_TTL = 86400.         # measurements from older runs are ignored
+
+# global grid of the 0.25 deg files, and bytes per point of a packed record (see planner.GFS_GRID)
+NPOINTS_GLOBAL = 1440 * 721
+BYTES_PER_POINT = 2
+
+def history_path():
+    return os.environ.get('SOMISANA_MIRROR_HISTORY',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'somisana', 'gfs_mirrors.json'))
+
+class Mirror:
+    def __init__(self, name, url, filter=False, prefix=''):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.filter = filter
+        self.prefix = prefix.rstrip('/')
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.down_until = 0.
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.name} ({self.url})'
+
+    def filter_url(self, encoded_params):
+        return f'{self.url}/cgi-bin/filter_gfs_0p25.pl?{encoded_params}'
+
+    def file_url(self, directory, fname):
+        # directory as in the filter parameters e.g. /gfs.20240110/00/atmos
+        return f'{self.url}{self.prefix}{directory}/{fname}'
+
+    def is_down(self):
+        return time.time() < self.down_until
+
+    def success(self, latency, nbytes=0, seconds=0.):
+        with self._lock:
+            self.latency = latency if self.latency is None else (1 - ALPHA) * self.latency + ALPHA * latency
+            if nbytes and seconds > 0:
+                throughput = nbytes / seconds
+                self.throughput = (throughput if self.throughput is None
+                                   else (1 - ALPHA) * self.throughput + ALPHA * throughput)
+            self.failures = 0
+            self.down_until = 0.
+
+    def failure(self, reason):
+        with self._lock:
+            self.failures += 1
+            cooldown = min(COOLDOWN * 2 ** (self.failures - 1), MAX_COOLDOWN)
+            self.down_until = time.time() + cooldown
+        print(f'[mirrors] {self.name} failed ({reason}), not used for {cooldown:.0f} s')
+
+    def expected_time(self, nbytes):
+        return (self.latency or 0.) + nbytes / (self.throughput or DEFAULT_THROUGHPUT)
+
+_mirrors = None
+_mirrors_lock = threading.Lock()
+
+def _load_config():
+    if os.environ.get('SOMISANA_GFS_MIRRORS'):
+        with open(os.environ['SOMISANA_GFS_MIRRORS']) as f:
+            return json.load(f)
+    return MIRRORS
+
+def _load_history(mirrors):
+    try:
+        with open(history_path()) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return
+    for mirror in mirrors:
+        h = history.get(mirror.url)
+        if h and time.time() - h['updated'] < HISTORY_TTL:
+            mirror.latency, mirror.throughput = h['latency'], h['throughput']
+
+def save_history():
+    """
+    Keep the measurements of this run for the next ones
+    """
+    if _mirrors is None:
+        return
+    path = history_path()
+    try:
+        with open(path) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = {}
+    for mirror in _mirrors:
+        if mirror.latency is not None:
+            history[mirror.url] = {'name': mirror.name, 'latency': mirror.latency,
+                                   'throughput': mirror.throughput, 'updated': time.time()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp, path)
+
+def probe(mirror, cycle):
+    """
+    Measure the latency (an .idx) and throughput (a small byte range of a grib file) of a mirror
+    """
+    fname = f"gfs.t{cycle:%H}z.pgrb2.0p25.f000"
+    url = mirror.file_url(f"/gfs.{cycle:%Y%m%d}/{cycle:%H}/atmos", fname)
+    try:
+        t0 = time.time()
+        with urlopen(url + '.idx', timeout=PROBE_TIMEOUT) as resp:
+            latency = time.time() - t0
+            resp.read()
+        t0 = time.time()
+        with urlopen(url, headers={'Range': f'bytes=0-{PROBE_BYTES - 1}'}, timeout=PROBE_TIMEOUT) as resp:
+            t1 = time.time()
+            nbytes = len(resp.read(PROBE_BYTES))
+            if resp.status == 200:
+                resp.close()   # the mirror ignored the range: don't read the whole file
+        mirror.success(latency, nbytes, max(time.time() - t1, 1e-6))
+    except (HTTPError, URLError, OSError) as e:
+        mirror.failure(f'probe: {e}')
+
+def get_mirrors():
+    """
+    The mirrors (probed the first time they're used in this process)
+    """
+    global _mirrors
+    with _mirrors_lock:
+        if _mirrors is None:
+            mirrors = [Mirror(**m) for m in _load_config()]
+            _load_history(mirrors)
+            if len(mirrors) > 1:
+                # yesterday's 00z cycle, which every mirror should have by now
+                cycle = (transport.utcnow() - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+                threads = [threading.Thread(target=probe, args=(m, cycle)) for m in mirrors]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                for m in mirrors:
+                    print(f'[mirrors] {m.name}: ' + ('down' if m.is_down() else
+                          f'latency {m.latency or 0:.2f} s, {(m.throughput or DEFAULT_THROUGHPUT) / 1e6:.1f} MB/s'))
+            _mirrors = mirrors
+        return _mirrors
+
+def _selection(params):
+    variables = {k[4:] for k in params if k.startswith('var_')}
+    levels = {k[4:].replace('_', ' ') for k in params if k.startswith('lev_')}
+    return variables, levels
+
+def estimate_bytes(params, mirror):
+    """
+    Bytes a mirror would send for a file: the subregion from a filter mirror, the global records otherwise
+    """
+    variables, levels = _selection(params)
+    nrecords = max(1, min(len(variables), 20))
+    if mirror.filter and 'leftlon' in params:
+        npoints = ((float(params['rightlon']) - float(params['leftlon'])) / 0.25 + 1) * \
+                  ((float(params['toplat']) - float(params['bottomlat'])) / 0.25 + 1)
+    else:
+        npoints = NPOINTS_GLOBAL
+    return nrecords * npoints * BYTES_PER_POINT
+
+_warned = False
+
+def ranked(params=None):
+    """
+    The mirrors, fastest first for a file with the filter parameters params (by latency only
+    if None), the ones in their cool-down last
+    """
+    global _warned
+    mirrors = get_mirrors()
+    if params is not None and 'leftlon' in params and shutil.which('wgrib2') is None:
+        if not _warned:
+            print('[mirrors] wgrib2 not found: only the mirrors with the filter CGI can cut the files to the domain')
+            _warned = True
+        mirrors = [m for m in mirrors if m.filter]
+        if not mirrors:
+            raise RuntimeError('wgrib2 is needed to cut the GFS files of range mirrors to the domain')
+    def cost(m):
+        return m.expected_time(estimate_bytes(params, m) if params is not None else 0)
+    return sorted(mirrors, key=lambda m: (m.is_down(), cost(m)))
+
+def idx_ranges(idx, params):
+    """
+    The byte ranges [(start, end or None)] of the records of an .idx matching the
+    variables and levels of the filter parameters, with adjacent records merged
+    """
+    variables, levels = _selection(params)
+    records = []
+    for line in idx.strip().splitlines():
+        fields = line.split(':')
+        records.append((int(fields[1]), fields[3], fields[4]))
+    ranges = []
+    for i, (offset, var, level) in enumerate(records):
+        if var not in variables or level not in levels:
+            continue
+        end = records[i + 1][0] - 1 if i + 1 < len(records) else None
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == offset:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((offset, end))
+    return ranges
+
+def crop(data, params):
+    """
+    Cut global grib records to the subregion of the filter parameters with wgrib2
+    (range mirrors aren't used for a subregion without it, see ranked)
+    """
+    if 'leftlon' not in params:
+        return data
+    wgrib2 = shutil.which('wgrib2')
+    if wgrib2 is None:
+        raise RuntimeError('wgrib2 is needed to cut the GFS records to the domain')
+    with tempfile.TemporaryDirectory() as tmp:
+        fin, fout = os.path.join(tmp, 'in.grb'), os.path.join(tmp, 'out.grb')
+        with open(fin, 'wb') as f:
+            f.write(data)
+        subprocess.run([wgrib2, fin, '-small_grib', f"{params['leftlon']}:{params['rightlon']}",
+                        f"{params['bottomlat']}:{params['toplat']}", fout],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(fout, 'rb') as f:
+            return f.read()
+
+def fetch_ranges(mirror, params, m, token=None):
+    """
+    Fetch the records of the file of the filter parameters params from a range
+    mirror, returning (data, latency, transfer seconds), with the time spent in
+    the phases of m (the track of the file, see metrics.py). The requests are
+    aborted if token (see hedging.py) is cancelled
+    """
+    url = mirror.file_url(params['dir'], params['file'])
+    t0 = time.time()
+    with m.phase('wait'), urlopen(url + '.idx') as resp:
+        latency = time.time() - t0
+        ranges = idx_ranges(resp.read().decode('utf-8'), params)
+    if not ranges:
+        raise URLError(f'none of the requested records are in {url}.idx')
+    chunks = []
+    t1 = time.time()
+    with m.phase('transfer'):
+        for start, end in ranges:
+            if token is not None:
+                token.check()
+            with urlopen(url, headers={'Range': f"bytes={start}-{'' if end is None else end}"}) as resp:
+                if token is not None:
+                    token.on_cancel(resp.abort)
+                data = throttle.read(resp)
+            if resp.status == 200:
+                # the mirror ignored the range
+                data = data[start:None if end is None else end + 1]
+            chunks.append(data)
+    seconds = time.time() - t1
+    return crop(b''.join(chunks), params), latency, seconds
@@ -0,0 +1,235 @@
+"""
+Hedged requests, to cut the latency tail of the downloads
+
+The merge of a run waits for its slowest file, and both THREDDS and NOMADS have
+long latency tails. With hedging on (the --hedge option of cli.py, or
+SOMISANA_HEDGE=1), a request which has been running for longer than the
+PERCENTILE (95th by default) of the recent completions of its endpoint gets a
+duplicate, and whichever finishes first wins. The other one is cancelled:
+    - HTTP requests (GFS) are aborted by shutting their socket down (see
+      http_pool.Response.abort). The duplicate goes to the next best mirror
+      when there is one (see gfs_mirrors.py)
+    - OPeNDAP requests (HYCOM) are hedged in a separate process, since the
+      netCDF library serialises all the reads of a process behind one lock (a
+      duplicate in a thread would only queue behind the slow read). The process
+      is terminated if it loses. A slow read in the download thread itself
+      can't be interrupted, so its result is dropped when it ends
+Attempts check their token before committing anything (e.g. renaming their
+output into place), so a loser which finishes late has no effect.
+
+The extra load on the public servers is bounded by a global budget: at most
+BUDGET (5% by default, SOMISANA_HEDGE_BUDGET) of the requests are hedged, and
+at most MAX_IN_FLIGHT hedges run at once. Nothing is hedged until an endpoint
+has MIN_SAMPLES completions, nor sooner than MIN_DELAY seconds. The hedges
+sent and won per endpoint go into the metrics report (see metrics.write_json).
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from download_tools.concurrency import endpoint_name
+
+ENABLED = os.environ.get('SOMISANA_HEDGE', '').lower() in ('1', 'true', 'yes')
+PERCENTILE = float(os.environ.get('SOMISANA_HEDGE_PERCENTILE', 95))
+BUDGET = float(os.environ.get('SOMISANA_HEDGE_BUDGET', 0.05))
+MAX_IN_FLIGHT = 2
+MIN_SAMPLES = 10
+MIN_DELAY = 1.
+WINDOW = 200          # completions kept per endpoint
+
+class Cancelled(Exception):
+    """
+    Raised by an attempt which lost to its duplicate
+    """
+
+class Token:
+    """
+    Handed to each attempt: cancelled once the other attempt has won, when the
+    callbacks registered with on_cancel (e.g. aborting a response) are called
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+class _Endpoint:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=WINDOW)
+        self.stats = {'endpoint': name, 'requests': 0, 'hedged': 0, 'hedge_won': 0}
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def delay(self):
+        """
+        How long to wait before hedging, None if there aren't enough completions yet
+        """
+        with self._lock:
+            if len(self.latencies) < MIN_SAMPLES:
+                return None
+            values = sorted(self.latencies)
+        return max(values[min(len(values) - 1, int(PERCENTILE / 100. * len(values)))], MIN_DELAY)
+
+_endpoints = {}
+_lock = threading.Lock()
+_requests = 0
+_hedges = 0
+_in_flight = 0
+
+def _endpoint(key):
+    name = endpoint_name(key)
+    with _lock:
+        if name not in _endpoints:
+            _endpoints[name] = _Endpoint(name)
+        return _endpoints[name]
+
+def _take_budget():
+    global _hedges, _in_flight
+    with _lock:
+        if _in_flight >= MAX_IN_FLIGHT or _hedges + 1 > BUDGET * _requests:
+            return False
+        _hedges += 1
+        _in_flight += 1
+        return True
+
+def _return_budget():
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+
+def run(key, attempt, hedge=None):
+    """
+    Run attempt(token), hedged with hedge(token) (attempt itself by default) if it's
+    slow, and return the result of the first one to succeed. key is the url of the
+    request, whose endpoint the latencies are tracked for
+    """
+    global _requests
+    endpoint = _endpoint(key)
+    with _lock:
+        _requests += 1
+    endpoint.count('requests')
+    delay = endpoint.delay() if ENABLED else None
+    if delay is None:
+        # not hedged: run in this thread as usual
+        t0 = time.time()
+        result = attempt(Token())
+        endpoint.add(time.time() - t0)
+        return result
+
+    done = queue.Queue()
+    tokens = {}
+    def go(name, fn):
+        token = tokens[name] = Token()
+        def target():
+            t0 = time.time()
+            try:
+                done.put((name, True, fn(token), time.time() - t0))
+            except BaseException as e:
+                done.put((name, False, e, time.time() - t0))
+        threading.Thread(target=target, name=f'{threading.current_thread().name}-{name}', daemon=True).start()
+
+    t_start = time.time()
+    go('primary', attempt)
+    running = 1
+    hedged = False
+    error = None
+    try:
+        item = done.get(timeout=delay)
+    except queue.Empty:
+        if _take_budget():
+            hedged = True
+            endpoint.count('hedged')
+            print(f'[hedge] {endpoint.name}: no answer after {delay:.1f} s, sending a duplicate request')
+            go('hedge', hedge or attempt)
+            running += 1
+        item = done.get()
+    try:
+        while True:
+            name, ok, value, seconds = item
+            running -= 1
+            if ok:
+                for other, token in tokens.items():
+                    if other != name:
+                        token.cancel()
+                endpoint.add(time.time() - t_start)
+                if name == 'hedge':
+                    endpoint.count('hedge_won')
+                    print(f'[hedge] {endpoint.name}: the duplicate won ({seconds:.1f} s)')
+                return value
+            error = error or value
+            if running == 0:
+                raise error
+            item = done.get()
+    finally:
+        if hedged:
+            _return_budget()
+
+def _child(conn, fn, args):
+    try:
+        result = (True, fn(*args))
+    except BaseException as e:
+        result = (False, RuntimeError(f'{type(e).__name__}: {e}'))
+    conn.send(result)
+    conn.close()
+
+def in_process(token, fn, *args):
+    """
+    Run fn(*args) in a new process (spawned, so it has its own netCDF library),
+    terminated if token is cancelled, and return its result
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=_child, args=(child, fn, args), daemon=True)
+    p.start()
+    child.close()
+    token.on_cancel(p.terminate)
+    try:
+        ok, value = parent.recv()
+    except EOFError:
+        raise Cancelled() if token.cancelled else RuntimeError(f'the process running {fn.__name__} died')
+    finally:
+        parent.close()
+        p.join()
+    if not ok:
+        raise value
+    return value
+
+def stats():
+    """
+    Requests, hedges and hedges won per endpoint
+    """
+    with _lock:
+        endpoints = list(_endpoints.values())
+    return [dict(e.stats) for e in endpoints if e.stats['hedged'] or ENABLED]
@@ -0,0 +1,151 @@
+"""
+Keep-alive HTTP connections shared by the downloaders
+
+urllib.request opens a new connection (and TLS handshake) for every request,
+which is a good part of the cost of the many small NOMADS requests. urlopen here
+takes an idle connection to the host from a shared pool instead, and gives it
+back once the response has been read to the end, so connections stay warm
+across the files of a run, and across jobs in the download daemon (see
+server.py). Errors are raised as in urllib (HTTPError for status >= 400,
+URLError when the connection fails), so callers can use either.
+
+When the traffic is recorded or replayed (see transport.py), the requests go
+through the cassette.
+"""
+import http.client
+import socket
+import threading
+import urllib.error
+from urllib.parse import urljoin, urlsplit
+
+from download_tools import transport
+from download_tools.profiling import span
+
+TIMEOUT = 60
+MAX_IDLE = 8          # idle connections kept per host
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+_idle = {}            # (scheme, netloc) -> idle connections
+_idle_lock = threading.Lock()
+
+def _get(key, timeout):
+    with _idle_lock:
+        conns = _idle.get(key)
+        if conns:
+            return conns.pop(), True
+    scheme, netloc = key
+    cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+    return cls(netloc, timeout=timeout), False
+
+def _put(key, conn):
+    with _idle_lock:
+        conns = _idle.setdefault(key, [])
+        if len(conns) < MAX_IDLE:
+            conns.append(conn)
+            return
+    conn.close()
+
+def idle_connections():
+    """
+    Number of idle (warm) connections per host
+    """
+    with _idle_lock:
+        return {netloc: len(conns) for (_, netloc), conns in _idle.items()}
+
+class Response:
+    """
+    File-like wrapper of an http.client response, which hands its connection
+    back to the pool once the body has been read
+    """
+
+    def __init__(self, url, key, conn, response):
+        self.url = url
+        self.status = self.code = response.status
+        self.headers = response.headers
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._released = False
+
+    def read(self, amt=None):
+        data = self._response.read() if amt is None else self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._response.isclosed() and not self._response.will_close:
+            _put(self._key, self._conn)
+        else:
+            self._conn.close()
+
+    def close(self):
+        self._release()
+
+    def abort(self):
+        """
+        Drop the connection, from another thread: a read in progress fails straight
+        away (e.g. the request lost to its duplicate, see hedging.py)
+        """
+        self._released = True
+        try:
+            self._conn.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def urlopen(url, headers=None, method='GET', timeout=TIMEOUT):
+    """
+    Open url on a pooled connection and return the response (see Response)
+    """
+    if transport.MODE is not None:
+        return transport.urlopen(url, headers, method, timeout, _urlopen)
+    return _urlopen(url, headers, method, timeout)
+
+def _urlopen(url, headers, method, timeout):
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        while True:
+            conn, reused = _get(key, timeout)
+            try:
+                if not reused:
+                    # DNS, TCP and TLS, separately from the request in the profile
+                    with span('connect', 'http', host=parts.netloc):
+                        conn.connect()
+                with span('request', 'http', host=parts.netloc, reused=reused):
+                    conn.request(method, target, headers=headers or {})
+                    response = conn.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                # a pooled connection may have been closed by the server while it was idle
+                if not reused:
+                    raise urllib.error.URLError(e)
+            except (socket.timeout, OSError) as e:
+                conn.close()
+                raise urllib.error.URLError(e)
+
+        if response.status in REDIRECT_CODES and response.getheader('Location'):
+            response.read()
+            Response(url, key, conn, response).close()
+            url = urljoin(url, response.getheader('Location'))
+            continue
+        if response.status >= 400:
+            body = Response(url, key, conn, response)
+            body.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        return Response(url, key, conn, response)
+    raise urllib.error.URLError(f'too many redirects for {url}')
@@ -8,39 +8,71 @@ from pathlib import Path
 import tempfile
 import threading
 import calendar
+import contextlib
+import json
+import shutil
 from glob import glob
-from time import sleep
+from time import sleep, time
+from download_tools.manifest import get_manifest
+from download_tools import metrics
+from download_tools.metrics import track
+from download_tools import hedging, memory, throttle, transport
+from download_tools.concurrency import controller
+from download_tools.encoding import write_netcdf
+from download_tools.locking import atomic_write, lease
+from download_tools.planner import gofs31_periods, hycom_days_per_request
+from download_tools.profiling import span, traced
+from download_tools.tiles import download_tiled
+from download_tools.zarr_store import append_to_zarr, store_covers, store_name
+
+# base url of the HYCOM THREDDS server (can be pointed at a local stand-in e.g. for benchmarking)
+HYCOM_THREDDS_URL = os.environ.get('SOMISANA_HYCOM_THREDDS', 'https://tds.hycom.org/thredds/dodsC')
+
+# variables and depth range downloaded for our operational runs
+HYCOM_OPS_VARS = ['salinity', 'water_temp', 'surf_el', 'water_u', 'water_v']
+HYCOM_OPS_DEPTHS = [0, 5000]
 
 def update_var_list(var_list,run_date):
     var_metadata = {
         'salinity': {
             "var_id": "salinity",
-            "dataset": "https://tds.hycom.org/thredds/dodsC/FMRC_ESPC-D-V02_s3z/FMRC_ESPC-D-V02_s3z_best.ncd",
+            "dataset": f"{HYCOM_THREDDS_URL}/FMRC_ESPC-D-V02_s3z/FMRC_ESPC-D-V02_s3z_best.ncd",
             "fname": f"hycom_salinity_{run_date.strftime('%Y%m%d_%H')}.nc",
             },
         'water_temp': {
             "var_id": "water_temp",
-            "dataset": "https://tds.hycom.org/thredds/dodsC/FMRC_ESPC-D-V02_t3z/FMRC_ESPC-D-V02_t3z_best.ncd",
+            "dataset": f"{HYCOM_THREDDS_URL}/FMRC_ESPC-D-V02_t3z/FMRC_ESPC-D-V02_t3z_best.ncd",
             "fname": f"hycom_water_temp_{run_date.strftime('%Y%m%d_%H')}.nc",
             },
         'surf_el': {
             "var_id": "surf_el",
-            "dataset": "https://tds.hycom.org/thredds/dodsC/FMRC_ESPC-D-V02_ssh/FMRC_ESPC-D-V02_ssh_best.ncd",
+            "dataset": f"{HYCOM_THREDDS_URL}/FMRC_ESPC-D-V02_ssh/FMRC_ESPC-D-V02_ssh_best.ncd",
             "fname": f"hycom_surf_el_{run_date.strftime('%Y%m%d_%H')}.nc",
             },
         'water_u': {
             "var_id": "water_u",
-            "dataset": "https://tds.hycom.org/thredds/dodsC/FMRC_ESPC-D-V02_u3z/FMRC_ESPC-D-V02_u3z_best.ncd",
+            "dataset": f"{HYCOM_THREDDS_URL}/FMRC_ESPC-D-V02_u3z/FMRC_ESPC-D-V02_u3z_best.ncd",
             "fname": f"hycom_water_u_{run_date.strftime('%Y%m%d_%H')}.nc",
             },
         'water_v': {
             "var_id": "water_v",
-            "dataset": "https://tds.hycom.org/thredds/dodsC/FMRC_ESPC-D-V02_v3z/FMRC_ESPC-D-V02_v3z_best.ncd",
+            "dataset": f"{HYCOM_THREDDS_URL}/FMRC_ESPC-D-V02_v3z/FMRC_ESPC-D-V02_v3z_best.ncd",
             "fname": f"hycom_water_v_{run_date.strftime('%Y%m%d_%H')}.nc",
             }
         }
     return {var: var_metadata[var] for var in var_list if var in var_metadata}
 
+def is_valid_netcdf_file(file_path):
+    try:
+        with xr.open_dataset(file_path) as _:
+            return True
+    except Exception:
+        return False
+
+# the metadata scan of the files being merged shows up in the profile (see profiling.py)
+open_mfdataset = traced('open_mfdataset', 'merge')(xr.open_mfdataset)
+
+@traced('decode', 'hycom')
 def decode_time_units(time_var):
     try:
         units = time_var.units
@@ -55,7 +87,72 @@ def decode_time_units(time_var):
     except Exception as e:
         raise RuntimeError(f"Error decoding time units: {e}")
 
-def download_hycom(dataset, var, start_date, end_date, domain, depths, outputDir, fname):
+def _steps_per_day(variable):
+    ndays = pd.DatetimeIndex(variable.time.values).normalize().unique().size
+    return max(1, round(variable.time.size / max(ndays, 1))), ndays
+
+def _days_per_slice(dataset, var, domain, depths, variable):
+    """
+    Days of daily means per slice of download_hycom: as many as fit in the request
+    size (see planner.py) and, with a memory budget, in memory (see memory.py)
+    """
+    steps, ndays = _steps_per_day(variable)
+    per = hycom_days_per_request(dataset, var, domain, depths, ndays)
+    # the raw (hourly or 3 hourly) data of a slice is loaded to average it
+    day_bytes = variable.nbytes / max(variable.time.size, 1) * steps
+    return memory.steps_per_chunk(day_bytes, copies=2, default=per)
+
+def _slices(variable, per):
+    """
+    The slices of per days of download_hycom, as (first day, start, stop) of
+    the range of raw (hourly or 3 hourly) time steps of each, so that each slice
+    is fetched in a request of its own
+    """
+    days = pd.DatetimeIndex(variable.time.values).normalize()
+    starts = days.unique()
+    return [(starts[k], days.searchsorted(starts[k]),
+             days.searchsorted(starts[k + per]) if k + per < len(starts) else len(days))
+            for k in range(0, len(starts), per)]
+
+def _daily_mean(variable):
+    """
+    Daily means of the raw data of a slice, once it's loaded
+    """
+    with span('resample', 'hycom', var=variable.name):
+        return variable.resample(time='1D').mean()
+
+def _fetch_slice(dataset, var, vars_to_drop, lat_range, lon_range, depth_range, first, last, path):
+    """
+    Download the raw data of a slice of download_hycom (the time steps from first
+    to last) to path, in a hedge process (see hedging.py), with a connection of its own
+    """
+    with transport.open_dataset(dataset, drop_variables=vars_to_drop, decode_times=False) as ds:
+        ds = ds.sel(lat=lat_range, lon=lon_range)
+        ds['time'] = decode_time_units(ds['time'])
+        variable = ds[var].sel(time=slice(first, last))
+        if variable.ndim == 4: variable = variable.sel(depth=depth_range)
+        with atomic_write(path) as tmp:
+            variable.to_netcdf(tmp)
+    return path
+
+def _load_file(path):
+    try:
+        return xr.load_dataarray(path)
+    finally:
+        os.remove(path)
+
+def download_hycom(dataset, var, start_date, end_date, domain, depths, outputDir, fname, tile_cache=None):
+    if tile_cache is not None:
+        # download the domain as tiles shared with other domains (see tiles.py)
+        key = f"{var}_{pd.Timestamp(start_date):%Y%m%d%H}_{pd.Timestamp(end_date):%Y%m%d%H}_{'_'.join(f'{d:g}' for d in depths)}"
+        record = dict(dataset=dataset, params={'var': var, 'domain': domain, 'depths': depths, 'tiled': True},
+                      time_start=start_date, time_end=end_date)
+        download_tiled('hycom', dataset, key, domain, outputDir, fname,
+                       lambda tile, tile_dir, tile_fname: download_hycom(dataset, var, start_date, end_date, tile,
+                                                                         depths, tile_dir, tile_fname),
+                       tile_cache, record)
+        return
+
     vars_to_drop = ['salinity_bottom', 'water_temp_bottom', 'water_u_bottom', 'water_v_bottom', 'tau', 'time_offset',
                     'time_run', 'time1_offset', 'sst', 'sss', 'ssu', 'ssv', 'sic', 'sih', 'siu', 'siv', 'surtx',
                     'surty', 'steric_ssh']
@@ -76,98 +173,211 @@ def download_hycom(dataset, var, start_date, end_date, domain, depths, outputDir
     if 'surf_el' in var: Nt = 361 # hourly for ssh
     else: Nt = 121                # three hourly for water_temp, salinity, water_u and water_v
 
-    if Path(outputDir, fname).exists(): print(f'\n{fname} already exist.\nDownload skipped.\n')
+    manifest = get_manifest(outputDir)
+    save_path = os.path.join(outputDir, fname)
+    record = dict(dataset=dataset, params={'var': var, 'domain': domain, 'depths': depths},
+                  time_start=start_date, time_end=end_date)
+    if manifest.already_downloaded(save_path, 'hycom', legacy_check=os.path.exists, **record):
+        print(f'\n{fname} already exist.\nDownload skipped.\n')
+        with track('hycom', fname) as m:
+            m.set_status('skipped')
     else:
-        i = 1
-        MAX_TRIES = 20
-        success = False
-        while i <= MAX_TRIES:
-            # Phase 1: open dataset and verify time coverage
-            ds = None
-            try:
-                ds = xr.open_dataset(
-                    dataset,
-                    drop_variables=vars_to_drop,
-                    decode_times=False
-                    ).sel(lat=lat_range, lon=lon_range)
-                try:
-                    ds['time'] = decode_time_units(ds['time'])
-                    print(f"[Try {i}] Decoded the times.")
-                    if np.unique(ds['time']).size < Nt:
-                        print(f"[Try {i}] Incomplete time coverage.")
-                        ds.close()
+        with track('hycom', fname) as m, manifest.downloading(save_path, 'hycom', **record):
+            _start = time()
+            i = 1
+            MAX_TRIES = 20
+            success = False
+            while i <= MAX_TRIES:
+                with controller(dataset).slot() as s:
+                    # Phase 1: open dataset and verify time coverage
+                    ds = None
+                    try:
+                        with m.phase('wait'):
+                            ds = transport.open_dataset(
+                                dataset,
+                                drop_variables=vars_to_drop,
+                                decode_times=False
+                                ).sel(lat=lat_range, lon=lon_range)
+                        try:
+                            with m.phase('wait'):
+                                ds['time'] = decode_time_units(ds['time'])
+                            print(f"[Try {i}] Decoded the times.")
+                            if np.unique(ds['time']).size < Nt:
+                                print(f"[Try {i}] Incomplete time coverage.")
+                                s.fail('incomplete time coverage')
+                                ds.close()
+                                i += 1
+                                m.retry()
+                                with m.phase('backoff'):
+                                    sleep(5)
+                                continue
+                        except Exception as e:
+                            print(f"[Try {i}] Time decoding failed: {e}")
+                            s.fail('time decoding failed')
+                            ds.close()
+                            i += 1
+                            m.retry()
+                            with m.phase('backoff'):
+                                sleep(5)
+                            continue
+                    except Exception as e:
+                        print(f"[Try {i}] Dataset open failed: {e}")
+                        s.fail('open failed')
+                        if ds is not None:
+                            ds.close()
                         i += 1
-                        sleep(5)
+                        m.retry()
+                        with m.phase('backoff'):
+                            sleep(5)
                         continue
-                except Exception as e:
-                    print(f"[Try {i}] Time decoding failed: {e}")
-                    ds.close()
-                    i += 1
-                    sleep(5)
-                    continue
-            except Exception as e:
-                print(f"[Try {i}] Dataset open failed: {e}")
-                if ds is not None:
-                    ds.close()
-                i += 1
-                sleep(5)
-                continue
 
-            # Phase 2: download timesteps and validate data
-            variable = ds[var].sel(time=slice(start_date,end_date))
+                    # Phase 2: download timesteps and validate data
+                    variable = ds[var].sel(time=slice(start_date,end_date))
 
-            if variable.ndim == 4: variable = variable.sel(depth=depth_range)
+                    if variable.ndim == 4: variable = variable.sel(depth=depth_range)
 
-            variable = variable.resample(time='1D').mean()
+                    per = _days_per_slice(dataset, var, domain, depths, variable)
 
-            tmp_dir = Path(tempfile.mkdtemp())
-            time_slices = []
+                    tmp_dir = Path(tempfile.mkdtemp())
+                    time_slices = []
 
-            try:
-                has_nan = False
-                for t in range(variable.time.values.size):
                     try:
-                        # Save temporary file
-                        time_str = pd.to_datetime(variable.time.values[t]).strftime("%Y-%m-%d")
-                        tmp_file = tmp_dir / f"{var}_{time_str}.nc"
-                        v=variable.isel(time=slice(t, t+1))
-                        v.load()
-                        # Check if the data is all NaN (server returned fill values)
-                        if np.all(np.isnan(v.values)):
-                            print(f"[Try {i}] WARNING: {var} at {time_str} is all NaN")
-                            has_nan = True
-                            break
-                        v.to_netcdf(tmp_file)
-                        time_slices.append(tmp_file)
-                    except Exception as e:
-                        print(f"Failed to download time {t}: {e}")
-
-                if has_nan:
-                    print(f"[Try {i}] Data not fully available yet. Retrying in 5 minutes...")
-                    i += 1
-                    sleep(300)
-                    continue
-
-                # Combine time slices
-                with xr.open_mfdataset(time_slices, combine='by_coords') as combined:
-                    combined = combined.sortby('time')
-                    save_path = os.path.join(outputDir, fname)
-                    combined = combined.sel(time=slice(start_date, end_date))
-                    combined.to_netcdf(save_path)
-                success = True
-                break
-
-            finally:
-                ds.close()
-                for f in time_slices:
-                    f.unlink()
-                if tmp_dir.exists():
-                    tmp_dir.rmdir()
+                        has_nan = False
+                        # the points with data in any time step so far: the ocean, which doesn't change
+                        # with time (none in a tile entirely over land, which is all NaN and complete)
+                        ocean = None
+                        for k, (day, start, stop) in enumerate(_slices(variable, per)):
+                            t = k * per
+                            try:
+                                # Save temporary file
+                                time_str = day.strftime("%Y-%m-%d")
+                                tmp_file = tmp_dir / f"{var}_{time_str}.nc"
+                                # still lazy: only the raw data of the slice is requested
+                                window = variable.isel(time=slice(start, stop))
+                                with m.phase('transfer'):
+                                    # hedged in a separate process if it's slow (see hedging.py)
+                                    hedge_file = tmp_dir / f"{var}_{time_str}.hedge.nc"
+                                    # the hedge fetches the same raw time steps as the window
+                                    first, last = window.time.values[0], window.time.values[-1]
+                                    raw = hedging.run(dataset, lambda token, w=window: w.load(),
+                                                      lambda token: _load_file(hedging.in_process(
+                                                          token, _fetch_slice, dataset, var, vars_to_drop,
+                                                          lat_range, lon_range, depth_range, first, last,
+                                                          str(hedge_file))))
+                                    throttle.consume(raw.nbytes)
+                                # the bytes which came over the network, before averaging
+                                m.add_bytes(raw.nbytes)
+                                s.add_bytes(raw.nbytes)
+                                v = _daily_mean(raw)
+                                # Check if the data of any day is all NaN over the ocean (server returned fill values)
+                                with span('validate', 'hycom', var=var):
+                                    has_data = raw.notnull().any(dim='time')
+                                    ocean = has_data if ocean is None else ocean | has_data
+                                    all_nan = bool(ocean.any()) and \
+                                        bool(v.isnull().all(dim=[d for d in v.dims if d != 'time']).any())
+                                if all_nan:
+                                    print(f"[Try {i}] WARNING: {var} from {time_str} has all NaN days")
+                                    has_nan = True
+                                    break
+                                with m.phase('write'):
+                                    v.to_netcdf(tmp_file)
+                                time_slices.append(tmp_file)
+                            except Exception as e:
+                                print(f"Failed to download time {t}: {e}")
+
+                        if has_nan:
+                            print(f"[Try {i}] Data not fully available yet. Retrying in 5 minutes...")
+                            s.fail('all NaN data')
+                            i += 1
+                            m.retry()
+                            with m.phase('backoff'):
+                                sleep(300)
+                            continue
+
+                        # Combine time slices
+                        with m.phase('write'), open_mfdataset(time_slices, combine='by_coords', chunks=memory.file_chunks(time_slices)) as combined:
+                            combined = combined.sortby('time')
+                            combined = combined.sel(time=slice(start_date, end_date))
+                            with atomic_write(save_path) as tmp:
+                                combined.to_netcdf(tmp)
+                        manifest.record(save_path, 'hycom', duration=time() - _start, **record)
+                        success = True
+                        break
+
+                    finally:
+                        ds.close()
+                        for f in time_slices:
+                            f.unlink()
+                        if tmp_dir.exists():
+                            tmp_dir.rmdir()
 
-        if not success:
-            raise RuntimeError(f"Failed to download valid data for {var} after {MAX_TRIES} attempts.")
+            if not success:
+                manifest.fail(save_path, 'hycom', duration=time() - _start, **record)
+                raise RuntimeError(f"Failed to download valid data for {var} after {MAX_TRIES} attempts.")
 
-def download_hycom_ops(domain, run_date, hdays, fdays, outputDir, parallel=True):
+def find_previous_run(dataset, var, run_date, domain, depths, dirs):
+    """
+    The most recent ops file hycom_<var>_<date>.nc from before run_date in any of dirs,
+    with the same dataset, domain and depths according to its manifest, or None
+    """
+    candidates = []
+    for d in dirs:
+        manifest = get_manifest(d)
+        for path in glob(os.path.join(d, f'hycom_{var}_*.nc')):
+            try:
+                prev_date = datetime.strptime(os.path.basename(path)[len(f'hycom_{var}_'):-3], '%Y%m%d_%H')
+            except ValueError:
+                continue
+            if prev_date >= run_date or not manifest.is_complete(path):
+                continue
+            params = json.loads(manifest.get(path)['params'] or '{}')
+            if (manifest.get(path)['dataset'] == dataset and params.get('domain') == list(domain)
+                    and params.get('depths') == list(depths)):
+                candidates.append((prev_date, path))
+    return max(candidates) if candidates else None
+
+def download_hycom_reusing(dataset, var, start_date, end_date, domain, depths, outputDir, fname,
+                           run_date, reuse_dirs, tile_cache=None):
+    """
+    Download a variable for an ops run, reusing the days we already have from the
+    previous ops run: the days before the previous run date were analysis days
+    then and are taken from its file, the rest (the new days and the forecast,
+    which has been updated since) is downloaded and appended
+    """
+    manifest = get_manifest(outputDir)
+    save_path = os.path.join(outputDir, fname)
+    record = dict(dataset=dataset, params={'var': var, 'domain': domain, 'depths': depths},
+                  time_start=start_date, time_end=end_date)
+    if manifest.already_downloaded(save_path, 'hycom', legacy_check=os.path.exists, **record):
+        print(f'\n{fname} already exist.\nDownload skipped.\n')
+        return
+
+    with manifest.downloading(save_path, 'hycom', **record):
+        previous = find_previous_run(dataset, var, pd.Timestamp(run_date), domain, depths, reuse_dirs)
+        # the first day we still need to download
+        new_start = pd.Timestamp(previous[0]).floor('D') if previous else None
+        if previous is None or new_start <= pd.Timestamp(start_date).floor('D'):
+            download_hycom(dataset, var, start_date, end_date, domain, depths, outputDir, fname, tile_cache)
+            return
+        print(f'Reusing {var} up to {new_start:%Y-%m-%d} from {previous[1]}')
+
+        tmp_dir = tempfile.mkdtemp(prefix=f'.hycom_{var}_', dir=outputDir)
+        try:
+            download_hycom(dataset, var, new_start, end_date, domain, depths, tmp_dir, fname, tile_cache)
+            with track('hycom', fname, stage='merge') as m, \
+                    xr.open_dataset(previous[1]) as ds_prev, \
+                    xr.open_dataset(os.path.join(tmp_dir, fname)) as ds_new:
+                ds_old = ds_prev.sel(time=slice(pd.Timestamp(start_date).floor('D'), new_start - timedelta(seconds=1)))
+                with m.phase('write'), atomic_write(save_path) as tmp:
+                    xr.concat([ds_old, ds_new], dim='time').to_netcdf(tmp)
+                m.add_bytes(os.path.getsize(save_path))
+            record['params']['reused_from'] = os.path.basename(previous[1])
+            manifest.record(save_path, 'hycom', **record)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def download_hycom_ops(domain, run_date, hdays, fdays, outputDir, parallel=True, output_format='nc',
+                       tile_cache=None, reuse=False, reuse_dir=None):
     """
     Downloads the HYCOM analysis variables (salinity, water_temp, surf_el, water_u and water_v) required 
     to run our forecast models. The variables are stored in daily outputs.
@@ -179,73 +389,105 @@ def download_hycom_ops(domain, run_date, hdays, fdays, outputDir, parallel=True)
     fdays     : Days to forecast (e.g. fdays=5).
     outputDir : Directory to save the downloaded data (eg. outputDir='/path/and/directory/to/save/').
     parallel  : Default is True = parallel download. False = downloading in series.
+    output_format : 'nc' (default) or 'zarr' (see merge_hycom_ops).
+    tile_cache : Directory of the tile cache shared between domains (see tiles.py), None to download the domain as is.
+    reuse     : Reuse the analysis days of the most recent previous ops run in outputDir (and reuse_dir if given),
+                only downloading the days since then (see download_hycom_reusing).
+    reuse_dir : Another directory to look for previous ops runs in (e.g. a shared cache).
     OUTPUT:
     NetCDF file containing the most recent HYCOM forcast run.
     """
 
-    # We add an additional day to ensure that it exceeds the model run time.    
-    hdays,fdays = hdays + 1, fdays + 1
-    start_date = pd.Timestamp(run_date) - timedelta(days=hdays)
-    end_date = pd.Timestamp(run_date) + timedelta(days=fdays)
+    start_date, end_date = hycom_ops_dates(run_date, hdays, fdays)
     
     # This function creates a metadata dictionary which comtains information about the variables. 
     # we are intersted in downloading
-    VARIABLES = update_var_list(['salinity', 'water_temp', 'surf_el', 'water_u', 'water_v'],
-                                run_date)
-    
-    # Define depth to download
-    depths=[0,5000]
-    
-    # Downloading in series
-    if not parallel:
-        for var in VARIABLES:
+    VARIABLES = update_var_list(HYCOM_OPS_VARS, run_date)
+    reuse_dirs = [outputDir] + ([reuse_dir] if reuse_dir else [])
+
+    def download_worker(var):
+        if reuse:
+            download_hycom_reusing(VARIABLES[var]["dataset"], VARIABLES[var]["var_id"], start_date, end_date,
+                                   domain, HYCOM_OPS_DEPTHS, outputDir, VARIABLES[var]["fname"],
+                                   run_date, reuse_dirs, tile_cache)
+        else:
             download_hycom(VARIABLES[var]["dataset"], 
                            VARIABLES[var]["var_id"], 
                            start_date, 
                            end_date, 
                            domain, 
-                           depths, 
+                           HYCOM_OPS_DEPTHS, 
                            outputDir, 
-                           VARIABLES[var]["fname"]
+                           VARIABLES[var]["fname"],
+                           tile_cache
                            )
     
+    # Downloading in series
+    if not parallel:
+        for var in VARIABLES:
+            download_worker(var)
+    
     # Downloading in parallel
     else:
-        def download_worker(var):
-            download_hycom(VARIABLES[var]["dataset"], 
-                           VARIABLES[var]["var_id"], 
-                           start_date, 
-                           end_date, 
-                           domain, 
-                           depths, 
-                           outputDir, 
-                           VARIABLES[var]["fname"]
-                           )
         threads = []
     
+        # the threads all start together, the THREDDS concurrency controller decides
+        # how many are downloading at once (see concurrency.py)
         for var in VARIABLES:
-            t = threading.Thread(target=download_worker, args=(var,))
+            t = threading.Thread(target=metrics.in_scope(download_worker), args=(var,))
             threads.append(t)
             t.start()
-            sleep(2)
         # Wait for all threads to finish
         for t in threads:
             t.join()
         
+    merge_hycom_ops(domain, run_date, start_date, end_date, outputDir, output_format)
+
+def hycom_ops_dates(run_date, hdays, fdays):
+    """
+    Start and end dates of the download for an operational run
+    """
+    # We add an additional day to ensure that it exceeds the model run time.    
+    hdays,fdays = hdays + 1, fdays + 1
+    start_date = pd.Timestamp(run_date) - timedelta(days=hdays)
+    end_date = pd.Timestamp(run_date) + timedelta(days=fdays)
+    return start_date, end_date
+
+def merge_hycom_ops(domain, run_date, start_date, end_date, outputDir, output_format='nc'):
+    """
+    Merge the per-variable files of an operational run into HYCOM_<run_date>.nc
+
+    With output_format='zarr' the run is written to HYCOM_ops_<domain>.zarr
+    instead: the days we already have from previous runs are overwritten with
+    this run's (more recent) data and the new days are appended
+    """
     output_dir = Path(outputDir)  
-    files = sorted(output_dir.glob("hycom_*.nc"))
+    VARIABLES = update_var_list(HYCOM_OPS_VARS, run_date)
+    files = sorted(output_dir / VARIABLES[var]["fname"] for var in VARIABLES
+                   if (output_dir / VARIABLES[var]["fname"]).exists())
     # We ensure that all the variables have been saved before merginf it.
     # If there is a file missing, then the function will fail. 
     # in our operational workflow, it will restart the download automatically. 
-    if len(files) == 5:       
-        with xr.open_mfdataset(files, combine="by_coords") as ds:
-            outfile = output_dir / f"HYCOM_{run_date.strftime('%Y%m%d_%H')}.nc"
-            
-            # Remove if exists
-            if outfile.exists(): outfile.unlink()
-            
-            ds.to_netcdf(outfile, mode="w")
-            outfile.chmod(0o775)
+    if len(files) == 5 and output_format == 'zarr':
+        store = store_name(outputDir, 'HYCOM_ops', domain)
+        with track('hycom', os.path.basename(store), stage='merge') as m, \
+                open_mfdataset(files, combine="by_coords", chunks=memory.file_chunks(files)) as ds:
+            with m.phase('write'):
+                append_to_zarr(ds, store)
+        print(f"\nAdded {run_date.strftime('%Y%m%d_%H')} to {store}.\n")
+
+    elif len(files) == 5:       
+        outfile = output_dir / f"HYCOM_{run_date.strftime('%Y%m%d_%H')}.nc"
+        # another run merging the same files waits for us, and readers only ever see a complete file
+        with lease(outfile), track('hycom', outfile.name, stage='merge') as m, \
+                open_mfdataset(files, combine="by_coords", chunks=memory.file_chunks(files)) as ds:
+            with m.phase('write'), atomic_write(outfile) as tmp:
+                write_netcdf(ds, tmp, m, mode="w")
+                os.chmod(tmp, 0o775)
+            m.add_bytes(outfile.stat().st_size)
+            get_manifest(outputDir).record(outfile, 'hycom', dataset='HYCOM',
+                                           params={'merged': [f.name for f in files], 'domain': domain},
+                                           time_start=start_date, time_end=end_date)
         
         print("\nFiles downloaded successfully.")
         print(f"\nCreated {outfile} successfully.\n")
@@ -253,35 +495,47 @@ def download_hycom_ops(domain, run_date, hdays, fdays, outputDir, parallel=True)
     else:
         raise RuntimeError(f"Expected 5 files, found {len(files)} — download/s may have failed.")
 
-def _download_day(dataset_url, day_start, day_end, var_list, depth_range,
-                  surface, lon_range, lat_range, vars_to_drop, tmp_dir):
+# default variables of the GOFS 3.1 3-hourly and hourly surface datasets
+GOFS31_VARS = ['surf_el', 'water_temp', 'salinity', 'water_u', 'water_v']
+GOFS31_SURFACE_VARS = ['ssh', 'qtot', 'emp', 'steric_ssh',
+                       'u_barotropic_velocity', 'v_barotropic_velocity',
+                       'surface_boundary_layer_thickness', 'mixed_layer_thickness']
+
+def gofs31_dataset(year, var_list=None, surface=False):
     """
-    Download a single day's data by opening its own OPeNDAP connection.
-    Each thread gets an independent netCDF4 handle to avoid segfaults.
-    Returns the path to the temp file, or None on failure.
+    The OPeNDAP url of the GOFS 3.1 data for a year and the variables to download
     """
-    day_str = day_start.strftime('%Y-%m-%d')
-    tmp_file = os.path.join(tmp_dir, f'{day_str}.nc')
+    if surface:
+        return f"{HYCOM_THREDDS_URL}/GLBy0.08/expt_93.0/sur/{year}", var_list or GOFS31_SURFACE_VARS
+    return f"{HYCOM_THREDDS_URL}/GLBy0.08/expt_93.0", var_list or GOFS31_VARS
 
-    # skip if already downloaded (e.g. from a previous partial run)
-    if os.path.exists(tmp_file):
-        return tmp_file
+# reads through the netCDF library of this process (see hedging.py): a primary attempt
+# which lost to its hedge keeps reading, and the next one waits for it
+_opendap_lock = threading.Lock()
 
-    MAX_RETRIES = 3
-    for attempt in range(1, MAX_RETRIES + 1):
+def _fetch_day(dataset_url, day_start, day_end, var_list, depth_range, surface,
+               lon_range, lat_range, vars_to_drop, tmp_file, m=None, token=None):
+    """
+    Open the dataset and write the data of a day (or part of a day) to tmp_file,
+    returning the bytes downloaded, or None if the day isn't in the dataset.
+    The file is only moved into place if token (see hedging.py) wasn't cancelled.
+    Top level so that it can be run in a hedge process (without m)
+    """
+    phase = m.phase if m is not None else (lambda name: contextlib.nullcontext())
+    with _opendap_lock:
         ds = None
         try:
-            ds = xr.open_dataset(
-                dataset_url,
-                drop_variables=vars_to_drop,
-                decode_times=False
-            )
-            ds['time'] = decode_time_units(ds['time'])
+            with phase('wait'):
+                ds = transport.open_dataset(
+                    dataset_url,
+                    drop_variables=vars_to_drop,
+                    decode_times=False
+                )
+                ds['time'] = decode_time_units(ds['time'])
             ds = ds.sel(lat=lat_range, lon=lon_range)
 
             ds_day = ds.sel(time=slice(day_start, day_end))
             if ds_day.time.size == 0:
-                ds.close()
                 return None
 
             if var_list is not None:
@@ -290,24 +544,66 @@ def _download_day(dataset_url, day_start, day_end, var_list, depth_range,
             if not surface and 'depth' in ds_day.dims:
                 ds_day = ds_day.sel(depth=depth_range)
 
-            ds_day.to_netcdf(tmp_file)
-            ds.close()
-            print(f'  {day_str} OK')
-            return tmp_file
-
-        except Exception as e:
+            # the OPeNDAP reads happen lazily as the file gets written
+            # (to a temporary name, so a day file which exists is always complete)
+            with phase('transfer'), atomic_write(tmp_file) as tmp:
+                ds_day.to_netcdf(tmp)
+                throttle.consume(ds_day.nbytes)
+                if token is not None:
+                    token.check()
+            return ds_day.nbytes
+        finally:
             if ds is not None:
                 ds.close()
-            print(f'  {day_str} attempt {attempt} failed: {e}')
-            if attempt < MAX_RETRIES:
-                sleep(5)
-            else:
-                print(f'  {day_str} SKIPPED after {MAX_RETRIES} attempts')
-                return None
+
+def _download_day(dataset_url, day_start, day_end, var_list, depth_range,
+                  surface, lon_range, lat_range, vars_to_drop, tmp_dir):
+    """
+    Download a single day's data (or part of a day, see planner.gofs31_periods)
+    by opening its own OPeNDAP connection.
+    Each thread gets an independent netCDF4 handle to avoid segfaults.
+    A slow day is hedged in a separate process when hedging is on (see hedging.py).
+    Returns the path to the temp file, or None on failure.
+    """
+    day_str = day_start.strftime('%Y-%m-%d') if day_start.hour == 0 else day_start.strftime('%Y-%m-%dT%H')
+    tmp_file = os.path.join(tmp_dir, f'{day_str}.nc')
+
+    # skip if already downloaded (e.g. from a previous partial run)
+    if os.path.exists(tmp_file):
+        return tmp_file
+
+    MAX_RETRIES = 3
+    args = (dataset_url, day_start, day_end, var_list, depth_range, surface,
+            lon_range, lat_range, vars_to_drop, tmp_file)
+    with track('hycom_gofs31', day_str) as m:
+        for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                with controller(dataset_url).slot() as s:
+                    nbytes = hedging.run(dataset_url,
+                                         lambda token: _fetch_day(*args, m=m, token=token),
+                                         lambda token: hedging.in_process(token, _fetch_day, *args))
+                    if nbytes is None:
+                        m.set_status('unavailable')
+                        return None
+                    m.add_bytes(nbytes)
+                    s.add_bytes(nbytes)
+                    print(f'  {day_str} OK')
+                    return tmp_file
+
+            except Exception as e:
+                print(f'  {day_str} attempt {attempt} failed: {e}')
+                if attempt < MAX_RETRIES:
+                    m.retry()
+                    with m.phase('backoff'):
+                        sleep(5)
+                else:
+                    print(f'  {day_str} SKIPPED after {MAX_RETRIES} attempts')
+                    m.set_status('failed')
+                    return None
 
 
 def download_hycom_gofs31(domain, start_date, end_date, outputDir,
-                          var_list=None, depths=[0, 5000], surface=False):
+                          var_list=None, depths=[0, 5000], surface=False, output_format='nc'):
     """
     Downloads HYCOM GOFS 3.1 (GLBy0.08/expt_93.0) data in monthly files.
     Downloads are done day-by-day sequentially, then concatenated into
@@ -324,6 +620,8 @@ def download_hycom_gofs31(domain, start_date, end_date, outputDir,
     depths     : [depth_min, depth_max] for subsetting depth (only for 3-hourly 4D variables).
                  Default [0, 5000].
     surface    : False (default) = 3-hourly data, True = hourly surface data.
+    output_format : 'nc' (default) = monthly files, 'zarr' = each month is appended
+                 to a single hycom_gofs31[_sur]_<domain>.zarr store in outputDir.
 
     OUTPUT:
     Monthly NetCDF files named YYYY_MM.nc in outputDir.
@@ -333,23 +631,19 @@ def download_hycom_gofs31(domain, start_date, end_date, outputDir,
     # 3-hourly data is a single aggregated dataset
     # Surface data is organized by year: .../sur/{YYYY}
     if surface:
-        url_base = "https://tds.hycom.org/thredds/dodsC/GLBy0.08/expt_93.0/sur"
+        url_base = f"{HYCOM_THREDDS_URL}/GLBy0.08/expt_93.0/sur"
     else:
-        url = "https://tds.hycom.org/thredds/dodsC/GLBy0.08/expt_93.0"
+        url = f"{HYCOM_THREDDS_URL}/GLBy0.08/expt_93.0"
 
     # Default variable lists
     if var_list is None:
-        if surface:
-            var_list = ['ssh', 'qtot', 'emp', 'steric_ssh',
-                        'u_barotropic_velocity', 'v_barotropic_velocity',
-                        'surface_boundary_layer_thickness', 'mixed_layer_thickness']
-        else:
-            var_list = ['surf_el', 'water_temp', 'salinity', 'water_u', 'water_v']
+        var_list = GOFS31_SURFACE_VARS if surface else GOFS31_VARS
 
     # Variables to drop (auxiliary/coordinate variables we don't need)
     vars_to_drop = ['tau']
 
     os.makedirs(outputDir, exist_ok=True)
+    manifest = get_manifest(outputDir)
 
     # Spatial subset slices
     lon_range = slice(domain[0], domain[1])
@@ -371,111 +665,129 @@ def download_hycom_gofs31(domain, start_date, end_date, outputDir,
 
         print(f'\n{download_date.strftime("%Y-%m")}')
 
+        if output_format == 'zarr':
+            store = store_name(outputDir, 'hycom_gofs31_sur' if surface else 'hycom_gofs31', domain)
+            if store_covers(store, month_start, datetime(download_date.year, download_date.month, day_end)):
+                print(f'{download_date.strftime("%Y-%m")} already in {store}. Skipping.')
+                download_date = download_date + timedelta(days=32)
+                download_date = datetime(download_date.year, download_date.month, 1)
+                continue
+
         # skip if file already exists and is valid
-        if os.path.exists(fpath):
-            try:
-                with xr.open_dataset(fpath) as _:
-                    print(f'{fname} already exists. Skipping.')
-                    download_date = download_date + timedelta(days=32)
-                    download_date = datetime(download_date.year, download_date.month, 1)
-                    continue
-            except Exception:
+        record = dict(dataset=url_base if surface else url,
+                      params={'vars': var_list, 'domain': domain, 'depths': depths, 'surface': surface},
+                      time_start=month_start, time_end=month_end)
+        if output_format != 'zarr':
+            if manifest.already_downloaded(fpath, 'hycom_gofs31', legacy_check=is_valid_netcdf_file, **record):
+                print(f'{fname} already exists. Skipping.')
+                download_date = download_date + timedelta(days=32)
+                download_date = datetime(download_date.year, download_date.month, 1)
+                continue
+            if os.path.exists(fpath):
+                # left in place, and only replaced once the new download is complete
                 print(f'{fname} exists but is invalid. Re-downloading.')
-                os.unlink(fpath)
 
-        # For surface data, construct yearly URL
-        if surface:
-            dataset_url = f"{url_base}/{download_date.year}"
-        else:
-            dataset_url = url
+        # marks the month as failed if it ends without being recorded (no data, an error)
+        with (manifest.downloading(fpath, 'hycom_gofs31', **record) if output_format != 'zarr'
+              else contextlib.nullcontext()):
+            _start = time()
 
-        # Open dataset with retry logic (lazy load via OPeNDAP)
-        MAX_RETRIES = 5
-        RETRY_WAIT = 10
-        ds = None
+            # For surface data, construct yearly URL
+            if surface:
+                dataset_url = f"{url_base}/{download_date.year}"
+            else:
+                dataset_url = url
 
-        for attempt in range(1, MAX_RETRIES + 1):
-            try:
-                ds = xr.open_dataset(
-                    dataset_url,
-                    drop_variables=vars_to_drop,
-                    decode_times=False
-                )
-                ds['time'] = decode_time_units(ds['time'])
-                print(f'[Attempt {attempt}] Dataset opened and times decoded.')
-                break
-            except Exception as e:
-                print(f'[Attempt {attempt}] Failed to open dataset: {e}')
-                if ds is not None:
-                    ds.close()
-                    ds = None
-                if attempt < MAX_RETRIES:
-                    print(f'Retrying in {RETRY_WAIT} seconds...')
-                    sleep(RETRY_WAIT)
-                else:
-                    raise RuntimeError(
-                        f'Failed to open HYCOM GOFS 3.1 dataset after {MAX_RETRIES} attempts.'
+            # Open dataset with retry logic (lazy load via OPeNDAP)
+            MAX_RETRIES = 5
+            RETRY_WAIT = 10
+            ds = None
+
+            for attempt in range(1, MAX_RETRIES + 1):
+                try:
+                    ds = transport.open_dataset(
+                        dataset_url,
+                        drop_variables=vars_to_drop,
+                        decode_times=False
                     )
+                    ds['time'] = decode_time_units(ds['time'])
+                    print(f'[Attempt {attempt}] Dataset opened and times decoded.')
+                    break
+                except Exception as e:
+                    print(f'[Attempt {attempt}] Failed to open dataset: {e}')
+                    if ds is not None:
+                        ds.close()
+                        ds = None
+                    if attempt < MAX_RETRIES:
+                        print(f'Retrying in {RETRY_WAIT} seconds...')
+                        sleep(RETRY_WAIT)
+                    else:
+                        raise RuntimeError(
+                            f'Failed to open HYCOM GOFS 3.1 dataset after {MAX_RETRIES} attempts.'
+                        )
 
-        try:
-            # Check data availability for this month using the initial connection
-            ds = ds.sel(lat=lat_range, lon=lon_range)
-            ds_month_check = ds.sel(time=slice(month_start, month_end))
-            if ds_month_check.time.size == 0:
-                print(f'No data available for {download_date.strftime("%Y-%m")}. Skipping.')
+            try:
+                # Check data availability for this month using the initial connection
+                ds = ds.sel(lat=lat_range, lon=lon_range)
+                ds_month_check = ds.sel(time=slice(month_start, month_end))
+                if ds_month_check.time.size == 0:
+                    print(f'No data available for {download_date.strftime("%Y-%m")}. Skipping.')
+                    ds.close()
+                    download_date = download_date + timedelta(days=32)
+                    download_date = datetime(download_date.year, download_date.month, 1)
+                    continue
                 ds.close()
-                download_date = download_date + timedelta(days=32)
-                download_date = datetime(download_date.year, download_date.month, 1)
-                continue
-            ds.close()
 
-            # Create temp directory for daily files inside outputDir
-            tmp_dir = tempfile.mkdtemp(
-                prefix=f'.hycom_gofs31_{download_date.strftime("%Y_%m")}_',
-                dir=outputDir
-            )
+                # Directory for the daily files inside outputDir, named after the month so that
+                # an interrupted month resumes from the days it already has
+                tmp_dir = os.path.join(outputDir, f'.hycom_gofs31{"_sur" if surface else ""}_'
+                                                  f'{download_date.strftime("%Y_%m")}')
+                os.makedirs(tmp_dir, exist_ok=True)
 
-            # Build list of days in this month
-            days = []
-            d = month_start
-            while d <= month_end:
-                day_start = d
-                day_end_dt = datetime(d.year, d.month, d.day, 23, 59, 59)
-                days.append((day_start, day_end_dt))
-                d = d + timedelta(days=1)
-
-            # Download days sequentially (netCDF4's C library is not thread-safe
-            # with OPeNDAP, causing memory corruption when using threads)
-            print(f'Downloading {len(days)} days...')
-            daily_files = []
-
-            for day_s, day_e in days:
-                result = _download_day(
-                    dataset_url, day_s, day_e, var_list, depth_range,
-                    surface, lon_range, lat_range, vars_to_drop, tmp_dir
-                )
-                if result is not None:
-                    daily_files.append(result)
+                # Build list of days in this month (or shorter periods if a day is too big for one request)
+                days = gofs31_periods(dataset_url, var_list, month_start, month_end, domain, depths)
 
-            # Sort by filename (date order) and concatenate
-            daily_files.sort()
+                # Download days sequentially (netCDF4's C library is not thread-safe
+                # with OPeNDAP, causing memory corruption when using threads)
+                print(f'Downloading {len(days)} days...')
+                daily_files = []
 
-            if len(daily_files) == 0:
-                print(f'No daily files downloaded for {download_date.strftime("%Y-%m")}. Skipping.')
-            else:
-                print(f'Concatenating {len(daily_files)} daily files into {fname}...')
-                with xr.open_mfdataset(daily_files, combine='by_coords') as ds_combined:
-                    ds_combined.to_netcdf(fpath)
-                print(f'Saved {fname}')
-
-            # Clean up temp files
-            for f in daily_files:
-                os.unlink(f)
-            os.rmdir(tmp_dir)
-
-        except Exception:
-            ds.close()
-            raise
+                for day_s, day_e in days:
+                    result = _download_day(
+                        dataset_url, day_s, day_e, var_list, depth_range,
+                        surface, lon_range, lat_range, vars_to_drop, tmp_dir
+                    )
+                    if result is not None:
+                        daily_files.append(result)
+
+                # Sort by filename (date order) and concatenate
+                daily_files.sort()
+
+                if len(daily_files) == 0:
+                    print(f'No daily files downloaded for {download_date.strftime("%Y-%m")}. Skipping.')
+                elif output_format == 'zarr':
+                    print(f'Appending {len(daily_files)} daily files to {store}...')
+                    with track('hycom_gofs31', fname, stage='merge'):
+                        with open_mfdataset(daily_files, combine='by_coords', chunks=memory.file_chunks(daily_files)) as ds_combined:
+                            append_to_zarr(ds_combined, store)
+                else:
+                    print(f'Concatenating {len(daily_files)} daily files into {fname}...')
+                    with track('hycom_gofs31', fname, stage='merge') as m:
+                        with open_mfdataset(daily_files, combine='by_coords', chunks=memory.file_chunks(daily_files)) as ds_combined:
+                            with m.phase('write'), atomic_write(fpath) as tmp:
+                                write_netcdf(ds_combined, tmp, m)
+                        m.add_bytes(os.path.getsize(fpath))
+                    manifest.record(fpath, 'hycom_gofs31', duration=time() - _start, **record)
+                    print(f'Saved {fname}')
+
+                # Clean up temp files
+                for f in daily_files:
+                    os.unlink(f)
+                os.rmdir(tmp_dir)
+
+            except Exception:
+                ds.close()
+                raise
 
         # Advance to next month
         download_date = download_date + timedelta(days=32)
@@ -0,0 +1,320 @@
+"""
+Cross-process lease locks on the artifacts, and atomic writes
+
+Overlapping runs against the same output directory (a cron job and its retry,
+or two Airflow tasks) must not download the same file twice or write over each
+other. Each artifact being produced has a lease: a lock file next to it,
+.<name>.lock, holding the host, pid and start time of its owner. Processes
+wanting the same artifact wait for the lease to be released, then find the
+artifact complete in the manifest and reuse it (see Manifest.already_downloaded,
+which takes the lease of an artifact which isn't there yet, released when it's
+recorded as complete or failed).
+
+A lock file is created with os.link from a file which already has its content,
+which is atomic on local and network filesystems, and the owner refreshes its
+modification time every LOCK_TTL / 4 seconds from a background thread. A lease
+is stale, and taken over, if its heartbeat is older than LOCK_TTL (e.g. the
+container was killed), or straight away if its owner was on this host, in the
+same pid namespace, and is no longer running. Within a process a lease is held
+by the thread which took it: taking it again from that thread returns
+immediately, while other threads (e.g. the variables of download_hycom_ops)
+wait for it to be released as other processes do. The leases a thread still
+holds when it ends are released by the next heartbeat, or as soon as another
+thread of this process wants one of them.
+
+Outputs are written to a temporary file in the same directory and renamed into
+place (atomic_write), so nobody ever sees a partially written file.
+
+The same leases work across the nodes which mount a shared filesystem (NFS,
+Lustre, ...), as long as their clocks are synchronised (NTP), since the age of
+a heartbeat is compared with the clock of another host. is_shared_fs tells the
+users of SQLite databases (see manifest.py and backfill.py) when their file is
+on such a filesystem, where SQLite's WAL mode can't be used.
+"""
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+LOCK_TTL = float(os.environ.get('SOMISANA_LOCK_TTL', 120))
+POLL = 1.
+MAX_POLL = 10.
+
+# filesystem types (of /proc/mounts) shared between hosts
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs', 'beegfs', 'ceph', 'glusterfs',
+              'fuse.glusterfs', 'fuse.cephfs', 'fuse.sshfs', '9p')
+
+_held = {}           # lock path -> (token, owning thread), for the leases held by this process
+_held_lock = threading.Lock()
+_released = threading.Condition(_held_lock)
+_PENDING = None      # token of a lease a thread of this process is taking
+_heartbeat = None
+
+def lock_path(path):
+    path = os.path.abspath(str(path))
+    return os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.lock')
+
+def is_shared_fs(path):
+    """
+    True if path is on a network filesystem, which may be shared with other hosts
+    (SOMISANA_SHARED_FS=1 or 0 overrides the detection)
+    """
+    if os.environ.get('SOMISANA_SHARED_FS'):
+        return os.environ['SOMISANA_SHARED_FS'].lower() in ('1', 'true', 'yes')
+    path = os.path.realpath(str(path))
+    mount, fstype = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                mnt = fields[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) >= len(mount):
+                    mount, fstype = mnt, fields[2]
+    except OSError:
+        return False
+    return fstype in NETWORK_FS
+
+def _pid_namespace():
+    try:
+        return os.readlink('/proc/self/ns/pid')
+    except OSError:
+        return None
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read(lock):
+    try:
+        with open(lock) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _is_stale(lock, info):
+    try:
+        age = time.time() - os.stat(lock).st_mtime
+    except FileNotFoundError:
+        return False
+    if age > LOCK_TTL:
+        return True
+    # pids can only be checked on the same host and in the same pid namespace (containers)
+    return (info is not None and info.get('host') == socket.gethostname()
+            and info.get('pidns') is not None and info.get('pidns') == _pid_namespace()
+            and not _pid_alive(info['pid']))
+
+def _break(lock, info):
+    """
+    Remove a stale lock, unless someone else got there first
+    """
+    stale = f'{lock}.{uuid.uuid4().hex}.stale'
+    try:
+        os.rename(lock, stale)
+    except FileNotFoundError:
+        return
+    taken = _read(stale)
+    if info is not None and taken is not None and taken.get('token') != info.get('token'):
+        # the lock was recovered and taken by another process in the meantime: put it back
+        try:
+            os.link(stale, lock)
+        except FileExistsError:
+            pass
+    else:
+        print(f'[lock] recovered the stale lock {lock} of {info}')
+    os.remove(stale)
+
+def _ended(owner):
+    """
+    Whether the thread owner (an ident) has ended without releasing its leases
+    """
+    return owner not in {t.ident for t in threading.enumerate()}
+
+def _drop(lock, token):
+    """
+    Remove a lease of this process (called with _held_lock held) and wake up the threads waiting for it
+    """
+    # the lock file goes first, so the thread woken up can take it straight away
+    owner = _read(lock)
+    if owner is not None and owner.get('token') == token:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            pass
+    del _held[lock]
+    _released.notify_all()
+
+def _beat():
+    while True:
+        time.sleep(LOCK_TTL / 4)
+        with _held_lock:
+            # the leases left by threads which have ended (e.g. the workers of a failed job) go
+            for lock, (token, owner) in list(_held.items()):
+                if token is not _PENDING and _ended(owner):
+                    _drop(lock, token)
+            # not the lock files still owned by another process
+            locks = [lock for lock, (token, _) in _held.items() if token is not _PENDING]
+        for lock in locks:
+            try:
+                os.utime(lock)
+            except FileNotFoundError:
+                pass
+
+def _wait_thread(lock, path, t0, timeout, quiet):
+    """
+    Wait (called with _held_lock held) while another thread of this process holds
+    the lease. True if this thread holds it already
+    """
+    me = threading.get_ident()
+    waiting = quiet
+    while lock in _held:
+        token, owner = _held[lock]
+        if owner == me:
+            return True
+        if token is not _PENDING and _ended(owner):
+            _drop(lock, token)
+            continue
+        if not waiting:
+            print(f'[lock] waiting for {path}, in progress in thread {_held[lock][1]} of this process')
+            waiting = True
+        remaining = None if timeout is None else timeout - (time.time() - t0)
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f'{path} still locked by another thread after {timeout} s')
+        _released.wait(remaining if remaining is not None else MAX_POLL)
+    return False
+
+def acquire(path, timeout=None, poll=POLL, quiet=False):
+    """
+    Take the lease of path, waiting while another live process, or another
+    thread of this process, holds it. Returns False if this thread already held it
+
+    INPUTS:
+    path    : the artifact
+    timeout : seconds to wait before raising TimeoutError (None to wait for ever)
+    poll    : first interval between attempts, growing up to MAX_POLL (shorter
+              for leases which are only held for a moment, e.g. a queue update)
+    quiet   : don't report the wait
+    """
+    global _heartbeat
+    lock = lock_path(path)
+    t0 = time.time()
+    with _held_lock:
+        if _wait_thread(lock, path, t0, timeout, quiet):
+            return False
+        # the other threads wait for us while we take the lock file
+        _held[lock] = (_PENDING, threading.get_ident())
+    try:
+        token = _take(lock, path, t0, timeout, poll, quiet)
+    except BaseException:
+        with _held_lock:
+            del _held[lock]
+            _released.notify_all()
+        raise
+    with _held_lock:
+        _held[lock] = (token, threading.get_ident())
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, daemon=True)
+            _heartbeat.start()
+    return True
+
+def _take(lock, path, t0, timeout, poll, quiet):
+    """
+    Create the lock file, waiting while another process holds it, and return its token
+    """
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    token = uuid.uuid4().hex
+    info = {'host': socket.gethostname(), 'pid': os.getpid(), 'pidns': _pid_namespace(),
+            'started': time.time(), 'token': token}
+    tmp = f'{lock}.{token}'
+    with open(tmp, 'w') as f:
+        json.dump(info, f)
+    waiting = quiet
+    try:
+        while True:
+            try:
+                os.link(tmp, lock)
+                break
+            except FileExistsError:
+                pass
+            owner = _read(lock)
+            if _is_stale(lock, owner):
+                _break(lock, owner)
+                continue
+            if not waiting:
+                print(f'[lock] waiting for {path}, in progress in {owner}')
+                waiting = True
+            if timeout is not None and time.time() - t0 > timeout:
+                raise TimeoutError(f'{path} still locked by {owner} after {timeout} s')
+            time.sleep(poll)
+            poll = min(poll * 1.5, MAX_POLL)
+    finally:
+        os.remove(tmp)
+    return token
+
+def release(path, any_thread=False):
+    """
+    Give up the lease of path, if this thread (any thread of this process with
+    any_thread) holds it
+    """
+    lock = lock_path(path)
+    with _held_lock:
+        held = _held.get(lock)
+        if held is None or held[0] is _PENDING or (held[1] != threading.get_ident() and not any_thread):
+            return
+        _drop(lock, held[0])
+
+@contextmanager
+def lease(path, timeout=None, poll=POLL, quiet=False):
+    """
+    Hold the lease of path for the duration of the block (see acquire)
+    """
+    acquired = acquire(path, timeout, poll, quiet)
+    try:
+        yield
+    finally:
+        if acquired:
+            release(path)
+
+def held(thread=None):
+    """
+    The artifacts whose lease is held by a thread (the ident of a thread, all the
+    threads of this process if None)
+    """
+    with _held_lock:
+        locks = [lock for lock, (token, owner) in _held.items()
+                 if token is not _PENDING and (thread is None or owner == thread)]
+    return [os.path.join(os.path.dirname(lock), os.path.basename(lock)[1:-len('.lock')]) for lock in locks]
+
+@atexit.register
+def release_all(thread=None):
+    """
+    Give up the leases held by a thread (all the threads of this process if None),
+    e.g. those left by a job which failed
+    """
+    for path in held(thread):
+        release(path, any_thread=True)
+
+@contextmanager
+def atomic_write(path):
+    """
+    Yield a temporary path in the directory of path, moved to path if the block succeeds
+    (the temporary file keeps the extension, which some writers go by)
+    """
+    path = str(path)
+    base, ext = os.path.splitext(os.path.basename(path))
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), f'.{base}.{os.getpid()}.{uuid.uuid4().hex[:8]}{ext}')
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
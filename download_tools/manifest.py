@@ -0,0 +1,271 @@
+"""
+SQLite manifest of the files produced by the downloaders
+
+Every artifact (a GFS grib file, a CMEMS subset, a HYCOM variable file, a monthly
+archive file or a merged product) gets a row recording where it came from
+(source, dataset, request parameters and time range), its size, checksum,
+how long it took and its status. The downloaders use this to decide what is
+already done with an indexed lookup rather than by opening files, and it can
+be queried in bulk for what is missing from an archive.
+
+By default the manifest lives in the output directory of the download
+(.somisana_manifest.sqlite), but a single manifest can be shared across
+directories by setting the SOMISANA_MANIFEST environment variable to a file path.
+
+The manifest also hands out the leases of the artifacts (see locking.py), so that
+overlapping processes don't download the same artifact twice.
+"""
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from download_tools import locking
+
+MANIFEST_NAME = '.somisana_manifest.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path       TEXT PRIMARY KEY,
+    source     TEXT NOT NULL,
+    dataset    TEXT,
+    params     TEXT,
+    time_start TEXT,
+    time_end   TEXT,
+    size       INTEGER,
+    mtime      REAL,
+    checksum   TEXT,
+    duration   REAL,
+    status     TEXT NOT NULL,
+    host       TEXT,
+    updated    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_dataset ON artifacts (source, dataset, status);
+CREATE INDEX IF NOT EXISTS artifacts_time ON artifacts (dataset, time_start);
+"""
+
+# status values
+IN_PROGRESS = 'in_progress'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def manifest_path(outputDir):
+    return os.environ.get('SOMISANA_MANIFEST') or os.path.join(outputDir, MANIFEST_NAME)
+
+def get_manifest(outputDir):
+    """
+    Return the (cached) manifest used for files written to outputDir
+    """
+    db = os.path.abspath(manifest_path(outputDir))
+    with _manifests_lock:
+        # the database is recreated if it was removed with its directory, e.g. between
+        # the jobs of the download daemon (see server.py)
+        if db not in _manifests or not os.path.exists(db):
+            _manifests[db] = Manifest(db)
+        return _manifests[db]
+
+def file_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _to_str(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+class Manifest:
+    """
+    Thin wrapper around the sqlite database. Connections are kept per thread
+    so the threaded downloaders can share a Manifest instance, and the
+    database runs in WAL mode so overlapping processes can read while one writes.
+    WAL needs memory shared between the processes, so a database on a network
+    filesystem (outputs shared between the nodes of a backfill, see backfill.py)
+    keeps the default rollback journal instead.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+        self.journal_mode = 'DELETE' if locking.is_shared_fs(db) else 'WAL'
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db, timeout=60)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+            self._local.conn = conn
+        return conn
+
+    def get(self, path):
+        row = self._connect().execute(
+            'SELECT * FROM artifacts WHERE path = ?', (os.path.abspath(path),)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def is_complete(self, path):
+        """
+        True if path is recorded as complete and the file on disk still has the
+        recorded size and modification time (a stat, the file isn't opened)
+        """
+        entry = self.get(path)
+        if entry is None or entry['status'] != COMPLETE:
+            return False
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+    def already_downloaded(self, path, source, legacy_check=None, **kwargs):
+        """
+        Skip check used by the downloaders. If the file isn't in the manifest
+        (e.g. it was downloaded before the manifest existed) then legacy_check(path)
+        is used once, and a file which passes it is adopted into the manifest.
+        A complete file whose size or modification time no longer match (e.g.
+        after a touch, or a copy without -p) is checked again (see _revalidate)
+        rather than downloaded again.
+
+        If another process is downloading path, this waits for it to finish and
+        reuses its result. If path isn't there, the caller gets its lease until it
+        records it as complete or failed (record/fail)
+        """
+        if self.is_complete(path):
+            return True
+        locking.acquire(path)
+        if self.is_complete(path):
+            locking.release(path)
+            return True
+        if self._revalidate(path, source, legacy_check, **kwargs):
+            return True
+        if legacy_check is not None and self.get(path) is None and legacy_check(path):
+            self.record(path, source, **kwargs)
+            return True
+        return False
+
+    def _revalidate(self, path, source, legacy_check, **kwargs):
+        """
+        Whether a file recorded as complete, whose stat no longer matches the
+        manifest, is still the file we downloaded: the same content (its checksum),
+        or else a file which passes legacy_check. Its entry is refreshed if so
+        (with the caller holding the lease, which this releases)
+        """
+        entry = self.get(path)
+        if entry is None or entry['status'] != COMPLETE or not os.path.exists(path):
+            return False
+        if os.path.getsize(path) == entry['size'] and file_checksum(path) == entry['checksum']:
+            stat = os.stat(path)
+            conn = self._connect()
+            with conn:
+                conn.execute('UPDATE artifacts SET mtime = ?, updated = ? WHERE path = ?',
+                             (stat.st_mtime, _to_str(datetime.now()), os.path.abspath(path)))
+            locking.release(path)
+            return True
+        if legacy_check is not None and legacy_check(path):
+            self.record(path, source, **kwargs)
+            return True
+        return False
+
+    def start(self, path, source, dataset=None, params=None, time_start=None, time_end=None):
+        """
+        Mark an artifact as in progress before the download starts (taking its lease if we don't have it)
+        """
+        locking.acquire(path)
+        self._write(path, source, dataset, params, time_start, time_end,
+                    None, None, None, None, IN_PROGRESS)
+
+    def record(self, path, source, dataset=None, params=None, time_start=None, time_end=None,
+               duration=None, status=COMPLETE):
+        """
+        Record a finished artifact, with its size and checksum, releasing its lease
+        """
+        size = mtime = checksum = None
+        try:
+            if status == COMPLETE:
+                stat = os.stat(path)
+                size, mtime = stat.st_size, stat.st_mtime
+                checksum = file_checksum(path)
+            self._write(path, source, dataset, params, time_start, time_end,
+                        size, mtime, checksum, duration, status)
+        finally:
+            locking.release(path)
+
+    def fail(self, path, source, **kwargs):
+        self.record(path, source, status=FAILED, **kwargs)
+
+    @contextmanager
+    def downloading(self, path, source, **kwargs):
+        """
+        Mark path as in progress (start) for the duration of the block, which
+        records it (record) once it's complete. If the block raises, or ends
+        without recording it (e.g. the data isn't there), path is recorded as
+        failed. The lease is released either way, so an error can't leave it
+        held for the life of the process, e.g.
+
+            if not manifest.already_downloaded(path, 'gfs', **record):
+                with manifest.downloading(path, 'gfs', **record):
+                    ...
+                    manifest.record(path, 'gfs', duration=..., **record)
+        """
+        try:
+            self.start(path, source, **kwargs)
+            yield
+        finally:
+            try:
+                entry = self.get(path)
+                if entry is not None and entry['status'] == IN_PROGRESS:
+                    self.fail(path, source, **kwargs)
+            finally:
+                locking.release(path)
+
+    def _write(self, path, source, dataset, params, time_start, time_end,
+               size, mtime, checksum, duration, status):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO artifacts VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (os.path.abspath(path), source, dataset,
+                 json.dumps(params, default=_to_str, sort_keys=True) if params is not None else None,
+                 _to_str(time_start), _to_str(time_end), size, mtime, checksum, duration,
+                 status, socket.gethostname(), _to_str(datetime.now())))
+
+    def missing(self, paths):
+        """
+        Return the subset of paths which aren't recorded as complete, in one query
+        """
+        paths = [os.path.abspath(p) for p in paths]
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (path TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM wanted')
+            conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(p,) for p in paths])
+            done = {row['path'] for row in conn.execute(
+                'SELECT a.path FROM artifacts a JOIN wanted w ON a.path = w.path WHERE a.status = ?',
+                (COMPLETE,))}
+        return [p for p in paths if p not in done]
+
+    def entries(self, source=None, dataset=None, status=None):
+        """
+        List the recorded artifacts, optionally filtered by source, dataset and status
+        """
+        query, args = 'SELECT * FROM artifacts WHERE 1=1', []
+        for column, value in (('source', source), ('dataset', dataset), ('status', status)):
+            if value is not None:
+                query += f' AND {column} = ?'
+                args.append(value)
+        query += ' ORDER BY dataset, time_start, path'
+        return [dict(row) for row in self._connect().execute(query, args)]
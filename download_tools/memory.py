@@ -0,0 +1,180 @@
+"""
+Memory budget of the downloads and merges (the --memory_budget option of cli.py)
+
+How much memory a stage takes normally follows the size of the domain and
+period: a HYCOM slice is loaded whole, a merge writes each variable of the
+combined files in one go, and so on, which gets big domains OOM-killed. With a
+budget (--memory_budget 4G, or SOMISANA_MEMORY_BUDGET), every stage which moves
+data sizes its chunks from it instead:
+    - the days of a HYCOM slice (on top of the request size, see planner.py)
+    - the time chunks of the merges (open_mfdataset and the Mercator merge),
+      which dask then streams to the output a chunk at a time
+    - the time records converted at a time by ERA5_convert.py
+A stage gets what's left of the budget once the memory the process already
+uses is taken off (leaving HEADROOM for the copies the libraries make), shared
+with the other stages running at the time. The dask thread pool is limited to
+DASK_THREADS, each holding a chunk.
+
+Whether the budget was respected shows in the metrics: each track (see
+metrics.py) records the peak resident memory of the process while it ran
+(sampled every POLL seconds), which goes into the run report, with a warning
+for the stages which went over.
+"""
+import os
+import re
+import threading
+import time
+
+HEADROOM = 0.7          # fraction of the budget the data of the stages may take
+MIN_FRACTION = 0.02     # smallest share of the budget a stage is given
+DASK_THREADS = 4
+POLL = 0.05
+
+_UNITS = {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9, 't': 1e12}
+
+def parse_size(value):
+    """
+    Bytes of a size e.g. '4G', '500M', '2.5g' or '1000000'
+    """
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([kKmMgGtT]?)[iI]?[bB]?\s*', str(value))
+    if match is None:
+        raise ValueError(f'Invalid size {value!r}, expected e.g. 4G or 500M')
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+BUDGET = parse_size(os.environ['SOMISANA_MEMORY_BUDGET']) if os.environ.get('SOMISANA_MEMORY_BUDGET') else None
+
+def set_budget(nbytes):
+    """
+    Set the budget (None for none), for this process and the ones it starts
+    """
+    global BUDGET
+    BUDGET = nbytes
+    if nbytes is None:
+        os.environ.pop('SOMISANA_MEMORY_BUDGET', None)
+        return
+    os.environ['SOMISANA_MEMORY_BUDGET'] = str(int(nbytes))
+    # read by dask when it's imported
+    os.environ.setdefault('DASK_NUM_WORKERS', str(DASK_THREADS))
+
+def split(n):
+    """
+    Give each of n worker processes started from now on an equal share of the budget
+    """
+    if BUDGET is not None and n > 1:
+        set_budget(BUDGET // n)
+
+_PAGE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def rss():
+    """
+    Resident memory of this process, in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE
+    except (OSError, IndexError, ValueError):
+        import resource
+        # the peak rather than the current value, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def peak_rss():
+    """
+    Peak resident memory of this process since it started, in bytes
+    """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# stages being watched (see watch), whose peaks are updated by the sampler thread
+_watchers = set()
+_lock = threading.Lock()
+_wake = threading.Condition(_lock)
+_sampler = None
+
+class _Watch:
+    def __init__(self):
+        self.peak = rss()
+
+    def stop(self):
+        self.peak = max(self.peak, rss())
+        with _lock:
+            _watchers.discard(self)
+        return self.peak
+
+def _sample():
+    while True:
+        with _lock:
+            while not _watchers:
+                _wake.wait()
+            watchers = list(_watchers)
+        current = rss()
+        for w in watchers:
+            if current > w.peak:
+                w.peak = current
+        time.sleep(POLL)
+
+def watch():
+    """
+    Start following the peak resident memory of the process for a stage: the
+    peak since then is returned by stop() on the returned object
+    """
+    global _sampler
+    w = _Watch()
+    with _lock:
+        _watchers.add(w)
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample, name='memory-sampler', daemon=True)
+            _sampler.start()
+        _wake.notify()
+    return w
+
+def available():
+    """
+    Bytes a stage may use for its data now, None without a budget
+    """
+    if BUDGET is None:
+        return None
+    with _lock:
+        stages = max(len(_watchers), 1)
+    free = max(BUDGET * HEADROOM - rss(), BUDGET * MIN_FRACTION)
+    return free / stages
+
+def steps_per_chunk(step_bytes, copies=2, default=None, threads=1):
+    """
+    How many time steps of step_bytes each fit in the memory available to a
+    stage, which holds copies of its data at once on each of threads (at least
+    one step, and at most default). default without a budget
+    """
+    free = available()
+    if free is None or not step_bytes:
+        return default
+    n = max(1, int(free / (step_bytes * copies * threads)))
+    return min(n, default) if default is not None else n
+
+def _step_bytes(ds, dim):
+    nbytes = 0
+    for v in ds.data_vars.values():
+        if dim in v.dims:
+            nbytes += v.nbytes / max(v.sizes[dim], 1)
+    return nbytes
+
+def dask_chunks(ds, dim='time', copies=2):
+    """
+    The chunks {dim: steps} for the dask arrays of ds so that a stage streaming
+    it keeps within the budget (None without a budget, i.e. the default chunks)
+    """
+    if BUDGET is None or dim not in ds.dims:
+        return None
+    return {dim: steps_per_chunk(_step_bytes(ds, dim), copies, ds.sizes[dim], DASK_THREADS)}
+
+def file_chunks(paths, dim='time', copies=2):
+    """
+    dask_chunks for the variables of a NetCDF file, or the first of a list of them
+    (only its metadata is read), e.g. for the chunks argument of open_mfdataset
+    """
+    if isinstance(paths, (list, tuple)):
+        paths = paths[0] if paths else None
+    if BUDGET is None or paths is None:
+        return None
+    import xarray as xr
+    with xr.open_dataset(paths, decode_times=False) as ds:
+        return dask_chunks(ds, dim, copies)
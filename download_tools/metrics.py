@@ -0,0 +1,253 @@
+"""
+Per-download metrics for all the downloaders
+
+Each file or slice that gets downloaded (and each merge) is wrapped in a
+track(), which records the bytes moved, the wall time, the number of retries and
+how the time was spent in named phases:
+    wait     : waiting on the server before data flows (time to first byte, opening an OPeNDAP dataset)
+    transfer : moving the data
+    backoff  : sleeping between retries
+    write    : writing output locally
+At the end of a run the records can be written as a JSON run report and/or as
+a Prometheus node-exporter textfile (see the --metrics_json and --metrics_prom
+options of cli.py).
+
+With --profile, each track and each of its phases is also a span of the
+timeline trace (see profiling.py).
+
+Each track also records the peak resident memory of the process while it ran,
+checked against the --memory_budget if there is one (see memory.py).
+
+By default the records are those of the whole process. Within a scope() (e.g.
+a job of the daemon, see server.py) they go to the scope instead, and the
+report covers the scope only: the threads a download starts carry the scope
+of their caller with in_scope().
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from download_tools import concurrency, hedging, memory, profiling
+
+_records = []
+_lock = threading.Lock()
+_run_start = time.time()
+_over_budget = set()
+_scope = contextvars.ContextVar('metrics_scope', default=None)
+
+class scope:
+    """
+    Context manager collecting the records of the tracks run within it, rather
+    than those of the process e.g.
+
+        with metrics.scope() as job:
+            ...
+        metrics.write_json(path, scope=job)
+    """
+
+    def __init__(self):
+        self.records = []
+        self.start = time.time()
+
+    def __enter__(self):
+        self._token = _scope.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _scope.reset(self._token)
+        return False
+
+def in_scope(func):
+    """
+    func, run in the metrics scope of the caller (for the target of a thread or pool)
+    """
+    current = _scope.get()
+    def run(*args, **kwargs):
+        token = _scope.set(current)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _scope.reset(token)
+    return run
+
+class track:
+    """
+    Context manager recording the metrics for one file, slice or merge e.g.
+
+        with track('gfs', fname) as m:
+            with m.phase('wait'):
+                response = urlopen(url)
+            with m.phase('transfer'):
+                data = response.read()
+            m.add_bytes(len(data))
+    """
+
+    def __init__(self, source, name, stage='download'):
+        self.record = {
+            'source': source,
+            'name': name,
+            'stage': stage,
+            'status': 'ok',
+            'start': None,
+            'wall': 0.,
+            'bytes': 0,
+            'retries': 0,
+            'phases': {},
+            'peak_rss': None,
+        }
+
+    def __enter__(self):
+        self._t0 = time.time()
+        self._memory = memory.watch()
+        self.record['start'] = datetime.fromtimestamp(self._t0).isoformat()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record['wall'] = time.time() - self._t0
+        if exc_type is not None and self.record['status'] == 'ok':
+            self.record['status'] = 'failed'
+        transfer = self.record['phases'].get('transfer', 0.)
+        self.record['throughput'] = self.record['bytes'] / transfer if transfer > 0 else None
+        self.record['peak_rss'] = self._memory.stop()
+        key = (self.record['source'], self.record['stage'])
+        if memory.BUDGET is not None and self.record['peak_rss'] > memory.BUDGET and key not in _over_budget:
+            # once per source and stage, the rest are in the report
+            _over_budget.add(key)
+            print(f"WARNING: {self.record['source']} {self.record['name']} ({self.record['stage']}) peaked at "
+                  f"{self.record['peak_rss'] / 1e6:.0f} MB, over the memory budget of {memory.BUDGET / 1e6:.0f} MB")
+        current = _scope.get()
+        with _lock:
+            (current.records if current is not None else _records).append(self.record)
+        if profiling.ENABLED:
+            profiling.record(f"{self.record['source']} {self.record['name']}", self.record['stage'],
+                             self._t0, self._t0 + self.record['wall'],
+                             {'status': self.record['status'], 'bytes': self.record['bytes'],
+                              'retries': self.record['retries']})
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            t1 = time.time()
+            phases = self.record['phases']
+            phases[name] = phases.get(name, 0.) + t1 - t0
+            if profiling.ENABLED:
+                profiling.record(name, self.record['stage'], t0, t1, {'file': self.record['name']})
+
+    def add_bytes(self, n):
+        self.record['bytes'] += int(n)
+
+    def retry(self):
+        self.record['retries'] += 1
+
+    def set_encoding(self, report):
+        # size of an output before/after compression and quantization (see encoding.write_netcdf)
+        self.record['encoding'] = report
+
+    def set_status(self, status):
+        # e.g. 'skipped' when the file was already downloaded
+        self.record['status'] = status
+
+def records(scope=None):
+    with _lock:
+        return list(scope.records if scope is not None else _records)
+
+def summary(recs):
+    """
+    Totals per source and stage
+    """
+    out = {}
+    for r in recs:
+        s = out.setdefault(f"{r['source']}/{r['stage']}", {
+            'source': r['source'], 'stage': r['stage'], 'count': 0, 'failed': 0,
+            'skipped': 0, 'bytes': 0, 'wall': 0., 'retries': 0, 'phases': {},
+            'raw_bytes': 0, 'encoded_bytes': 0, 'peak_rss': 0})
+        s['count'] += 1
+        s['failed'] += r['status'] == 'failed'
+        s['skipped'] += r['status'] == 'skipped'
+        s['bytes'] += r['bytes']
+        s['wall'] += r['wall']
+        s['retries'] += r['retries']
+        s['peak_rss'] = max(s['peak_rss'], r.get('peak_rss') or 0)
+        if 'encoding' in r:
+            s['raw_bytes'] += r['encoding']['raw_bytes']
+            s['encoded_bytes'] += r['encoding']['bytes']
+        for name, t in r['phases'].items():
+            s['phases'][name] = s['phases'].get(name, 0.) + t
+    for s in out.values():
+        transfer = s['phases'].get('transfer', 0.)
+        s['throughput'] = s['bytes'] / transfer if transfer > 0 else None
+    return list(out.values())
+
+def _write_atomic(path, text):
+    # write to a temporary file and rename it, so readers (e.g. the node exporter)
+    # never see a partially written file
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def write_json(path, command=None, status='ok', scope=None):
+    recs = records(scope)
+    run_start = scope.start if scope is not None else _run_start
+    report = {
+        'command': command,
+        'status': status,
+        'start': datetime.fromtimestamp(run_start).isoformat(),
+        'end': datetime.now().isoformat(),
+        'wall': time.time() - run_start,
+        'summary': summary(recs),
+        'records': recs,
+        # shared by everything running in the process, scope or not
+        'concurrency': concurrency.decisions(),
+        'hedging': hedging.stats(),
+        'memory': {'budget': memory.BUDGET, 'peak_rss': memory.peak_rss(),
+                   'over_budget': [f"{r['source']} {r['name']} ({r['stage']})" for r in recs
+                                   if memory.BUDGET is not None and (r.get('peak_rss') or 0) > memory.BUDGET]},
+    }
+    _write_atomic(path, json.dumps(report, indent=1))
+
+def write_prometheus(path, command=None, status='ok', scope=None):
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP somisana_download_{name} {help_text}')
+        lines.append(f'# TYPE somisana_download_{name} {kind}')
+        for labels, value in samples:
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f'somisana_download_{name}{{{label_str}}} {value}')
+
+    summ = summary(records(scope))
+    base = lambda s: {'command': command, 'source': s['source'], 'stage': s['stage']}
+    metric('items', 'gauge', 'Number of files/slices handled in the last run',
+           [(dict(base(s), status=st), s[key]) for s in summ
+            for st, key in (('total', 'count'), ('failed', 'failed'), ('skipped', 'skipped'))])
+    metric('bytes', 'gauge', 'Bytes moved in the last run',
+           [(base(s), s['bytes']) for s in summ])
+    metric('retries', 'gauge', 'Retries in the last run',
+           [(base(s), s['retries']) for s in summ])
+    metric('seconds', 'gauge', 'Time spent in the last run, by phase',
+           [(dict(base(s), phase='wall'), round(s['wall'], 3)) for s in summ] +
+           [(dict(base(s), phase=p), round(t, 3)) for s in summ for p, t in s['phases'].items()])
+    metric('throughput_bytes_per_second', 'gauge', 'Bytes per second of transfer time in the last run',
+           [(base(s), round(s['throughput'], 1)) for s in summ if s['throughput'] is not None])
+    metric('output_compression_ratio', 'gauge', 'Uncompressed over written size of the outputs in the last run',
+           [(base(s), round(s['raw_bytes'] / s['encoded_bytes'], 3)) for s in summ if s['encoded_bytes']])
+    metric('peak_rss_bytes', 'gauge', 'Peak resident memory of the process during the stages of the last run',
+           [(base(s), s['peak_rss']) for s in summ if s['peak_rss']])
+    if memory.BUDGET is not None:
+        metric('memory_budget_bytes', 'gauge', 'Memory budget of the last run',
+               [({'command': command}, memory.BUDGET)])
+    metric('last_run_success', 'gauge', '1 if the last run completed without error',
+           [({'command': command}, int(status == 'ok'))])
+    metric('last_run_timestamp_seconds', 'gauge', 'Time the last run finished',
+           [({'command': command}, round(time.time()))])
+    metric('last_run_duration_seconds', 'gauge', 'Wall time of the last run',
+           [({'command': command}, round(time.time() - (scope.start if scope is not None else _run_start), 3))])
+    _write_atomic(path, '\n'.join(lines) + '\n')
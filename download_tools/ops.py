@@ -0,0 +1,183 @@
+"""
+Operational downloads of all our forcing sources (GFS, HYCOM and Mercator) in a single process
+
+The sources hit different servers and share nothing, so rather than running
+download_gfs_atm, download_hycom_ops and download_mercator_ops one after the
+other, download_ops builds a graph of tasks (a download task per variable, plus
+the merge steps which depend on them) and runs it on one shared thread pool.
+Each source finishes independently - a failing source doesn't stop the others -
+so the time to a complete forcing set approaches that of the slowest source.
+"""
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from download_tools import metrics, throttle
+
+OPS_SOURCES = ['gfs', 'hycom', 'mercator']
+
+class Task:
+    """
+    A node in the task graph: func is called with no arguments once all the
+    tasks named in deps have completed
+    """
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.status = 'pending'
+        self.start = None
+        self.end = None
+        self.error = None
+
+def run_graph(tasks, max_workers):
+    """
+    Run the tasks on a pool of max_workers threads, each as soon as its
+    dependencies are done. A failed task causes everything downstream of it
+    to be skipped, while the rest of the graph carries on.
+    """
+    by_name = {t.name: t for t in tasks}
+    pending = list(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for t in list(pending):
+                dep_status = [by_name[d].status if d in by_name else 'failed' for d in t.deps]
+                if any(s in ('failed', 'skipped') for s in dep_status):
+                    print(f'[ops] {t.name} skipped as a dependency failed')
+                    t.status = 'skipped'
+                    pending.remove(t)
+                elif all(s == 'done' for s in dep_status):
+                    t.status = 'running'
+                    t.start = time.time()
+                    running[pool.submit(metrics.in_scope(t.func))] = t
+                    pending.remove(t)
+            if not running:
+                # nothing left that can run (e.g. a dependency cycle)
+                for t in pending:
+                    t.status = 'skipped'
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                t = running.pop(future)
+                t.end = time.time()
+                try:
+                    future.result()
+                    t.status = 'done'
+                    print(f'[ops] {t.name} done in {t.end - t.start:.1f} s')
+                except (Exception, SystemExit) as e:
+                    # SystemExit too, as get_latest_available_dt exits if there's no GFS data
+                    t.status = 'failed'
+                    t.error = e
+                    print(f'[ops] {t.name} FAILED: {e}')
+                    traceback.print_exc()
+    return tasks
+
+def gfs_tasks(domain, run_date, hdays, fdays, outputDir, progressive=False, deadline=None):
+    from download_tools.gfs import download_gfs_atm
+    # a single task, as the concurrency controller for NOMADS already sets how many GFS files download at once
+    return [Task('gfs', lambda: download_gfs_atm(domain, run_date, hdays, fdays, outputDir, progressive, deadline))]
+
+def hycom_tasks(domain, run_date, hdays, fdays, outputDir, output_format='nc', tile_cache=None,
+                reuse=False, reuse_dir=None):
+    from download_tools.hycom import (download_hycom, download_hycom_reusing, merge_hycom_ops, hycom_ops_dates,
+                                      update_var_list, HYCOM_OPS_VARS, HYCOM_OPS_DEPTHS)
+    start_date, end_date = hycom_ops_dates(run_date, hdays, fdays)
+    VARIABLES = update_var_list(HYCOM_OPS_VARS, run_date)
+    tasks = []
+    reuse_dirs = [outputDir] + ([reuse_dir] if reuse_dir else [])
+    for var, info in VARIABLES.items():
+        if reuse:
+            func = lambda info=info: download_hycom_reusing(
+                info["dataset"], info["var_id"], start_date, end_date, domain, HYCOM_OPS_DEPTHS,
+                outputDir, info["fname"], run_date, reuse_dirs, tile_cache)
+        else:
+            func = lambda info=info: download_hycom(
+                info["dataset"], info["var_id"], start_date, end_date, domain, HYCOM_OPS_DEPTHS,
+                outputDir, info["fname"], tile_cache)
+        tasks.append(Task(f'hycom:{var}', func))
+    tasks.append(Task('hycom:merge', lambda: merge_hycom_ops(domain, run_date, start_date, end_date, outputDir,
+                                                                 output_format),
+                      deps=[t.name for t in tasks]))
+    return tasks
+
+def mercator_tasks(usrname, passwd, domain, run_date, hdays, fdays, outputDir, output_format='nc',
+                   tile_cache=None):
+    from download_tools.cmems import (download_cmems_split, merge_mercator_ops, mercator_ops_dates,
+                                      mercator_variables, MERCATOR_DEPTHS)
+    start_date, end_date = mercator_ops_dates(run_date, hdays, fdays)
+    tasks = []
+    for var in mercator_variables(run_date):
+        tasks.append(Task(f'mercator:{var["name"]}', lambda var=var: download_cmems_split(
+            usrname, passwd, var["id"], var["vars"], start_date, end_date, domain, MERCATOR_DEPTHS,
+            outputDir, var["fname"], tile_cache=tile_cache)))
+    tasks.append(Task('mercator:merge', lambda: merge_mercator_ops(domain, run_date, start_date, end_date, outputDir,
+                                                                       output_format),
+                      deps=[t.name for t in tasks]))
+    return tasks
+
+def download_ops(domain, run_date, hdays, fdays, outputDir, sources=OPS_SOURCES,
+                 usrname=None, passwd=None, max_workers=10, bandwidth=None, output_format='nc',
+                 tile_cache=None, gfs_progressive=False, gfs_deadline=None,
+                 hycom_reuse=False, hycom_reuse_dir=None):
+    """
+    Download the forcing for an operational run from all the requested sources concurrently
+
+    INPUTS:
+    domain      : [lon_min, lon_max, lat_min, lat_max]
+    run_date    : datetime of the run
+    hdays       : hindcast days i.e before run_date
+    fdays       : forecast days i.e after run_date
+    outputDir   : each source is written to its own subdirectory (gfs, hycom, mercator) of outputDir
+    sources     : list of sources to download, any of 'gfs', 'hycom' and 'mercator'
+    usrname     : Copernicus username (only needed for 'mercator')
+    passwd      : Copernicus password (only needed for 'mercator')
+    max_workers : global limit on the number of concurrent download/merge tasks
+    bandwidth   : global bandwidth budget in bytes/s (None for unlimited)
+    output_format : 'nc' or 'zarr' for the merged hycom and mercator output (GFS is always grib)
+    tile_cache  : directory of the tile cache shared between domains (see tiles.py), for hycom and mercator
+    gfs_progressive, gfs_deadline : progressive GFS download (see gfs.download_gfs_atm)
+    hycom_reuse, hycom_reuse_dir : reuse the days we have from previous hycom runs (see hycom.download_hycom_ops)
+    """
+    _now = datetime.now()
+    unknown = set(sources) - set(OPS_SOURCES)
+    if unknown:
+        raise ValueError(f"Unknown source(s) {sorted(unknown)}, expected any of {OPS_SOURCES}")
+    if 'mercator' in sources and (usrname is None or passwd is None):
+        raise ValueError("usrname and passwd are needed to download mercator")
+
+    throttle.set_bandwidth(bandwidth)
+
+    tasks = []
+    for source in sources:
+        source_dir = os.path.join(outputDir, source)
+        os.makedirs(source_dir, exist_ok=True)
+        if source == 'gfs':
+            tasks += gfs_tasks(domain, run_date, hdays, fdays, source_dir, gfs_progressive, gfs_deadline)
+        elif source == 'hycom':
+            tasks += hycom_tasks(domain, run_date, hdays, fdays, source_dir, output_format, tile_cache,
+                                 hycom_reuse, hycom_reuse_dir)
+        elif source == 'mercator':
+            tasks += mercator_tasks(usrname, passwd, domain, run_date, hdays, fdays, source_dir,
+                                    output_format, tile_cache)
+
+    t0 = time.time()
+    run_graph(tasks, max_workers)
+
+    # summary of when each source was complete
+    print('\nOps download summary:')
+    failed = []
+    for source in sources:
+        source_tasks = [t for t in tasks if t.name.split(':')[0] == source]
+        if all(t.status == 'done' for t in source_tasks):
+            print(f'  {source:<9} complete after {max(t.end for t in source_tasks) - t0:.1f} s')
+        else:
+            failed.append(source)
+            print(f'  {source:<9} FAILED ({", ".join(t.name for t in source_tasks if t.status != "done")})')
+    print("Ops download finished (in " + str(datetime.now() - _now) + " h:m:s)")
+
+    if failed:
+        raise RuntimeError(f"Ops download failed for: {', '.join(failed)}")
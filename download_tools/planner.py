@@ -0,0 +1,346 @@
+"""
+Request planner: estimates the size of a download before anything is fetched,
+and chooses how to split it into requests
+
+The estimate comes from the grid of each dataset (resolution, depth levels and
+time step), which is cached in a small JSON file (SOMISANA_METADATA_CACHE,
+default ~/.cache/somisana/metadata.json). HYCOM datasets are described by
+opening them over OPeNDAP once (only the coordinates are read); CMEMS and GFS
+grids come from the tables below, the CMEMS time step and resolution being
+read from the dataset id where possible.
+
+The downloaders split their requests so that each one stays below the target
+request size (SOMISANA_TARGET_REQUEST_MB, default 200 MB) and the server's limit
+(e.g. THREDDS refuses OPeNDAP responses over 500 MB by default), and every cli
+subcommand has a --dry_run option printing the plan, total volume and an
+estimated time instead of downloading.
+"""
+import calendar
+import json
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from download_tools.locking import atomic_write
+
+# largest response each server will give us, in bytes (None for no limit)
+SERVER_LIMITS = {'hycom': 500e6, 'cmems': 2e9, 'gfs': None}
+TARGET_REQUEST_BYTES = float(os.environ.get('SOMISANA_TARGET_REQUEST_MB', 200)) * 1e6
+
+# rough transfer rate per request (bytes/s) and fixed cost per request (s), for the time estimate
+THROUGHPUT = {'hycom': 2e6, 'cmems': 5e6, 'gfs': 2e6}
+REQUEST_OVERHEAD = {'hycom': 10., 'cmems': 15., 'gfs': 1.}
+
+HYCOM_DEPTHS = [0, 2, 4, 6, 8, 10, 12, 15, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 90, 100, 125, 150, 200,
+                250, 300, 350, 400, 500, 600, 700, 800, 900, 1000, 1250, 1500, 2000, 2500, 3000, 4000, 5000]
+CMEMS_DEPTHS = [0.494, 1.541, 2.646, 3.819, 5.078, 6.441, 7.930, 9.573, 11.405, 13.467, 15.810, 18.496,
+                21.599, 25.211, 29.445, 34.434, 40.344, 47.374, 55.764, 65.807, 77.854, 92.326, 109.729,
+                130.666, 155.851, 186.126, 222.475, 266.040, 318.127, 380.213, 453.938, 541.089, 643.567,
+                763.333, 902.339, 1062.440, 1245.291, 1452.251, 1684.284, 1941.893, 2225.078, 2533.336,
+                2865.703, 3220.820, 3597.032, 3992.484, 4405.224, 4833.291, 5274.784, 5727.917]
+
+# variables without a depth dimension
+SURFACE_VARS = {'surf_el', 'ssh', 'qtot', 'emp', 'steric_ssh', 'u_barotropic_velocity', 'v_barotropic_velocity',
+                'surface_boundary_layer_thickness', 'mixed_layer_thickness', 'zos', 'mlotst', 'bottomT',
+                'sithick', 'siconc', 'usi', 'vsi', 'sob', 'tob', 'CHL', 'CHL_uncertainty', 'flags'}
+
+# GFS 0.25 deg: one file per forecast hour, ~20 grib records of ~2 bytes per point
+GFS_GRID = {'dlon': 0.25, 'dlat': 0.25, 'depths': None, 'dt_hours': 1, 'itemsize': 2, 'records': 20}
+
+def metadata_cache_path():
+    return os.environ.get('SOMISANA_METADATA_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'somisana', 'metadata.json'))
+
+# the metadata already looked up by this process (e.g. the download daemon, see server.py)
+_memory = {}
+_memory_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+def _load_cache():
+    try:
+        with open(metadata_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(key, value):
+    """
+    Add the metadata of a dataset to the cache file. The variables of a download
+    look their datasets up from parallel threads (and runs from parallel
+    processes), so the file is re-read and written under a lock, and atomically.
+    The cache is best effort: it's not saved if it can't be written
+    """
+    path = metadata_cache_path()
+    with _cache_lock:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cache = _load_cache()
+            cache[key] = value
+            with atomic_write(path) as tmp:
+                with open(tmp, 'w') as f:
+                    json.dump(cache, f, indent=1)
+        except OSError as e:
+            print(f'[planner] could not save the metadata cache {path} ({e})')
+
+def _describe_opendap(url):
+    from download_tools import transport
+    with transport.open_dataset(url, decode_times=False) as ds:
+        lon, lat, time = ds['lon'].values, ds['lat'].values, ds['time'].values
+        units = ds['time'].attrs.get('units', 'hours')
+        dt = float(np.median(np.diff(time[-100:]))) if time.size > 1 else 24.
+        return {
+            'dlon': float(np.median(np.diff(lon))),
+            'dlat': float(np.median(np.diff(lat))),
+            'depths': [float(d) for d in ds['depth'].values] if 'depth' in ds.coords else None,
+            'dt_hours': dt * 24. if units.startswith('days') else dt / 3600. if units.startswith('seconds') else dt,
+            'itemsize': 4,
+        }
+
+def _describe_cmems(dataset):
+    # e.g. cmems_mod_glo_phy-so_anfc_0.083deg_PT6H-i, cmems_mod_glo_phy_my_0.083deg_P1D-m
+    res = re.search(r'_(\d+(?:\.\d+)?)deg', dataset)
+    km = re.search(r'_(\d+)km', dataset)
+    step = re.search(r'_P(T?)(\d+)([HDM])', dataset)
+    d = float(res.group(1)) if res else (int(km.group(1)) / 111. if km else 1 / 12.)
+    dt = 24.
+    if step:
+        n, unit = int(step.group(2)), step.group(3)
+        dt = n if step.group(1) else {'D': 24 * n, 'M': 24 * 30 * n}.get(unit, 24 * n)
+    return {'dlon': d, 'dlat': d, 'depths': None if '_obs' in dataset else CMEMS_DEPTHS,
+            'dt_hours': dt, 'itemsize': 4}
+
+def dataset_metadata(source, dataset):
+    """
+    Grid of a dataset: resolution (deg), depth levels, time step (hours) and bytes per value
+    """
+    if source == 'gfs':
+        return GFS_GRID
+    key = f'{source}:{dataset}'
+    with _memory_lock:
+        if key in _memory:
+            return _memory[key]
+    cache = _load_cache()
+    if key not in cache:
+        if source == 'hycom':
+            try:
+                cache[key] = _describe_opendap(dataset)
+            except Exception as e:
+                print(f'[planner] could not describe {dataset} ({e}), assuming the GLBy0.08 grid')
+                return {'dlon': 0.08, 'dlat': 0.04, 'depths': HYCOM_DEPTHS, 'dt_hours': 3, 'itemsize': 4}
+        else:
+            cache[key] = _describe_cmems(dataset)
+        _save_cache(key, cache[key])
+    with _memory_lock:
+        _memory[key] = cache[key]
+    return cache[key]
+
+def bytes_per_step(meta, domain, depths, variables):
+    """
+    Bytes of a single time step of the variables over domain and the depth range
+    """
+    nlon = int((domain[1] - domain[0]) / meta['dlon']) + 1
+    nlat = int((domain[3] - domain[2]) / meta['dlat']) + 1
+    nz = 1
+    if meta.get('depths') and depths is not None:
+        nz = max(1, sum(depths[0] <= z <= depths[-1] for z in meta['depths']))
+    total = 0
+    for v in variables:
+        total += nlon * nlat * (1 if v in SURFACE_VARS else nz) * meta['itemsize'] * meta.get('records', 1)
+    return total
+
+def request_limit(source):
+    limit = SERVER_LIMITS.get(source)
+    return min(TARGET_REQUEST_BYTES, limit) if limit else TARGET_REQUEST_BYTES
+
+def steps_per_request(step_bytes, nsteps, source):
+    """
+    The most time steps we can put in one request of this source
+    """
+    return int(max(1, min(nsteps, request_limit(source) // max(step_bytes, 1))))
+
+def periods(start, end, hours):
+    """
+    Consecutive periods of the given length from start to end
+    """
+    out = []
+    t = start
+    while t <= end:
+        out.append((t, min(t + timedelta(hours=hours) - timedelta(seconds=1), end)))
+        t = t + timedelta(hours=hours)
+    return out
+
+def split_period(start, end, step_hours, step_bytes, source, align_hours=None):
+    """
+    Split [start, end] into consecutive periods of whole steps, each within the request limit.
+    align_hours rounds the period length down to a multiple (e.g. 24 for whole days)
+    """
+    nsteps = int((end - start).total_seconds() / 3600. / step_hours) + 1
+    hours = steps_per_request(step_bytes, nsteps, source) * step_hours
+    if align_hours:
+        hours = max(align_hours, hours // align_hours * align_hours)
+    return periods(start, end, hours)
+
+def months(start_date, end_date):
+    """
+    (first day, last day) of each month from start_date to end_date, as downloaded by the monthly downloaders
+    """
+    out = []
+    d = datetime(start_date.year, start_date.month, 1)
+    while d <= end_date:
+        out.append((d, datetime(d.year, d.month, calendar.monthrange(d.year, d.month)[1])))
+        d = d + timedelta(days=32)
+        d = datetime(d.year, d.month, 1)
+    return out
+
+def cmems_periods(dataset, varlist, start_date, end_date, domain, depths):
+    """
+    Whole-day periods from start_date to end_date (days), each small enough for one CMEMS request
+    """
+    meta = dataset_metadata('cmems', dataset)
+    step_bytes = bytes_per_step(meta, domain, depths, varlist)
+    end = datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59)
+    return split_period(start_date, end, meta['dt_hours'], step_bytes, 'cmems', align_hours=24)
+
+def gofs31_periods(url, var_list, month_start, month_end, domain, depths):
+    """
+    Periods of a month of GOFS 3.1 data, each small enough for one OPeNDAP request:
+    days (as the downloader always did) unless a day is too big, then fewer time steps
+    """
+    meta = dataset_metadata('hycom', url)
+    step_bytes = bytes_per_step(meta, domain, depths, var_list)
+    if step_bytes * 24. / meta['dt_hours'] <= request_limit('hycom'):
+        return periods(month_start, month_end, 24)
+    return periods(month_start, month_end, steps_per_request(step_bytes, 1e9, 'hycom') * meta['dt_hours'])
+
+def hycom_days_per_request(dataset, var, domain, depths, ndays):
+    """
+    The number of daily means download_hycom loads per OPeNDAP request
+    """
+    meta = dataset_metadata('hycom', dataset)
+    day_bytes = bytes_per_step(meta, domain, depths, [var]) * 24. / meta['dt_hours']
+    return steps_per_request(day_bytes, ndays, 'hycom')
+
+class Plan:
+    """
+    The requests a download will make, for printing with --dry_run
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.requests = []  # (source, description, bytes)
+
+    def add(self, source, description, nbytes):
+        self.requests.append((source, description, nbytes))
+
+    def extend(self, other):
+        self.requests += other.requests
+
+    def estimated_time(self):
+        """
+        Rough wall time, assuming the initial concurrency of each endpoint
+        """
+        from download_tools.concurrency import ENDPOINT_LIMITS
+        parallel = {'hycom': ENDPOINT_LIMITS['tds.hycom.org'][0], 'cmems': ENDPOINT_LIMITS['copernicusmarine'][0],
+                    'gfs': ENDPOINT_LIMITS['nomads.ncep.noaa.gov'][0]}
+        per_source = {}
+        for source, _, nbytes in self.requests:
+            t = REQUEST_OVERHEAD.get(source, 10.) + nbytes / THROUGHPUT.get(source, 2e6)
+            per_source[source] = per_source.get(source, 0.) + t / parallel.get(source, 1)
+        # sources download concurrently (download_ops) so the slowest one sets the time
+        return max(per_source.values()) if per_source else 0.
+
+    def print(self, max_lines=20):
+        total = sum(r[2] for r in self.requests)
+        print(f'\nPlan for {self.title}: {len(self.requests)} requests')
+        for i, (source, description, nbytes) in enumerate(self.requests):
+            if i == max_lines:
+                print(f'  ... {len(self.requests) - max_lines} more')
+                break
+            print(f'  {source:<6} {description:<60} {nbytes / 1e6:10.1f} MB')
+        print(f'Total: {total / 1e6:.1f} MB, largest request {max([r[2] for r in self.requests] or [0]) / 1e6:.1f} MB'
+              f' (target {TARGET_REQUEST_BYTES / 1e6:.0f} MB), estimated time {timedelta(seconds=int(self.estimated_time()))}')
+        return self
+
+# ------------------------------------------------------------
+# plans of each downloader, mirroring how they split their requests
+# ------------------------------------------------------------
+
+def plan_hycom(dataset, var, start_date, end_date, domain, depths):
+    plan = Plan(f'hycom {var}')
+    meta = dataset_metadata('hycom', dataset)
+    day_bytes = bytes_per_step(meta, domain, depths, [var]) * 24. / meta['dt_hours']
+    ndays = int((end_date - start_date).total_seconds() // 86400) + 1
+    per = hycom_days_per_request(dataset, var, domain, depths, ndays)
+    for k in range(0, ndays, per):
+        n = min(per, ndays - k)
+        plan.add('hycom', f'{var} {start_date + timedelta(days=k):%Y-%m-%d} +{n}d', day_bytes * n)
+    return plan
+
+def plan_hycom_ops(domain, run_date, hdays, fdays):
+    from download_tools.hycom import hycom_ops_dates, update_var_list, HYCOM_OPS_VARS, HYCOM_OPS_DEPTHS
+    start_date, end_date = hycom_ops_dates(run_date, hdays, fdays)
+    plan = Plan('download_hycom_ops')
+    for var, info in update_var_list(HYCOM_OPS_VARS, run_date).items():
+        plan.extend(plan_hycom(info['dataset'], info['var_id'], start_date, end_date, domain, HYCOM_OPS_DEPTHS))
+    return plan
+
+def plan_hycom_gofs31(domain, start_date, end_date, var_list=None, depths=[0, 5000], surface=False):
+    from download_tools.hycom import gofs31_dataset
+    plan = Plan('download_hycom_gofs31')
+    for month_start, month_end in months(start_date, end_date):
+        url, variables = gofs31_dataset(month_start.year, var_list, surface)
+        meta = dataset_metadata('hycom', url)
+        step_bytes = bytes_per_step(meta, domain, depths, variables)
+        for p0, p1 in gofs31_periods(url, variables, month_start, month_end.replace(hour=23, minute=59, second=59),
+                                     domain, depths):
+            nsteps = int((p1 - p0).total_seconds() / 3600. / meta['dt_hours']) + 1
+            plan.add('hycom', f'{p0:%Y-%m-%d %H:%M} to {p1:%Y-%m-%d %H:%M}', step_bytes * nsteps)
+    return plan
+
+def plan_cmems(dataset, varlist, start_date, end_date, domain, depths):
+    plan = Plan(dataset)
+    meta = dataset_metadata('cmems', dataset)
+    step_bytes = bytes_per_step(meta, domain, depths, varlist)
+    for p0, p1 in cmems_periods(dataset, varlist, start_date, end_date, domain, depths):
+        nsteps = int((p1 - p0).total_seconds() / 3600. / meta['dt_hours']) + 1
+        plan.add('cmems', f'{dataset} {p0:%Y-%m-%d} to {p1:%Y-%m-%d}', step_bytes * nsteps)
+    return plan
+
+def plan_cmems_monthly(dataset, domain, start_date, end_date, varlist, depths):
+    plan = Plan('download_cmems_monthly')
+    for month_start, month_end in months(start_date, end_date):
+        plan.extend(plan_cmems(dataset, varlist, month_start, month_end, domain, depths))
+    return plan
+
+def plan_mercator_ops(domain, run_date, hdays, fdays):
+    from download_tools.cmems import mercator_ops_dates, mercator_variables, MERCATOR_DEPTHS
+    start_date, end_date = mercator_ops_dates(run_date, hdays, fdays)
+    plan = Plan('download_mercator_ops')
+    for var in mercator_variables(run_date):
+        plan.extend(plan_cmems(var['id'], var['vars'], start_date, end_date, domain, MERCATOR_DEPTHS))
+    return plan
+
+def plan_gfs_atm(domain, run_date, hdays, fdays):
+    """
+    One file per hour (the hindcast from the 6 hourly cycles, the forecast from the latest)
+    """
+    plan = Plan('download_gfs_atm')
+    step_bytes = bytes_per_step(GFS_GRID, domain, None, ['gfs'])
+    nfiles = int((hdays + 0.25) * 24) + sum(1 for i in range(1, int((fdays + 0.25) * 24) + 1)
+                                            if i <= 120 or i % 3 == 0)
+    for i in range(nfiles):
+        plan.add('gfs', f'file {i + 1} of {nfiles}', step_bytes)
+    return plan
+
+def plan_ops(domain, run_date, hdays, fdays, sources):
+    plan = Plan('download_ops')
+    if 'gfs' in sources:
+        plan.extend(plan_gfs_atm(domain, run_date, hdays, fdays))
+    if 'hycom' in sources:
+        plan.extend(plan_hycom_ops(domain, run_date, hdays, fdays))
+    if 'mercator' in sources:
+        plan.extend(plan_mercator_ops(domain, run_date, hdays, fdays))
+    return plan
@@ -0,0 +1,183 @@
+"""
+Timeline profiling of the downloaders (the --profile option of cli.py)
+
+When profiling is on, the time spent in every step of every download is recorded
+as a span, per process and thread, and written as a Chrome trace (JSON), which
+can be opened in https://ui.perfetto.dev or chrome://tracing. The spans are
+    - the files, slices and merges of metrics.track, with their phases (wait,
+      transfer, backoff, write)
+    - connect (DNS, TCP and TLS of a new connection) and request (until the
+      response headers, i.e. the queueing on the server) of http_pool
+    - decode (decode_time_units), resample, open_mfdataset (the metadata scan of
+      the files being merged), to_netcdf (see encoding.write_netcdf) and validate
+      (the checks of the downloaded files)
+and anything else wrapped in span() or traced(). Optionally, a cProfile of
+every thread of the main process is also written (a pstats file, e.g. for
+snakeviz or python -m pstats).
+
+Each process appends its finished spans to its own file in <trace>.parts, so
+the spans of worker processes are kept even if they exit without cleaning up,
+and stop() merges them into the trace. Processes started with spawn rather than
+fork find the parts directory in SOMISANA_PROFILE.
+
+When profiling is off, span() returns a shared no-op context manager, so the
+spans left in the code cost next to nothing.
+"""
+import contextlib
+import glob
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+ENABLED = False
+_parts = None         # directory of the per-process span files
+_trace = None         # the trace being recorded (main process only)
+_pstats = None
+_profilers = []
+_file = None
+_file_pid = None
+_named = set()        # threads already named in the span file of this process
+_lock = threading.Lock()
+_NULL = contextlib.nullcontext()
+
+def _open_part():
+    # called with _lock held; a forked child gets its own file
+    global _file, _file_pid
+    if _file_pid != os.getpid():
+        _file = open(os.path.join(_parts, f'{os.getpid()}.jsonl'), 'a')
+        _file_pid = os.getpid()
+        _named.clear()
+        _file.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0,
+                                'args': {'name': f'{os.path.basename(sys.argv[0])} ({os.getpid()})'}}) + '\n')
+    return _file
+
+def record(name, cat, t0, t1, args=None):
+    """
+    Record a span from t0 to t1 (time.time())
+    """
+    global ENABLED
+    tid = threading.get_ident()
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': t0 * 1e6, 'dur': (t1 - t0) * 1e6,
+             'pid': os.getpid(), 'tid': tid}
+    if args:
+        event['args'] = {k: str(v) for k, v in args.items()}
+    with _lock:
+        try:
+            f = _open_part()
+            if tid not in _named:
+                _named.add(tid)
+                f.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                    'args': {'name': threading.current_thread().name}}) + '\n')
+            f.write(json.dumps(event) + '\n')
+            f.flush()
+        except OSError:
+            # e.g. a process outliving the trace, whose parts were already merged
+            ENABLED = False
+
+@contextlib.contextmanager
+def _span(name, cat, args):
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        record(name, cat, t0, time.time(), args)
+
+def span(name, cat='step', **args):
+    """
+    Context manager recording a span (a no-op when profiling is off) e.g.
+        with span('decode', 'hycom', file=fname):
+            ...
+    """
+    if not ENABLED:
+        return _NULL
+    return _span(name, cat, args)
+
+def traced(name=None, cat='step'):
+    """
+    Decorator recording every call of a function as a span
+    """
+    def decorator(f):
+        label = name or f.__name__
+        def wrapper(*a, **kw):
+            if not ENABLED:
+                return f(*a, **kw)
+            with _span(label, cat, None):
+                return f(*a, **kw)
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        wrapper.__wrapped__ = f
+        return wrapper
+    return decorator
+
+def _profile_thread(frame, event, arg):
+    # installed with threading.setprofile: starts a cProfile in each new thread
+    import cProfile
+    sys.setprofile(None)
+    profiler = cProfile.Profile()
+    with _lock:
+        _profilers.append(profiler)
+    profiler.enable()
+
+def start(trace, pstats=None):
+    """
+    Start recording spans for the trace file trace, and a cProfile written to
+    pstats (if given) of the main process
+    """
+    global ENABLED, _parts, _trace, _pstats
+    _trace = os.path.abspath(trace)
+    _parts = f'{_trace}.parts'
+    shutil.rmtree(_parts, ignore_errors=True)
+    os.makedirs(_parts)
+    os.environ['SOMISANA_PROFILE'] = _parts
+    ENABLED = True
+    if pstats is not None:
+        import cProfile
+        _pstats = pstats
+        threading.setprofile(_profile_thread)
+        profiler = cProfile.Profile()
+        _profilers.append(profiler)
+        profiler.enable()
+
+def stop():
+    """
+    Stop recording, and write the trace (and the cProfile)
+    """
+    global ENABLED, _file, _file_pid
+    if not ENABLED or _trace is None:
+        return
+    ENABLED = False
+    if _pstats is not None:
+        import pstats
+        threading.setprofile(None)
+        for profiler in _profilers:
+            profiler.disable()
+        stats = pstats.Stats(*_profilers)
+        stats.dump_stats(_pstats)
+        print(f'[profile] cProfile of {len(_profilers)} threads written to {_pstats}')
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file, _file_pid = None, None
+    events = []
+    for part in sorted(glob.glob(os.path.join(_parts, '*.jsonl'))):
+        with open(part) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass   # the last line of a process which was killed while writing
+    tmp = f'{_trace}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmp, _trace)
+    shutil.rmtree(_parts, ignore_errors=True)
+    os.environ.pop('SOMISANA_PROFILE', None)
+    print(f'[profile] {sum(e["ph"] == "X" for e in events)} spans written to {_trace}')
+
+# processes started with spawn (e.g. by multiprocessing) inherit the parts directory through the environment
+if os.environ.get('SOMISANA_PROFILE') and os.path.isdir(os.environ['SOMISANA_PROFILE']):
+    _parts = os.environ['SOMISANA_PROFILE']
+    ENABLED = True
@@ -0,0 +1,325 @@
+"""
+Long-running download daemon (cli.py serve), and its client (cli.py submit / jobs)
+
+Each cli.py invocation is normally a cold start: importing the scientific stack,
+starting the CMEMS client, opening new connections to NOMADS. The daemon pays
+for this once and keeps it warm between jobs:
+    - the downloader modules stay imported
+    - HTTP connections stay open in the shared pool (see http_pool.py)
+    - the CMEMS requests run through the copernicusmarine python client in
+      this process, rather than a new client process per request
+    - the dataset metadata of the planner stays in memory (see planner.py)
+    - all jobs share the concurrency controllers of the endpoints (see
+      concurrency.py), so concurrent jobs don't overload a server between them
+
+Jobs are the arguments of a cli.py command, e.g.
+    ['download_gfs_atm', '--domain', '11,36,-39,-25', '--run_date', '2024-01-10 00:00:00', ...]
+and are submitted either through the Unix socket (one JSON request per
+connection, answered with one JSON line):
+    {"op": "submit", "argv": [...], "wait": false} -> the job
+    {"op": "status", "id": "<job id>"}             -> the job, or all jobs without an id
+    {"op": "ping"}                                 -> the state of the daemon
+or by dropping a JSON file {"argv": [...]} into <spool>/incoming/, whose status
+is then kept in <spool>/jobs/<job id>.json. Jobs run on a pool of worker threads
+in the order they are submitted. The leases of the artifacts (see locking.py) are
+held per thread, so concurrent jobs wait for each other's files as separate
+processes would, and whatever leases a job still holds when it ends are released.
+
+The --metrics_json/--metrics_prom report of a job covers that job only (see
+metrics.scope). The options which set up the whole process (--profile,
+--memory_budget, --hedge, --record/--replay) are given to serve, and a job
+which has them is rejected. The socket is only open to the user running the
+daemon.
+"""
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DEFAULT_SOCKET = os.environ.get('SOMISANA_SOCKET', '/tmp/somisana-download.sock')
+SPOOL_POLL = 0.2
+
+# options of cli.py which set up the whole process, so they're given to serve rather than to a job
+PROCESS_OPTIONS = {'profile': '--profile', 'memory_budget': '--memory_budget', 'hedge': '--hedge',
+                   'record': '--record', 'replay': '--replay'}
+
+# job status values
+QUEUED = 'queued'
+RUNNING = 'running'
+OK = 'ok'
+FAILED = 'failed'
+
+class Job:
+    def __init__(self, argv, origin):
+        self.id = datetime.now().strftime('%Y%m%d_%H%M%S_') + uuid.uuid4().hex[:6]
+        self.argv = list(argv)
+        self.origin = origin
+        self.status = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {'id': self.id, 'argv': self.argv, 'origin': self.origin, 'status': self.status,
+                'submitted': datetime.fromtimestamp(self.submitted).isoformat(),
+                'queued': (self.started or time.time()) - self.submitted,
+                'wall': ((self.finished or time.time()) - self.started) if self.started else None,
+                'error': self.error}
+
+class Scheduler:
+    """
+    Runs the submitted jobs on a shared pool of worker threads
+    """
+
+    def __init__(self, parser, workers=4, spool=None):
+        self.parser = parser
+        self.spool = spool
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.started = time.time()
+
+    def parse(self, argv):
+        """
+        Parse the arguments of a job as cli.py would, raising ValueError with argparse's message
+        """
+        err = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(err):
+                args = self.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(err.getvalue().strip().splitlines()[-1] if err.getvalue().strip() else 'invalid arguments')
+        if not hasattr(args, 'func') or args.function in ('serve', 'submit', 'jobs', 'backfill'):
+            raise ValueError(f'not a download job: {argv}')
+        for dest, option in PROCESS_OPTIONS.items():
+            if getattr(args, dest, None):
+                raise ValueError(f'{option} applies to the whole daemon: give it to serve, not to a job')
+        return args
+
+    def submit(self, argv, origin='socket'):
+        args = self.parse(argv)
+        job = Job(argv, origin)
+        with self._lock:
+            self.jobs[job.id] = job
+        self._save(job)
+        print(f'[serve] job {job.id} queued: {" ".join(job.argv)}')
+        self._pool.submit(self._run, job, args)
+        return job
+
+    def _run(self, job, args):
+        from download_tools import locking, metrics
+        job.status = RUNNING
+        job.started = time.time()
+        self._save(job)
+        print(f'[serve] job {job.id} started after {job.started - job.submitted:.3f} s')
+        # the metrics of the tracks of this job only (and of the threads it starts)
+        scope = metrics.scope()
+        try:
+            with scope:
+                if getattr(args, 'dry_run', False):
+                    args.plan(args).print()
+                else:
+                    args.func(args)
+            job.status = OK
+        except BaseException as e:
+            # including SystemExit, from the functions which exit when there's no data
+            job.status = FAILED
+            job.error = f'{type(e).__name__}: {e}'
+            traceback.print_exc()
+        finally:
+            job.finished = time.time()
+            # leases are held per thread and this worker thread outlives the job, so
+            # those a failed job left (e.g. an exception between already_downloaded
+            # and the download) are released here rather than blocking the next jobs
+            # (those of the threads the job started go once the threads end, see locking.py)
+            left = locking.held(threading.get_ident())
+            if left:
+                print(f'[serve] job {job.id} left {len(left)} leases, releasing them')
+                locking.release_all(threading.get_ident())
+            if args.metrics_json:
+                metrics.write_json(args.metrics_json, command=args.function, status=job.status, scope=scope)
+            if args.metrics_prom:
+                metrics.write_prometheus(args.metrics_prom, command=args.function, status=job.status, scope=scope)
+            self._save(job)
+            job.done.set()
+            print(f'[serve] job {job.id} {job.status} in {job.finished - job.started:.1f} s')
+
+    def _save(self, job):
+        if self.spool is None:
+            return
+        path = os.path.join(self.spool, 'jobs', f'{job.id}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(job.to_dict(), f, indent=1)
+        os.replace(tmp, path)
+
+    def status(self, job_id=None):
+        with self._lock:
+            if job_id is None:
+                return [j.to_dict() for j in self.jobs.values()]
+            if job_id not in self.jobs:
+                raise KeyError(f'no job {job_id}')
+            return self.jobs[job_id].to_dict()
+
+    def wait(self, job_id, timeout=None):
+        with self._lock:
+            job = self.jobs[job_id]
+        job.done.wait(timeout)
+        return job.to_dict()
+
+    def watch_spool(self, stop):
+        """
+        Submit the job files dropped in <spool>/incoming until stop is set
+        """
+        incoming = os.path.join(self.spool, 'incoming')
+        while not stop.is_set():
+            for name in sorted(os.listdir(incoming)):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(incoming, name)
+                claimed = os.path.join(self.spool, 'claimed', name)
+                try:
+                    # claim the file, in case another daemon watches the same spool
+                    os.rename(path, claimed)
+                except FileNotFoundError:
+                    continue
+                try:
+                    with open(claimed) as f:
+                        self.submit(json.load(f)['argv'], origin=f'spool:{name}')
+                except Exception as e:
+                    print(f'[serve] rejected {name}: {e}')
+                    os.rename(claimed, os.path.join(self.spool, 'rejected', name))
+                else:
+                    os.remove(claimed)
+            stop.wait(SPOOL_POLL)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        scheduler = self.server.scheduler
+        try:
+            request = json.loads(self.rfile.readline())
+            op = request.get('op')
+            if op == 'submit':
+                job = scheduler.submit(request['argv'])
+                reply = scheduler.wait(job.id) if request.get('wait') else job.to_dict()
+            elif op == 'status':
+                reply = scheduler.status(request.get('id'))
+            elif op == 'ping':
+                from download_tools import http_pool
+                reply = {'pid': os.getpid(), 'uptime': time.time() - scheduler.started,
+                         'jobs': len(scheduler.jobs), 'idle_connections': http_pool.idle_connections()}
+            else:
+                raise ValueError(f'unknown op {op}')
+            response = {'ok': True, 'result': reply}
+        except Exception as e:
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _warm_cmems():
+    # run the CMEMS requests in this process (see cmems.download_cmems) if the python client is installed
+    import importlib.util
+    from download_tools import cmems
+    if importlib.util.find_spec('copernicusmarine') is not None:
+        import copernicusmarine  # noqa: F401 (imported once, here)
+        cmems.CMEMS_CLIENT = 'python'
+    print(f'[serve] CMEMS requests through the {cmems.CMEMS_CLIENT} client')
+
+def serve(parser, socket_path=DEFAULT_SOCKET, spool=None, workers=4, warmup=None):
+    """
+    Run the daemon until it's interrupted (SIGINT/SIGTERM), accepting jobs on the
+    Unix socket socket_path and from the spool directory (if given)
+
+    INPUTS:
+    parser      : the argparse parser of cli.py, used to parse the jobs
+    socket_path : path of the Unix socket
+    spool       : spool directory, None to only accept jobs on the socket
+    workers     : number of jobs running at once
+    warmup      : function called once at start up (e.g. importing the downloaders)
+    """
+    import signal
+    if warmup is not None:
+        warmup()
+    try:
+        _warm_cmems()
+    except ImportError as e:
+        print(f'[serve] CMEMS not warmed up: {e}')
+
+    if spool is not None:
+        for sub in ('incoming', 'claimed', 'jobs', 'rejected'):
+            os.makedirs(os.path.join(spool, sub), exist_ok=True)
+    scheduler = Scheduler(parser, workers, spool)
+
+    if os.path.exists(socket_path):
+        try:
+            request(socket_path, {'op': 'ping'})
+            raise RuntimeError(f'a daemon is already listening on {socket_path}')
+        except ConnectionError:
+            os.remove(socket_path)   # left behind by a daemon which was killed
+    # only our user can connect to the socket, i.e. submit jobs
+    umask = os.umask(0o177)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+    server.scheduler = scheduler
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=server.serve_forever, daemon=True)]
+    if spool is not None:
+        threads.append(threading.Thread(target=scheduler.watch_spool, args=(stop,), daemon=True))
+    for t in threads:
+        t.start()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    print(f'[serve] listening on {socket_path}' + (f' and {spool}/incoming' if spool else '') +
+          f' with {workers} workers')
+    try:
+        while not stop.is_set():
+            stop.wait(1.)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        print('[serve] shutting down, waiting for the running jobs')
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+        scheduler.shutdown()
+
+def request(socket_path, message, timeout=None):
+    """
+    Send a request to the daemon and return its reply
+    (ConnectionError if there is no daemon on socket_path)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        try:
+            s.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError(f'no download daemon on {socket_path}: {e}')
+        s.sendall((json.dumps(message) + '\n').encode())
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    response = json.loads(data)
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
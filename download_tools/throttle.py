@@ -0,0 +1,60 @@
+"""
+Global bandwidth budget shared by all the downloaders in a process
+
+By default there is no limit. Once set_bandwidth() is called, every downloader
+reports the bytes it receives through consume(), which sleeps as needed to keep
+the combined rate within the budget. Byte streams we read ourselves (GFS) are
+throttled as they arrive; OPeNDAP reads and CMEMS subsets are accounted for
+once each slice or file has arrived, which keeps the average rate in budget.
+"""
+import threading
+import time
+
+class BandwidthLimiter:
+    """
+    Virtual-time token bucket: each consume() books its bytes onto a shared
+    schedule at the given rate, and waits until its booking is no more than
+    `burst` seconds ahead of now
+    """
+
+    def __init__(self, rate, burst=1.):
+        self.rate = float(rate)
+        self.burst = burst
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(now, self._next) + nbytes / self.rate
+            wait = self._next - now - self.burst
+        if wait > 0:
+            time.sleep(wait)
+
+_limiter = None
+
+def set_bandwidth(rate):
+    """
+    Set the global budget in bytes/s (None to remove it)
+    """
+    global _limiter
+    _limiter = BandwidthLimiter(rate) if rate else None
+
+def consume(nbytes):
+    if _limiter is not None:
+        _limiter.consume(nbytes)
+
+def read(response, blocksize=1 << 16):
+    """
+    Read an http response in blocks, within the bandwidth budget
+    """
+    if _limiter is None:
+        return response.read()
+    chunks = []
+    while True:
+        chunk = response.read(blocksize)
+        if not chunk:
+            break
+        _limiter.consume(len(chunk))
+        chunks.append(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,142 @@
+"""
+Tile cache shared by overlapping domains
+
+Our domains overlap heavily (e.g. the cli defaults [10,25,-40,-25] and
+[23,34,-37,-31], plus the nested configurations), yet each is normally
+downloaded as its own box. With a tile cache, a request is split into fixed
+TILE_SIZE x TILE_SIZE degree tiles (aligned to multiples of TILE_SIZE, so the
+same tiles come up for every domain), each tile is downloaded into the cache
+with the usual downloader, and the domain is assembled from the cached tiles.
+The tiles of a request are cached per source/dataset/variable/time range, so
+the bytes transferred across all our domains scale with their union rather
+than their sum.
+
+Each grid point belongs to exactly one tile: tiles are downloaded with their
+bounds included, then trimmed to [x0, x0 + TILE_SIZE) x [y0, y0 + TILE_SIZE)
+when assembled, which keeps them aligned to the source grid whatever its
+resolution. A domain whose edge lies on a tile edge takes that edge from the
+tile inside the domain (which has it, since bounds are included) rather than
+fetching the whole tile beyond it for a single column. The cache directory has its own manifest, which is how a tile
+which is already there is found.
+"""
+import hashlib
+import os
+import threading
+from math import ceil, floor
+
+import numpy as np
+import xarray as xr
+
+from download_tools.encoding import write_netcdf
+from download_tools.locking import atomic_write
+from download_tools.manifest import get_manifest
+from download_tools.metrics import track
+
+TILE_SIZE = 5.
+
+# one lock per tile, so that concurrent requests for the same tile download it once
+_tile_locks = {}
+_tile_locks_lock = threading.Lock()
+
+def _tile_lock(path):
+    with _tile_locks_lock:
+        return _tile_locks.setdefault(path, threading.Lock())
+
+def tiles_for_domain(domain, tile_size=TILE_SIZE):
+    """
+    The tiles [lon0, lon1, lat0, lat1] needed to cover domain [lon_min, lon_max, lat_min, lat_max]
+    """
+    def indices(lo, hi):
+        # an upper edge on a tile edge is the last column of the tile below it, not a tile of its own
+        first = floor(lo / tile_size)
+        return range(first, max(ceil(hi / tile_size), first + 1))
+
+    tiles = []
+    for i in indices(domain[0], domain[1]):
+        for j in indices(domain[2], domain[3]):
+            tiles.append([i * tile_size, (i + 1) * tile_size, j * tile_size, (j + 1) * tile_size])
+    return tiles
+
+def tile_dir(tile_cache, source, dataset, key):
+    """
+    Cache directory for the tiles of a request e.g.
+    <tile_cache>/hycom/FMRC_ESPC-D-V02_s3z_best.ncd_1a2b3c4d/salinity_2024010800_2024011300_0_5000
+    (the hash tells apart datasets with the same name on different servers)
+    """
+    name = os.path.basename(dataset.rstrip('/'))
+    digest = hashlib.md5(dataset.encode()).hexdigest()[:8]
+    return os.path.join(tile_cache, source, f'{name}_{digest}', key)
+
+def _lonlat(ds):
+    lon = 'lon' if 'lon' in ds.dims else 'longitude'
+    lat = 'lat' if 'lat' in ds.dims else 'latitude'
+    return lon, lat
+
+def _below(values, upper, domain_upper):
+    return values < upper if upper < domain_upper else values <= upper
+
+def assemble(tile_files, tiles, domain, out_path, m=None):
+    """
+    Write the domain to out_path from the cached tile files (m is the track of the write, if any)
+    """
+    datasets = []
+    for fpath, tile in zip(tile_files, tiles):
+        ds = xr.open_dataset(fpath)
+        lon, lat = _lonlat(ds)
+        # each tile only keeps its half-open interval so that shared edges aren't duplicated,
+        # except the last tile of the domain, which also keeps its upper edge
+        ds = ds.isel({lon: np.where(_below(ds[lon].values, tile[1], domain[1]))[0],
+                      lat: np.where(_below(ds[lat].values, tile[3], domain[3]))[0]})
+        if ds[lon].size and ds[lat].size:
+            datasets.append(ds)
+    try:
+        merged = xr.combine_by_coords(datasets, combine_attrs='override')
+        lon, lat = _lonlat(merged)
+        merged = merged.sel({lon: slice(domain[0], domain[1]), lat: slice(domain[2], domain[3])})
+        with atomic_write(out_path) as tmp:
+            write_netcdf(merged, tmp, m)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+def download_tiled(source, dataset, key, domain, outputDir, fname, fetch, tile_cache, record,
+                   tile_size=TILE_SIZE):
+    """
+    Download domain into outputDir/fname through the tile cache
+
+    INPUTS:
+    source     : name of the source for the manifest and metrics (e.g. 'hycom')
+    dataset    : dataset id or url
+    key        : string identifying the rest of the request (variables, times, depths)
+    domain     : [lon_min, lon_max, lat_min, lat_max]
+    outputDir  : output directory of the domain
+    fname      : output file name of the domain
+    fetch      : fetch(tile, tile_dir, tile_fname) downloads the subset tile = [lon0, lon1, lat0, lat1]
+                 into tile_dir/tile_fname, skipping it if it's already there (i.e. the usual downloader)
+    tile_cache : root directory of the tile cache
+    record     : the manifest record of the domain file
+    """
+    out_path = os.path.join(outputDir, fname)
+    manifest = get_manifest(outputDir)
+    if manifest.already_downloaded(out_path, source, legacy_check=os.path.exists, **record):
+        print(f'\n{fname} already exist.\nDownload skipped.\n')
+        return
+
+    with manifest.downloading(out_path, source, **record):
+        cache = tile_dir(tile_cache, source, dataset, key)
+        os.makedirs(cache, exist_ok=True)
+        tiles = tiles_for_domain(domain, tile_size)
+        tile_files = []
+        missing = get_manifest(cache).missing([os.path.join(cache, f'tile_{t[0]:g}_{t[2]:g}.nc') for t in tiles])
+        print(f'{fname}: {len(tiles) - len(missing)} of {len(tiles)} tiles already in the cache')
+        for tile in tiles:
+            tile_fname = f'tile_{tile[0]:g}_{tile[2]:g}.nc'
+            tile_path = os.path.join(cache, tile_fname)
+            with _tile_lock(tile_path):
+                fetch(tile, cache, tile_fname)
+            tile_files.append(tile_path)
+
+        with track(source, fname, stage='merge') as m:
+            assemble(tile_files, tiles, domain, out_path, m)
+            m.add_bytes(os.path.getsize(out_path))
+        manifest.record(out_path, source, **record)
@@ -0,0 +1,692 @@
+"""
+Record and replay of the network traffic of the downloaders, for reproducible benchmarks
+
+The time a run takes depends on how NOMADS, THREDDS and the Copernicus services
+behave that morning, so a change to the downloaders can't be measured against
+the real servers, nor at all on a machine without internet access. The traffic
+of a run can instead be recorded into a cassette (the --record option of cli.py)
+and replayed from it later (--replay), with the servers emulated:
+    - http     : the requests of http_pool.urlopen (GFS), with the status,
+                 headers and body of each response, the time to the headers
+                 (latency) and the time the body took (transfer)
+    - opendap  : the datasets opened with open_dataset below (HYCOM), with the
+                 variables, dimensions and attributes of the dataset, and each
+                 array read with the time it took. netCDF-C does its own HTTP,
+                 so the traffic is recorded at the level of the reads instead
+    - file     : the requests of the clients which write a file (the
+                 copernicusmarine subset, the CDS API), with the file and the
+                 time it took
+A cassette is a directory with cassette.json (when and how it was recorded),
+exchanges.jsonl (a line per exchange, appended to by every process and thread of
+the run) and blobs/ (the bodies, arrays and files, by their hash).
+
+When replaying, the exchanges with the same request are served in the order they
+were recorded (the last one again once they run out), so e.g. a file which only
+appeared on the second try still does. The recorded timings are replayed as
+they were, unless overridden:
+    LATENCY    seconds before the response of every request (SOMISANA_REPLAY_LATENCY)
+    BANDWIDTH  bytes per second of a link shared by all the transfers (SOMISANA_REPLAY_BANDWIDTH)
+    ERRORS     fraction of the requests which fail, before or during the
+               transfer, to exercise the retries (SOMISANA_REPLAY_ERRORS)
+    SEED       of the failures, so they're the same from one replay to the next
+A request which isn't in the cassette fails as the server would (a URLError, a
+netCDF error), with a warning. The clock of the parts of the run which depend
+on the date of the day (e.g. the GFS cycle probed in gfs_mirrors.py, see
+utcnow) is set back to the time of the recording.
+
+Processes started by the run (workers, hedges) find the mode in
+SOMISANA_TRANSPORT (record:<dir> or replay:<dir>).
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import urllib.error
+from datetime import datetime, timedelta
+from http.client import HTTPMessage
+
+from download_tools.profiling import span
+
+MODE = None           # None, 'record' or 'replay'
+PATH = None           # the cassette
+LATENCY = None
+BANDWIDTH = None
+ERRORS = 0.
+SEED = 0
+
+def _from_env():
+    global MODE, PATH, LATENCY, BANDWIDTH, ERRORS, SEED
+    value = os.environ.get('SOMISANA_TRANSPORT')
+    if value:
+        MODE, PATH = value.split(':', 1)
+    if os.environ.get('SOMISANA_REPLAY_LATENCY'):
+        LATENCY = float(os.environ['SOMISANA_REPLAY_LATENCY'])
+    if os.environ.get('SOMISANA_REPLAY_BANDWIDTH'):
+        BANDWIDTH = float(os.environ['SOMISANA_REPLAY_BANDWIDTH'])
+    ERRORS = float(os.environ.get('SOMISANA_REPLAY_ERRORS', 0))
+    SEED = int(os.environ.get('SOMISANA_REPLAY_SEED', 0))
+
+_from_env()
+
+def start(mode, path, latency=None, bandwidth=None, errors=0., seed=0):
+    """
+    Record the traffic of the run to the cassette path, or replay it from there
+    (mode 'record' or 'replay'), in this process and the ones it starts
+    """
+    if mode not in ('record', 'replay'):
+        raise ValueError(f'Invalid transport mode {mode!r}')
+    path = os.path.abspath(path)
+    if mode == 'record':
+        os.makedirs(os.path.join(path, 'blobs'), exist_ok=True)
+        meta = os.path.join(path, 'cassette.json')
+        if not os.path.exists(meta):
+            with open(meta, 'w') as f:
+                json.dump({'recorded_at': datetime.utcnow().isoformat(), 'argv': sys.argv}, f, indent=1)
+    elif not os.path.isfile(os.path.join(path, 'exchanges.jsonl')):
+        raise FileNotFoundError(f'No cassette in {path} (record one with --record)')
+    os.environ['SOMISANA_TRANSPORT'] = f'{mode}:{path}'
+    for name, value in (('LATENCY', latency), ('BANDWIDTH', bandwidth), ('ERRORS', errors), ('SEED', seed)):
+        if value is not None:
+            os.environ[f'SOMISANA_REPLAY_{name}'] = str(value)
+    _from_env()
+
+# ------------------------------------------------------------
+# the cassette
+# ------------------------------------------------------------
+
+class Cassette:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._served = {}
+        self._missing = set()
+        self._exchanges = None
+        self._reads = None
+
+    def _blob_path(self, name):
+        return os.path.join(self.path, 'blobs', name)
+
+    def put_blob(self, data=None, src=None, ext=''):
+        """
+        Keep bytes data (or a copy of the file src) by their hash, returning its name
+        """
+        h = hashlib.sha1()
+        if src is None:
+            h.update(data)
+        else:
+            with open(src, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+        name = h.hexdigest() + ext
+        path = self._blob_path(name)
+        if not os.path.exists(path):
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            if src is None:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+            else:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+        return name
+
+    def blob(self, name):
+        with open(self._blob_path(name), 'rb') as f:
+            return f.read()
+
+    def blob_path(self, name):
+        return self._blob_path(name)
+
+    def add(self, exchange):
+        # a single write of a line to a file opened for appending, so the lines
+        # of concurrent processes don't interleave
+        line = json.dumps(exchange, default=str) + '\n'
+        with self._lock, open(os.path.join(self.path, 'exchanges.jsonl'), 'a') as f:
+            f.write(line)
+
+    def _load(self):
+        # called with _lock held
+        if self._exchanges is not None:
+            return
+        exchanges = []
+        with open(os.path.join(self.path, 'exchanges.jsonl')) as f:
+            for line in f:
+                if line.strip():
+                    exchanges.append(json.loads(line))
+        exchanges.sort(key=lambda e: e['t'])
+        self._exchanges, self._reads = {}, {}
+        for e in exchanges:
+            self._exchanges.setdefault((e['kind'], e['key']), []).append(e)
+            if e['kind'] == 'read':
+                self._reads.setdefault((e['url'], e['var']), []).append(e)
+
+    def next(self, kind, key, warn=True):
+        """
+        The next recorded exchange of the request (kind, key), None if there isn't any
+        """
+        with self._lock:
+            self._load()
+            recorded = self._exchanges.get((kind, key))
+            if not recorded:
+                if warn:
+                    self.missing(kind, key)
+                return None
+            i = self._served.get((kind, key), 0)
+            self._served[(kind, key)] = i + 1
+            return recorded[min(i, len(recorded) - 1)]
+
+    def missing(self, kind, key):
+        # once per request
+        if (kind, key) not in self._missing:
+            self._missing.add((kind, key))
+            print(f'WARNING: [transport] {kind} {key} is not in the cassette {self.path}')
+
+    def reads(self, url, var):
+        with self._lock:
+            self._load()
+            return self._reads.get((url, var), [])
+
+    def recorded_at(self):
+        try:
+            with open(os.path.join(self.path, 'cassette.json')) as f:
+                return datetime.fromisoformat(json.load(f)['recorded_at'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+def cassette():
+    global _cassette
+    with _cassette_lock:
+        if _cassette is None or _cassette.path != PATH:
+            _cassette = Cassette(PATH)
+        return _cassette
+
+_started = time.time()
+
+def utcnow():
+    """
+    datetime.utcnow(), or the time of the recording plus the time since the
+    start of the run when replaying
+    """
+    if MODE == 'replay':
+        recorded_at = cassette().recorded_at()
+        if recorded_at is not None:
+            return recorded_at + timedelta(seconds=time.time() - _started)
+    return datetime.utcnow()
+
+# ------------------------------------------------------------
+# network emulation
+# ------------------------------------------------------------
+
+_rng = None
+_rng_lock = threading.Lock()
+_link_free = 0.       # time the emulated link is free again (with BANDWIDTH)
+_link_lock = threading.Lock()
+
+def _fails(probability=None):
+    global _rng
+    probability = ERRORS if probability is None else probability
+    if not probability:
+        return False
+    with _rng_lock:
+        if _rng is None:
+            _rng = random.Random(SEED)
+        return _rng.random() < probability
+
+def _wait_latency(recorded):
+    delay = LATENCY if LATENCY is not None else recorded or 0.
+    if delay > 0:
+        time.sleep(delay)
+
+def _wait_transfer(nbytes, recorded_rate=None):
+    """
+    Sleep for the time nbytes take over the emulated link (shared by all the
+    transfers, first come first served), or at the recorded rate
+    """
+    global _link_free
+    if BANDWIDTH:
+        with _link_lock:
+            now = time.time()
+            _link_free = max(_link_free, now) + nbytes / BANDWIDTH
+            delay = _link_free - now
+    elif recorded_rate:
+        delay = nbytes / recorded_rate
+    else:
+        return
+    if delay > 0:
+        time.sleep(delay)
+
+# ------------------------------------------------------------
+# http (see http_pool.urlopen)
+# ------------------------------------------------------------
+
+def _http_key(url, headers, method):
+    key = f'{method} {url}'
+    rng = (headers or {}).get('Range')
+    return f'{key} [{rng}]' if rng else key
+
+def _http_headers(items):
+    headers = HTTPMessage()
+    for name, value in items:
+        headers[name] = value
+    return headers
+
+class _RecordingResponse:
+    """
+    A response of http_pool, with its body kept for the cassette as it's read
+    """
+
+    def __init__(self, key, t0, latency, response):
+        self._key = key
+        self._t0 = t0
+        self._latency = latency
+        self._response = response
+        self._chunks = []
+        self._first = None
+        self._eof = False
+        self._saved = False
+        self.url = response.url
+        self.status = self.code = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        if self._first is None:
+            self._first = time.time()
+        data = self._response.read() if amt is None else self._response.read(amt)
+        self._chunks.append(data)
+        if amt is None or not data:
+            self._eof = True
+            self._save()
+        return data
+
+    def _save(self):
+        if self._saved:
+            return
+        self._saved = True
+        c = cassette()
+        body = b''.join(self._chunks)
+        c.add({'kind': 'http', 'key': self._key, 't': self._t0, 'status': self.status,
+               'headers': list(self.headers.items()), 'latency': self._latency,
+               'transfer': time.time() - self._first if self._first is not None else 0.,
+               'bytes': len(body), 'complete': self._eof, 'blob': c.put_blob(body)})
+
+    def close(self):
+        self._save()
+        self._response.close()
+
+    def abort(self):
+        # a cancelled request (see hedging.py) isn't an exchange to replay
+        self._saved = True
+        self._response.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class _ReplayResponse:
+    """
+    A recorded response, served at the emulated latency and bandwidth
+    """
+
+    def __init__(self, url, exchange, body, fail=False):
+        self.url = url
+        self.status = self.code = exchange['status']
+        self.headers = _http_headers(exchange['headers'])
+        self._body = body
+        self._pos = 0
+        self._rate = exchange['bytes'] / exchange['transfer'] if exchange['transfer'] > 0 else None
+        # the point of the body where an injected failure cuts it, if any
+        self._cut = random.Random(SEED + len(body)).randrange(len(body)) if body and fail else None
+        self._aborted = False
+
+    def read(self, amt=None):
+        if self._aborted:
+            raise ConnectionAbortedError('connection aborted')
+        end = len(self._body) if amt is None else min(self._pos + amt, len(self._body))
+        if self._cut is not None and end > self._cut:
+            _wait_transfer(self._cut - self._pos, self._rate)
+            self._pos = self._cut
+            raise ConnectionResetError('connection reset by peer (injected)')
+        data = self._body[self._pos:end]
+        _wait_transfer(len(data), self._rate)
+        self._pos = end
+        return data
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self._aborted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def urlopen(url, headers, method, timeout, opener):
+    """
+    http_pool.urlopen through the cassette, opener being the real one
+    """
+    key = _http_key(url, headers, method)
+    if MODE == 'record':
+        t0 = time.time()
+        try:
+            response = opener(url, headers, method, timeout)
+        except urllib.error.HTTPError as e:
+            cassette().add({'kind': 'http', 'key': key, 't': t0, 'latency': time.time() - t0,
+                            'status': e.code, 'reason': str(e.reason),
+                            'headers': list(e.headers.items()) if e.headers else []})
+            raise
+        except urllib.error.URLError as e:
+            cassette().add({'kind': 'http', 'key': key, 't': t0, 'latency': time.time() - t0,
+                            'error': str(e.reason)})
+            raise
+        return _RecordingResponse(key, t0, time.time() - t0, response)
+
+    exchange = cassette().next('http', key)
+    with span('request', 'replay', url=url):
+        _wait_latency(exchange['latency'] if exchange is not None else None)
+    if exchange is None:
+        raise urllib.error.URLError(f'{url} is not in the cassette')
+    if exchange.get('error'):
+        raise urllib.error.URLError(exchange['error'])
+    if exchange['status'] >= 400:
+        raise urllib.error.HTTPError(url, exchange['status'], exchange.get('reason', ''),
+                                     _http_headers(exchange['headers']), None)
+    fail = _fails()
+    if fail and _fails(0.5):
+        # half of the failures before the response, the rest during the transfer (see _ReplayResponse)
+        raise urllib.error.URLError('connection refused (injected)')
+    return _ReplayResponse(url, exchange, cassette().blob(exchange['blob']), fail)
+
+# ------------------------------------------------------------
+# opendap (a backend of xarray, see open_dataset)
+# ------------------------------------------------------------
+
+def _to_json(value):
+    import numpy as np
+    if isinstance(value, (np.ndarray, np.generic)):
+        # with the dtype, which the decoding of the data depends on (e.g. of scale_factor)
+        return {'__array__': value.tolist(), 'dtype': value.dtype.str}
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+def _from_json(value):
+    import numpy as np
+    if isinstance(value, dict) and '__array__' in value:
+        return np.asarray(value['__array__'], dtype=value['dtype'])[()]
+    return value
+
+def _index(key, shape):
+    """
+    A basic indexer key (ints and slices) as [start, stop, step] lists and ints
+    """
+    return [list(k.indices(n)) if isinstance(k, slice) else int(k) % n for k, n in zip(key, shape)]
+
+def _read_key(url, var, index):
+    return f"{url}#{var}[{','.join(':'.join(map(str, i)) if isinstance(i, list) else str(i) for i in index)}]"
+
+def _within(index, recorded):
+    """
+    The key into the array of the recorded read index of the requested index, None if it isn't a subset of it
+    """
+    key = []
+    for req, rec in zip(index, recorded):
+        if isinstance(rec, int):
+            if req != rec:
+                return None
+            continue
+        start, stop, step = rec
+        if step != 1:
+            if req != rec:
+                return None
+            key.append(slice(None))
+        elif isinstance(req, int):
+            if not start <= req < stop:
+                return None
+            key.append(req - start)
+        else:
+            if req[2] <= 0 or req[0] < start or (req[1] > stop and req[0] < req[1]):
+                return None
+            key.append(slice(req[0] - start, max(req[1] - start, 0), req[2]))
+    return tuple(key)
+
+_backend = None
+
+def _opendap_backend():
+    """
+    The xarray backend (built once xarray is imported) which opens the datasets
+    through the cassette
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+    import numpy as np
+    from xarray import Variable
+    from xarray.backends import NetCDF4DataStore
+    from xarray.backends.common import AbstractDataStore, BackendArray, BackendEntrypoint
+    from xarray.backends.netCDF4_ import NetCDF4ArrayWrapper
+    from xarray.backends.store import StoreBackendEntrypoint
+    from xarray.core import indexing
+
+    class RecordedArray(BackendArray):
+        def __init__(self, url, name, wrapper):
+            self.url, self.name, self.wrapper = url, name, wrapper
+            self.shape, self.dtype = wrapper.shape, wrapper.dtype
+
+        def __getitem__(self, key):
+            return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self._read)
+
+        def _read(self, key):
+            index = _index(key, self.shape)
+            t0 = time.time()
+            data = np.asarray(self.wrapper[indexing.BasicIndexer(key)])
+            c = cassette()
+            tmp = c.blob_path(f'.{os.getpid()}.{threading.get_ident()}.npy')
+            np.save(tmp, data)
+            blob = c.put_blob(src=tmp, ext='.npy')
+            os.unlink(tmp)
+            c.add({'kind': 'read', 'key': _read_key(self.url, self.name, index), 't': t0,
+                   'url': self.url, 'var': self.name, 'index': index,
+                   'latency': time.time() - t0, 'bytes': data.nbytes, 'blob': blob})
+            return data
+
+    class RecordingStore(AbstractDataStore):
+        def __init__(self, url):
+            self.url = url
+            t0 = time.time()
+            try:
+                self._store = NetCDF4DataStore.open(url)
+            except Exception as e:
+                cassette().add({'kind': 'opendap', 'key': url, 't': t0, 'latency': time.time() - t0,
+                                'error': str(e)})
+                raise
+            self._variables = self._store.get_variables()
+            schema = {
+                'dims': dict(self._store.get_dimensions()),
+                'attrs': {k: _to_json(v) for k, v in self._store.get_attrs().items()},
+                'unlimited_dims': sorted(self._store.get_encoding().get('unlimited_dims', ())),
+                'variables': {name: {'dims': list(v.dims), 'dtype': np.dtype(v.dtype).str,
+                                     'attrs': {k: _to_json(a) for k, a in v.attrs.items()}}
+                              for name, v in self._variables.items()},
+            }
+            c = cassette()
+            c.add({'kind': 'opendap', 'key': url, 't': t0, 'latency': time.time() - t0,
+                   'blob': c.put_blob(json.dumps(schema).encode(), ext='.json')})
+
+        def get_variables(self):
+            return {name: Variable(v.dims, indexing.LazilyIndexedArray(
+                        RecordedArray(self.url, name, NetCDF4ArrayWrapper(name, self._store))),
+                        v.attrs, v.encoding)
+                    for name, v in self._variables.items()}
+
+        def get_attrs(self):
+            return self._store.get_attrs()
+
+        def get_dimensions(self):
+            return self._store.get_dimensions()
+
+        def get_encoding(self):
+            return self._store.get_encoding()
+
+        def close(self):
+            self._store.close()
+
+    class ReplayArray(BackendArray):
+        def __init__(self, url, name, shape, dtype):
+            self.url, self.name, self.shape, self.dtype = url, name, shape, dtype
+
+        def __getitem__(self, key):
+            return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self._read)
+
+        def _read(self, key):
+            index = _index(key, self.shape)
+            c = cassette()
+            key = _read_key(self.url, self.name, index)
+            exchange, sub = c.next('read', key, warn=False), None
+            if exchange is None:
+                # a part of a larger read, e.g. a day of a recorded slice
+                for recorded in c.reads(self.url, self.name):
+                    sub = _within(index, recorded['index'])
+                    if sub is not None:
+                        exchange = recorded
+                        break
+            if exchange is None:
+                c.missing('read', key)
+                raise RuntimeError(f'NetCDF: DAP failure ({key} is not in the cassette)')
+            data = np.load(c.blob_path(exchange['blob']), mmap_mode='r' if sub is not None else None)
+            if sub is not None:
+                data = np.array(data[sub])
+            with span('read', 'replay', var=self.name):
+                if LATENCY is None and not BANDWIDTH:
+                    # the recorded time, scaled to the part of the read served
+                    time.sleep(exchange['latency'] * data.nbytes / max(exchange['bytes'], 1))
+                else:
+                    _wait_latency(0.)
+                    _wait_transfer(data.nbytes)
+            if _fails():
+                raise RuntimeError('NetCDF: DAP failure (injected)')
+            return data
+
+    class ReplayStore(AbstractDataStore):
+        def __init__(self, url):
+            self.url = url
+            c = cassette()
+            exchange = c.next('opendap', url)
+            with span('open', 'replay', url=url):
+                _wait_latency(exchange['latency'] if exchange is not None else None)
+            if exchange is None:
+                raise OSError(f'[Errno -70] NetCDF: DAP server error: {url} is not in the cassette')
+            if exchange.get('error'):
+                raise OSError(exchange['error'])
+            if _fails():
+                raise OSError(f'[Errno -70] NetCDF: DAP server error (injected): {url}')
+            self.schema = json.loads(c.blob(exchange['blob']))
+
+        def get_variables(self):
+            dims = self.schema['dims']
+            variables = {}
+            for name, v in self.schema['variables'].items():
+                attrs = {k: _from_json(a) for k, a in v['attrs'].items()}
+                shape = tuple(dims[d] for d in v['dims'])
+                variables[name] = Variable(v['dims'], indexing.LazilyIndexedArray(
+                    ReplayArray(self.url, name, shape, np.dtype(v['dtype']))), attrs)
+            return variables
+
+        def get_attrs(self):
+            return {k: _from_json(v) for k, v in self.schema['attrs'].items()}
+
+        def get_dimensions(self):
+            return self.schema['dims']
+
+        def get_encoding(self):
+            return {'unlimited_dims': set(self.schema['unlimited_dims'])}
+
+        def close(self):
+            pass
+
+    class Backend(BackendEntrypoint):
+        description = 'OPeNDAP through the record/replay cassette (see download_tools/transport.py)'
+
+        def open_dataset(self, filename_or_obj, *, mask_and_scale=True, decode_times=True,
+                         concat_characters=True, decode_coords=True, drop_variables=None,
+                         use_cftime=None, decode_timedelta=None):
+            store = RecordingStore(filename_or_obj) if MODE == 'record' else ReplayStore(filename_or_obj)
+            return StoreBackendEntrypoint().open_dataset(
+                store, mask_and_scale=mask_and_scale, decode_times=decode_times,
+                concat_characters=concat_characters, decode_coords=decode_coords,
+                drop_variables=drop_variables, use_cftime=use_cftime, decode_timedelta=decode_timedelta)
+
+    _backend = Backend
+    return _backend
+
+def open_dataset(url, **kwargs):
+    """
+    xr.open_dataset of a remote (OPeNDAP) dataset, through the cassette when
+    recording or replaying
+    """
+    import xarray as xr
+    if MODE is None or not str(url).startswith(('http://', 'https://')):
+        return xr.open_dataset(url, **kwargs)
+    return xr.open_dataset(url, engine=_opendap_backend(), **kwargs)
+
+# ------------------------------------------------------------
+# clients which write a file (copernicusmarine, cdsapi)
+# ------------------------------------------------------------
+
+def fetch_file(kind, key, target, fetch):
+    """
+    Run fetch(), a request which writes the file target, through the cassette.
+    key (e.g. a dict of the request, without the credentials) identifies the
+    request in the cassette
+    """
+    if MODE is None:
+        return fetch()
+    key = json.dumps(key, sort_keys=True, default=str)
+    c = cassette()
+    if MODE == 'record':
+        t0 = time.time()
+        try:
+            fetch()
+        except Exception as e:
+            c.add({'kind': kind, 'key': key, 't': t0, 'latency': time.time() - t0, 'error': str(e),
+                   'raised': True})
+            raise
+        exchange = {'kind': kind, 'key': key, 't': t0, 'latency': time.time() - t0}
+        if os.path.isfile(target):
+            exchange.update(bytes=os.path.getsize(target), blob=c.put_blob(src=target))
+        else:
+            exchange['error'] = f'no output from the {kind} request'
+        c.add(exchange)
+        return
+
+    exchange = c.next(kind, key)
+    if exchange is None:
+        raise RuntimeError(f'{kind} request {key} is not in the cassette')
+    with span('request', 'replay', kind=kind):
+        if LATENCY is None and not BANDWIDTH:
+            time.sleep(exchange['latency'])
+        else:
+            _wait_latency(0.)
+            _wait_transfer(exchange.get('bytes', 0))
+    if _fails():
+        raise RuntimeError(f'{kind} request failed (injected)')
+    if exchange.get('raised'):
+        raise RuntimeError(exchange['error'])
+    if exchange.get('blob') is None:
+        # the client ended without an output when it was recorded
+        return
+    shutil.copyfile(c.blob_path(exchange['blob']), target)
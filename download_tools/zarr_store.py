@@ -0,0 +1,143 @@
+"""
+Appendable Zarr output, as an alternative to writing one NetCDF file per month or per run
+
+All the data for a dataset/domain goes into a single Zarr store which grows along
+time. The chunks are long in time and small in space, so reading a time series
+(or any time window) only touches the chunks it needs, and new data is written
+chunk by chunk in parallel (through dask) when it's appended.
+"""
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from download_tools.encoding import get_policy, zarr_encoding
+from download_tools.locking import lease
+
+# target size of a chunk, and the number of points along each horizontal dimension in a chunk
+TARGET_CHUNK_BYTES = 2 * 1024**2
+SPATIAL_CHUNK = 32
+
+def store_name(outputDir, dataset, domain):
+    """
+    The store for a dataset and domain e.g. <outputDir>/<dataset>_10_25_-40_-25.zarr
+    """
+    return os.path.join(outputDir, f"{dataset}_{'_'.join(f'{d:g}' for d in domain)}.zarr")
+
+def zarr_chunks(da, time_chunk=None):
+    """
+    Chunk sizes for a variable: SPATIAL_CHUNK points along lat/lon, a single
+    level along depth, and as many time steps as fit in TARGET_CHUNK_BYTES
+    """
+    chunks = {}
+    for dim, size in da.sizes.items():
+        if dim == 'time':
+            continue
+        elif dim in ('depth', 'lev', 'level'):
+            chunks[dim] = 1
+        else:
+            chunks[dim] = min(size, SPATIAL_CHUNK)
+    if 'time' in da.dims:
+        if time_chunk is None:
+            points = int(np.prod(list(chunks.values()))) if chunks else 1
+            time_chunk = max(1, TARGET_CHUNK_BYTES // (points * da.dtype.itemsize))
+        chunks['time'] = time_chunk
+    return chunks
+
+def store_times(store):
+    """
+    The time coordinate of an existing store (only the time array is read), or None
+    """
+    if not os.path.exists(store):
+        return None
+    with xr.open_zarr(store) as ds:
+        return pd.DatetimeIndex(ds['time'].values)
+
+def store_covers(store, start, end):
+    """
+    True if the store already has every time step from start to end, i.e. it
+    spans them with no gap longer than its time step (the most common interval
+    between its times), so that a month missing in the middle isn't skipped
+    """
+    times = store_times(store)
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if times is None or len(times) == 0 or times[0] > start or times[-1] < end:
+        return False
+    if len(times) == 1:
+        return True
+    step = pd.Series(times).diff().mode()[0]
+    # the times from the last one at or before start to the first one at or after end
+    window = times[times.searchsorted(start, side='right') - 1:times.searchsorted(end) + 1]
+    return bool((window[1:] - window[:-1] <= step).all())
+
+def append_to_zarr(ds, store, time_chunk=None):
+    """
+    Append ds along time to the Zarr store, creating the store if needed.
+
+    Time steps of ds which are already in the store (e.g. the forecast days of
+    a previous ops run) are overwritten in place, the rest is appended. Only
+    data which extends the store forwards in time can be appended. Processes
+    appending to the same store take turns (see locking.py).
+    """
+    with lease(store):
+        _append_to_zarr(ds, store, time_chunk)
+
+def _append_to_zarr(ds, store, time_chunk):
+    ds = ds.sortby('time')
+    existing = store_times(store)
+
+    if existing is None:
+        # compression and quantization as for the NetCDF outputs (see encoding.py),
+        # appends then inherit them from the store
+        policy = get_policy()
+        encoding = {}
+        for v in list(ds.data_vars):
+            chunks = zarr_chunks(ds[v], time_chunk)
+            encoding[v] = dict(zarr_encoding(v, ds[v], policy), chunks=tuple(chunks[d] for d in ds[v].dims))
+            ds[v] = ds[v].chunk(chunks)
+        for v in list(ds.data_vars):
+            # xarray complains if the source encoding doesn't match the zarr chunks
+            for key in ('chunksizes', 'contiguous', 'zlib', 'complevel', 'shuffle', 'fletcher32'):
+                ds[v].encoding.pop(key, None)
+        ds.to_zarr(store, mode='w-', encoding=encoding, consolidated=True)
+        print(f'Created {store} with {ds.time.size} time steps')
+        return
+
+    times = pd.DatetimeIndex(ds['time'].values)
+    overlap = times.isin(existing)
+    if overlap.any():
+        # overwrite the time steps we already have, as a region of the store
+        ds_old = ds.isel(time=np.where(overlap)[0]).load()
+        i0 = existing.get_loc(pd.DatetimeIndex(ds_old['time'].values)[0])
+        static = [v for v in ds_old.variables if 'time' not in ds_old[v].dims]
+        ds_old.drop_vars(static).to_zarr(store, region={'time': slice(i0, i0 + ds_old.time.size)},
+                                         consolidated=True)
+        print(f'Updated {ds_old.time.size} time steps in {store}')
+
+    ds_new = ds.isel(time=np.where(~overlap)[0])
+    if ds_new.time.size == 0:
+        return
+    if pd.Timestamp(ds_new['time'].values[0]) <= existing[-1]:
+        raise ValueError(f"Can only append data after the end of {store} ({existing[-1]})")
+
+    # align the dask chunks with the zarr chunks, so that chunks can be written in parallel,
+    # the first dask chunk filling up the partial last chunk of the store
+    with xr.open_zarr(store) as ds_store:
+        store_chunks = {v: ds_store[v].encoding.get('chunks') for v in ds_store.data_vars}
+    for v in list(ds_new.data_vars):
+        if 'time' not in ds_new[v].dims or store_chunks.get(v) is None:
+            continue
+        chunks = dict(zip(ds_new[v].dims, store_chunks[v]))
+        tc = chunks['time']
+        first = tc - len(existing) % tc
+        nt = ds_new.time.size
+        tchunks = [min(first, nt)] + [tc] * ((nt - min(first, nt)) // tc)
+        if sum(tchunks) < nt:
+            tchunks.append(nt - sum(tchunks))
+        chunks['time'] = tuple(tchunks)
+        ds_new[v] = ds_new[v].chunk(chunks)
+        for key in ('chunksizes', 'contiguous', 'zlib', 'complevel', 'shuffle', 'fletcher32'):
+            ds_new[v].encoding.pop(key, None)
+    static = [v for v in ds_new.variables if 'time' not in ds_new[v].dims]
+    ds_new.drop_vars(static).to_zarr(store, append_dim='time', consolidated=True)
+    print(f'Appended {ds_new.time.size} time steps to {store}')